@@ -17,9 +17,12 @@
 import json
 import sys
 import os
+import time
 import argparse
 
-from libs.backupCore import backupCore
+from libs.common.fsTools import getHumanityDiskUsage
+from libs.core.powerDriver import getPowerDriver, POWER_DRIVERS
+from libs.core.runHistory import runHistory, getForecast
 
 
 def getDefaultConfigFile():
@@ -84,12 +87,24 @@ def getConfig(args):
     if args.ipmi_pass:
         config['ipmi']['password'] = args.ipmi_pass
 
+    if args.ipmi_backend:
+        config['ipmi']['backend'] = args.ipmi_backend
+
+    if args.ipmi_driver:
+        config['ipmi']['driver'] = args.ipmi_driver
+
     if args.server_host:
         config['server']['host'] = args.server_host
 
     if args.server_timeout:
         config['server']['timeout'] = args.server_timeout
 
+    if args.server_ready_by:
+        config['server']['ready_by'] = args.server_ready_by
+
+    if args.server_slot:
+        config['server']['slot'] = args.server_slot
+
     if args.server_mountpoint:
         config['server']['mountpoint'] = args.server_mountpoint
 
@@ -155,17 +170,27 @@ def validateConfig(config):
         print("broken config (mail)")
         return False
 
-    if config['ipmi'].get('host') is None:
-        print("broken config (ipmi.host)")
+    if config['ipmi'].get('driver', 'ipmi') not in POWER_DRIVERS:
+        print("broken config (ipmi.driver)")
         return False
 
-    if config['ipmi'].get('user') is None:
-        print("broken config (ipmi.user)")
-        return False
+    if config['ipmi'].get('driver') == 'wol':
+        if config['ipmi'].get('wol', {}).get('mac') is None:
+            print("broken config (ipmi.wol.mac)")
+            return False
 
-    if config['ipmi'].get('password') is None:
-        print("broken config (ipmi.password)")
-        return False
+    else:
+        if config['ipmi'].get('host') is None:
+            print("broken config (ipmi.host)")
+            return False
+
+        if config['ipmi'].get('user') is None:
+            print("broken config (ipmi.user)")
+            return False
+
+        if config['ipmi'].get('password') is None:
+            print("broken config (ipmi.password)")
+            return False
 
     if config['server'].get('host') is None:
         print("broken config (server.host)")
@@ -214,6 +239,163 @@ def validateConfig(config):
     return True
 
 
+def getTargetConfigs(config):
+    targets = []
+    for index, target in enumerate(config.get('targets', [])):
+        targetConfig = {}
+        for section in ['ipmi', 'server', 'client', 'rsnapshot', 'log', 'mail']:
+            targetConfig[section] = dict(config[section], **target.get(section, {}))
+
+        for section in ['metrics', 'history']:
+            targetConfig[section] = dict(config.get(section, {}), **target.get(section, {}))
+
+        targetConfig['name'] = target.get('name', targetConfig['server'].get('host', f'target{index}'))
+        targets.append(targetConfig)
+
+    return targets
+
+
+def validateTargets(targets):
+    mountpoints = set()
+    for target in targets:
+        if not validateConfig(target):
+            print(f"broken config (target {target['name']})")
+            return False
+
+        if target['client']['mountpoint'] in mountpoints:
+            print(f"broken config (target {target['name']}: client.mountpoint already in use)")
+            return False
+
+        mountpoints.add(target['client']['mountpoint'])
+
+    return True
+
+
+def runCatalog(config, args):
+    from libs.core.catalogCore import catalogCore
+
+    catalog_file = config['rsnapshot'].get('catalog')
+    if catalog_file is None or not os.path.isfile(catalog_file):
+        print("broken config (rsnapshot.catalog)")
+        sys.exit(1)
+
+    catalog = catalogCore(catalog_file)
+    if args.catalog_action == 'lookup':
+        for path, size, mtime, rotations in catalog.lookup(args.pattern):
+            print(f"{path}\t{size}\t{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(mtime))}\t{', '.join(rotations)}")
+
+    elif args.catalog_action == 'diff':
+        result = catalog.diff(args.rotation_a, args.rotation_b)
+        if result is None:
+            print(f'unknown rotation {args.rotation_a} or {args.rotation_b}')
+            sys.exit(1)
+
+        added, removed, changed = result
+        for path in added:
+            print(f'+ {path}')
+        for path in removed:
+            print(f'- {path}')
+        for path in changed:
+            print(f'M {path}')
+
+    catalog.close()
+
+
+def runControl(config, args):
+    from libs.daemonCore import sendControl
+
+    socketPath = config.get('daemon', {}).get('socket', '/run/ipmi-backup.sock')
+    line = ' '.join([args.ctl_action] + ([args.job] if args.job else []))
+    try:
+        response = sendControl(socketPath, line)
+    except OSError as ex:
+        print(f'unable to reach daemon at {socketPath}: {ex}')
+        sys.exit(1)
+
+    print(json.dumps(response, indent=2))
+
+
+def runStatus(config, args):
+    ipmiDict = config['ipmi']
+    keys = ['wol'] if ipmiDict.get('driver') == 'wol' else ['host', 'user', 'password']
+    for key in keys:
+        if ipmiDict.get(key) is None:
+            print(f"broken config (ipmi.{key})")
+            sys.exit(1)
+
+    try:
+        cache = getPowerDriver(ipmiDict, config['server'].get('host'))
+    except (KeyError, ValueError) as ex:
+        print(f'broken config (ipmi): {ex}')
+        sys.exit(1)
+
+    err, status = cache.getChassisPowerStatus(args.max_age)
+    cache.close()
+    if err != 0:
+        print(f'unable to get chassis power status: {status}')
+        sys.exit(1)
+
+    print(f'Chassis Power is {status}')
+
+
+def formatSeconds(seconds):
+    if seconds >= 3600:
+        return f'{seconds / 3600:.1f} h'
+    if seconds >= 60:
+        return f'{seconds / 60:.1f} min'
+    return f'{seconds:.1f} s'
+
+
+def runReport(config, args):
+    history_file = config.get('history', {}).get('file')
+    if not history_file:
+        print("broken config (history.file)")
+        sys.exit(1)
+
+    histories = [(None, history_file)]
+    if 'targets' in config:
+        root, ext = os.path.splitext(history_file)
+        histories = [(target['name'], f'{root}_{target["name"]}{ext}') for target in getTargetConfigs(config)]
+
+    window = config['history'].get('window')
+    since = time.time() - args.days * 86400
+    for name, filename in histories:
+        if name is not None:
+            print(f'[{name}]')
+
+        try:
+            forecast = getForecast(runHistory(filename).load(since), window)
+        except (OSError, ValueError) as ex:
+            print(f'unable to read {filename}: {ex}')
+            continue
+
+        if forecast is None:
+            print(f'no successful runs in the last {args.days} days')
+            continue
+
+        print(f"runs            {forecast['runs']} ({forecast['failed']} failed) "
+              f"from {forecast['first']:%Y-%m-%d} to {forecast['last']:%Y-%m-%d}")
+        print(f"snapshot        {getHumanityDiskUsage(forecast['apparent'])}, "
+              f"{getHumanityDiskUsage(forecast['unique_mean'])} new per run")
+        if forecast['apparent_growth'] is not None:
+            print(f"snapshot growth {getHumanityDiskUsage(forecast['apparent_growth'])} per day")
+        print(f"duration        mean {formatSeconds(forecast['duration_mean'])}, "
+              f"max {formatSeconds(forecast['duration_max'])}, boot {formatSeconds(forecast['ready_mean'])}, "
+              f"powered on {formatSeconds(forecast['powered_on_mean'])}")
+        print(f"throughput      {getHumanityDiskUsage(forecast['throughput_mean'])}/s")
+        if forecast['powered_on_growth'] is not None:
+            print(f"window growth   {forecast['powered_on_growth']:+.1f} s per day")
+        if window:
+            exceeded = forecast['window_exceeded']
+            print(f"window          {formatSeconds(window)}, "
+                  f"{'exceeded by ' + f'{exceeded:%Y-%m-%d}' if exceeded else 'not exceeded at the current trend'}")
+        if forecast['disk_total']:
+            full = forecast['disk_full']
+            print(f"disk            {getHumanityDiskUsage(forecast['disk_free'])} free of "
+                  f"{getHumanityDiskUsage(forecast['disk_total'])}, "
+                  f"{'full by ' + f'{full:%Y-%m-%d}' if full else 'not filling up at the current trend'}")
+
+
 def main():
     parser = argparse.ArgumentParser(
         description='runner',
@@ -240,6 +422,18 @@ def main():
                         metavar='impi password',
                         type=str)
 
+    parser.add_argument('-ib', '--impi-backend',
+                        dest='ipmi_backend',
+                        metavar='impi backend',
+                        choices=['native', 'ipmitool'],
+                        type=str)
+
+    parser.add_argument('-id', '--impi-driver',
+                        dest='ipmi_driver',
+                        metavar='impi driver',
+                        choices=POWER_DRIVERS,
+                        type=str)
+
     parser.add_argument('-sh ', '--server-host',
                         dest='server_host',
                         metavar='server host',
@@ -250,6 +444,16 @@ def main():
                         metavar='timeout till server is up',
                         type=int)
 
+    parser.add_argument('-srb', '--server-ready-by',
+                        dest='server_ready_by',
+                        metavar='HH:MM the server has to be ready by',
+                        type=str)
+
+    parser.add_argument('-ssl', '--server-slot',
+                        dest='server_slot',
+                        metavar='scheduled slot of this run, a retry with the same slot resumes',
+                        type=str)
+
     parser.add_argument('-smp', '--server-mountpoint',
                         dest='server_mountpoint',
                         metavar='server mount point',
@@ -267,7 +471,7 @@ def main():
 
     parser.add_argument('-rsc', '--rsnapshot-command',
                         dest='rsnapshot_command',
-                        metavar='rsnapschot command',
+                        metavar='rsnapschot command(s), comma separated',
                         type=str)
 
     parser.add_argument('-rsrf', '--rsnapshot-root-folder',
@@ -296,15 +500,73 @@ def main():
                         metavar='mail to address',
                         type=str)
 
+    subparsers = parser.add_subparsers(dest='action')
+    catalogParser = subparsers.add_parser('catalog', help='query the snapshot catalog')
+    catalogActions = catalogParser.add_subparsers(dest='catalog_action', required=True)
+    lookupParser = catalogActions.add_parser('lookup', help='list the rotations holding files matching a glob')
+    lookupParser.add_argument('pattern', type=str)
+    diffParser = catalogActions.add_parser('diff', help='list files added, removed or changed between rotations')
+    diffParser.add_argument('rotation_a', type=str)
+    diffParser.add_argument('rotation_b', type=str)
+
+    statusParser = subparsers.add_parser('status', help='print the chassis power state, served from the cache')
+    statusParser.add_argument('--max-age', dest='max_age', type=float,
+                              help='oldest cached state in seconds that is still accepted')
+
+    reportParser = subparsers.add_parser('report', help='growth trends and forecasts from the run history')
+    reportParser.add_argument('--days', type=int, default=90, help='history to take into account')
+
+    subparsers.add_parser('daemon', help='run as resident daemon with the scheduled jobs of daemon.jobs')
+    ctlParser = subparsers.add_parser('ctl', help='talk to a running daemon')
+    ctlParser.add_argument('ctl_action', choices=['status', 'queue', 'run'])
+    ctlParser.add_argument('job', nargs='?', type=str)
+
     try:
         args = parser.parse_args()
     except SystemExit:
         sys.exit()
 
     config = getConfig(args)
+    if args.action == 'catalog':
+        runCatalog(config, args)
+        return
+
+    if args.action == 'status':
+        runStatus(config, args)
+        return
+
+    if args.action == 'report':
+        runReport(config, args)
+        return
+
+    if args.action == 'ctl':
+        runControl(config, args)
+        return
+
+    if 'targets' in config:
+        if args.action == 'daemon':
+            print("broken config (targets): the daemon runs a single target, start one daemon per target")
+            sys.exit(1)
+
+        targets = getTargetConfigs(config)
+        if not validateTargets(targets):
+            sys.exit()
+
+        from libs.fleetCore import fleetCore
+        f = fleetCore(config, targets)
+        f.run()
+        return
+
     if not validateConfig(config):
         sys.exit()
 
+    if args.action == 'daemon':
+        from libs.daemonCore import daemonCore
+        d = daemonCore(config)
+        d.run()
+        return
+
+    from libs.backupCore import backupCore
     b = backupCore(config)
     b.run()
 
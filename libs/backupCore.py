@@ -14,83 +14,170 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
+import contextvars
+import datetime
 import logging
 import logging.handlers
 import os.path
+import sqlite3
 import subprocess
 import sys
+import threading
 import time
-
-from libs.common.BufferingSMTPHandler import BufferingSMTPHandler
-from libs.common.fsTools import mount, umount, getDiskUsage, getHumanityDiskUsage
-from libs.common.netTools import canPing
-from libs.core.ipmiCore import ipmiCore
+from collections import deque
+from concurrent.futures.process import BrokenProcessPool
+
+from libs.common.fsTools import mount, umount, getSnapshotUsage, getHumanityDiskUsage
+from libs.common.logTools import setupLogging, shutdownLogging, prefixLoggerAdapter, runId, target
+from libs.common.metricsTools import phaseTimer, writePrometheus, appendJson
+from libs.common.netTools import canPing, waitForReady
+from libs.common.rsyncStats import rsyncStats
+from libs.core.bootHistory import bootHistory, getReadyBy
+from libs.core.catalogCore import catalogCore
+from libs.core.changeCore import changeCore
+from libs.core.dedupeCore import dedupeCore
+from libs.core.mountTuner import mountTuner
+from libs.core.powerDriver import getPowerDriver
+from libs.core.runHistory import runHistory, getHistoryRecord
+from libs.core.runJournal import runJournal
+from libs.core.rsnapshotConfig import readRsnapshotConfig, getSnapshotPath, getFilter
+from libs.core.shardCore import shardCore
+from libs.core.throttleCore import throttleCore, selectPolicy, getBlockDevice, recordThroughput, \
+    getPolicyThroughput
+from libs.core.trashCore import trashCore
+from libs.core.verifyCore import verifyCore
 
 
 class backupCore:
 
-    def __init__(self, config):
+    def __init__(self, config, name=None, rsnapshotSlots=None, prefix=None):
         self._config = config
+        self._name = name
+        self._rsnapshotSlots = rsnapshotSlots
+        self._metrics = phaseTimer()
+        self._coalesced = False
+        self._reports = []
+        self._powerOffWatch = None
+        self.lastRun = None
+        self._resumed = set()
+        self._executed = set()
+
+        boot_history = self._config.get('server', {}).get('boot_history')
+        if boot_history and name is not None:
+            root, ext = os.path.splitext(boot_history)
+            boot_history = f'{root}_{name}{ext}'
+        self._bootHistory = bootHistory(boot_history)
+
+        journal_file = self._config.get('server', {}).get('journal')
+        if journal_file and name is not None:
+            root, ext = os.path.splitext(journal_file)
+            journal_file = f'{root}_{name}{ext}'
+        self._journal = runJournal(journal_file or None)
+
+        # name makes a fleet target with its own files, prefix only tags the log lines of a caller that set up logging
+        if name is None and prefix is None:
+            self._logger = setupLogging(self._config)
+        else:
+            self._logger = prefixLoggerAdapter(logging.getLogger(), {'prefix': name or prefix})
 
-        self._logger = logging.getLogger()
-        _log_handler = logging.FileHandler(self._config['log']['filename'])
-        _str_log_level = self._config['log']['level']
-        _log_level = getattr(logging, _str_log_level)
-        self._logger.setLevel(_log_level)
-        _log_handler.setLevel(_log_level)
-
-        _log_format = logging.Formatter('%(asctime)s - %(levelname)-8s - %(message)s')
-        _log_handler.setFormatter(_log_format)
-
-        self._logger.addHandler(_log_handler)
+        self._ipmi = getPowerDriver(self._config['ipmi'], self._config['server'].get('host'))
 
-        _mail_handler = BufferingSMTPHandler('localhost', self._config['mail']['fromaddr'],
-                                             [self._config['mail']['toaddr']], 'ipmi backup', 500)
-        _mail_handler.setLevel(logging.DEBUG)
-        self._logger.addHandler(_mail_handler)
+    def getBootTimeout(self):
+        server_timeout = self._config['server']['timeout']
+        margin = self._config['server'].get('timeout_margin', 30)
+        return self._bootHistory.getTimeout(server_timeout, margin)
 
-        ipmiDict = self._config['ipmi']
-        self._ipmi = ipmiCore(ipmiDict['host'], ipmiDict['user'], ipmiDict['password'])
+    def getBootEstimate(self):
+        # how long a boot really takes, so the early power on lands just before the slot
+        server_timeout = self._config['server']['timeout']
+        margin = self._config['server'].get('timeout_margin', 30)
+        return self._bootHistory.getEstimate(server_timeout, margin)
 
-    def startIPMIServer(self):
+    def startIPMIServer(self, previous=None):
         server_host = self._config['server']['host']
-        server_timeout = self._config['server']['timeout']
-        err, status = self._ipmi.getChassisPowerStatus()
+        server_timeout = self.getBootTimeout()
+        with self._metrics.phase('ipmi_status') as phase:
+            err, status = self._ipmi.getChassisPowerStatus()
+            phase.ok = err == 0
         self._logger.debug(f'ipmi.getChassisPowerStatus() returns {err}, {status}')
         if err != 0:
             return False
 
         if status == 'on':
+            # the interrupted run powered the server on itself, it is still booting rather than in use by someone else
+            if previous is None or not (previous['booting'] or previous['powered_on']):
+                self._logger.debug(f'mutual exclusion: can\'t ping {server_host}, but chassis power status is on')
+                return False
 
-            self._logger.debug(f'mutual exclusion: can\'t ping {server_host}, but chassis power status is on')
+            self._logger.info(f'{server_host} was powered on by run {previous["run_id"]}, waiting for it')
+        else:
+            with self._metrics.phase('power_on') as phase:
+                err, status = self._ipmi.setChassisPower('on')
+                phase.ok = err == 0 and status == 'on'
+            self._logger.debug(f'ipmi.setChassisPower() returns {err}, {status}')
+            if err != 0:
+                return False
+
+            if status != 'on':
+                self._logger.debug(f'unable to power on server {server_host}....')
+                return False
+
+            self.journal('booting')
+
+        stages = self._config['server'].get('probe')
+        self._logger.debug(f'waiting up to {self.getHumanityTime(server_timeout)} for {server_host}')
+        with self._metrics.phase('time_to_ready') as phase:
+            ready, timings = waitForReady(server_host, server_timeout, stages)
+            phase.ok = ready
+        for stage, elapsed in timings.items():
+            self._metrics.add(f'ready_{stage}', elapsed)
+            self._logger.debug(f'{server_host}: {stage} ready after {elapsed:.2f} seconds')
+
+        if not ready:
+            self._logger.debug(f'timeout: start server {server_host}....')
             return False
 
-        err, status = self._ipmi.setChassisPower('on')
-        self._logger.debug(f'ipmi.setChassisPower() returns {err}, {status}')
-        if err != 0:
-            return False
+        try:
+            self._bootHistory.add(self._metrics.phases['time_to_ready']['duration'])
+        except OSError as ex:
+            self._logger.error(f'unable to update boot history: {ex}')
 
-        if status != 'on':
-            self._logger.debug(f'unable to power on server {server_host}....')
-            return False
+        return True
 
-        timeout = time.time() + server_timeout
-        while True:
-            time.sleep(0.25)
-            if time.time() > timeout:
-                break
-            if canPing(server_host):
-                break
+    def waitUntil(self, moment, reason):
+        seconds = (moment - datetime.datetime.now()).total_seconds()
+        if seconds > 0:
+            self._logger.info(f'waiting {self.getHumanityTime(seconds)} {reason}')
+            time.sleep(seconds)
 
-        if not canPing(self._config['server']['host']):
-            self._logger.debug(f'timeout: start server {server_host}....')
+    def stopIPMIServer(self):
+        with self._metrics.phase('power_off') as phase:
+            err, status = self._ipmi.setChassisPower('soft')
+            phase.ok = err == 0
+        self._logger.debug(f'ipmi.setChassisPower() returns {err}, {status}')
+        if err != 0:
             return False
 
+        # the soft shutdown takes a while, nobody has to wait for it in the foreground
+        self._powerOffWatch = threading.Thread(target=contextvars.copy_context().run, args=(self.watchPowerOff,))
+        self._powerOffWatch.start()
         return True
 
-    def stopIPMIServer(self):
-        err, status = self._ipmi.setChassisPower('soft')
-        self._logger.debug(f'ipmi.setChassisPower() returns {err}, {status}')
+    def watchPowerOff(self):
+        server_host = self._config['server']['host']
+        off_timeout = self._config['server'].get('off_timeout', 300)
+        poll_interval = self._config['server'].get('off_poll_interval', 2)
+        start = time.monotonic()
+        while time.monotonic() - start < off_timeout:
+            err, status = self._ipmi.getChassisPowerStatus(0)
+            if err == 0 and status == 'off':
+                self._metrics.add('time_to_off', time.monotonic() - start)
+                self._logger.debug(f'{server_host} is off after {time.monotonic() - start:.2f} seconds')
+                return
+            time.sleep(poll_interval)
+
+        self._metrics.add('time_to_off', time.monotonic() - start, False)
+        self._logger.error(f'{server_host} is still on {self.getHumanityTime(off_timeout)} after the shutdown request')
 
     def getHumanityTime(self, time_elapsed):
         mm, ss = divmod(time_elapsed, 60)
@@ -109,67 +196,649 @@ class backupCore:
         avg = disk_usage / time_elapsed
         return f'{getHumanityDiskUsage(avg)}/s'
 
-    def executeSnapshot(self):
-
-        self._logger.info('start rsnapshot')
+    def getSnapshotCommands(self, commands=None):
+        commands = commands or self._config['rsnapshot']['command']
+        if isinstance(commands, str):
+            commands = [command.strip() for command in commands.split(',') if command.strip()]
+
+        try:
+            rsnapshot_config = readRsnapshotConfig(self._config['rsnapshot']['script'])
+            intervals = [name for name, _ in rsnapshot_config['retain']]
+            sync_first = rsnapshot_config['sync_first'] == '1'
+        except (OSError, ValueError, IndexError):
+            intervals = []
+            sync_first = False
+
+        # like rsnapshot's own cron examples: higher intervals rotate first, the lowest one syncs last
+        order = {name: index for index, name in enumerate(intervals)}
+        rotations = sorted([command for command in commands if not sync_first or command != 'sync'],
+                           key=lambda command: order.get(command, -1), reverse=True)
+        if sync_first:
+            # with sync_first only 'rsnapshot sync' transfers into .sync, every interval just rotates and the
+            # lowest one hands .sync over to <lowest>.0, so the sync has to come first
+            return (['sync'] if 'sync' in commands else []) + rotations, 'sync'
+
+        return rotations, intervals[0] if intervals else None
+
+    def getSnapshotDirs(self, rsnapshot_command):
+        root_folder = self._config['rsnapshot']['root_folder']
+        if rsnapshot_command != 'sync':
+            return (os.path.join(root_folder, f'{rsnapshot_command}.0'),
+                    os.path.join(root_folder, f'{rsnapshot_command}.1'))
+
+        # the fresh data stays in .sync, its predecessor is the newest rotation of the lowest interval
+        # that existed before this run
+        try:
+            lowest = readRsnapshotConfig(self._config['rsnapshot']['script'])['retain'][0][0]
+        except (OSError, ValueError, IndexError):
+            return os.path.join(root_folder, '.sync'), None
+
+        index = 1 if lowest in self._executed else 0
+        return os.path.join(root_folder, '.sync'), os.path.join(root_folder, f'{lowest}.{index}')
+
+    def _phaseName(self, name, rsnapshot_command):
+        if self._coalesced:
+            return f'{name}_{rsnapshot_command}'
+        return name
+
+    def executeSnapshot(self, rsnapshot_command=None, sync=True):
         rsnapshot_script = self._config['rsnapshot']['script']
-        rsnapshot_command = self._config['rsnapshot']['command']
+        rsnapshot_command = rsnapshot_command or self._config['rsnapshot']['command']
+        self._logger.info(f'start rsnapshot {rsnapshot_command}')
+        phase_name = self._phaseName('rsnapshot', rsnapshot_command)
+        expired = self.expireRotation(rsnapshot_command)
+
+        if self._rsnapshotSlots is not None:
+            self._logger.debug('waiting for a free rsnapshot slot')
+            with self._metrics.phase(self._phaseName('rsnapshot_slot_wait', rsnapshot_command)):
+                self._rsnapshotSlots.acquire()
+            try:
+                start_time = time.time()
+                with self._metrics.phase(phase_name) as phase:
+                    err, stats, stderr = self.runSnapshot(rsnapshot_script, rsnapshot_command)
+                    phase.ok = err == 0
+            finally:
+                self._rsnapshotSlots.release()
+        else:
+            start_time = time.time()
+            with self._metrics.phase(phase_name) as phase:
+                err, stats, stderr = self.runSnapshot(rsnapshot_script, rsnapshot_command)
+                phase.ok = err == 0
 
-        start_time = time.time()
-        command = ['/usr/bin/rsnapshot', '-c', rsnapshot_script, rsnapshot_command]
-        process = subprocess.run(command, capture_output=True, text=True)
-        err = process.returncode
         if err != 0:
-            self._logger.critical(f'rsnapshot returned {err}, {process.stderr.split(chr(10))[0]}')
-            return
+            self.restoreRotation(expired)
+            self._logger.critical(f'rsnapshot returned {err}, {stderr[0] if stderr else ""}')
+            for line in stderr[1:]:
+                self._logger.critical(line)
+            return False
 
         time_elapsed = time.time() - start_time
         ht = self.getHumanityTime(time_elapsed)
-        disk_usage = getDiskUsage(os.path.join(self._config['rsnapshot']['root_folder'], f'{rsnapshot_command}.0'))
-        hdu = getHumanityDiskUsage(disk_usage)
-        hAverageSpeed = self.getAverageSpeed(disk_usage, time_elapsed)
+        if not sync:
+            self._logger.info(f'rotated {rsnapshot_command} in {ht}')
+        else:
+            for key in ['files_transferred', 'literal_bytes', 'matched_bytes', 'bytes_itemized']:
+                self._metrics.values[f'rsync_{key}'] = stats[key]
+
+            self._logger.info(f'rsync transferred {stats["files_transferred"]} files, '
+                              f'{getHumanityDiskUsage(stats["literal_bytes"])} literal, '
+                              f'{getHumanityDiskUsage(stats["matched_bytes"])} matched')
 
-        self._logger.info(f'stored {hdu} in {ht} ({hAverageSpeed})')
+            # the only step that needs the source, so it runs before the umount
+            if self._config['rsnapshot'].get('verify', {}).get('mode', 'off') != 'off':
+                with self._metrics.phase(self._phaseName('verify', rsnapshot_command)) as phase:
+                    phase.ok = self.verifySnapshot(rsnapshot_command)
 
+        self._reports.append((rsnapshot_command, sync, ht, time_elapsed))
+        return True
+
+    def reportSnapshot(self, rsnapshot_command, sync, ht, time_elapsed):
+        if sync:
+            if self._config['rsnapshot'].get('dedupe', {}).get('enabled'):
+                with self._metrics.phase('dedupe'):
+                    self.dedupeSnapshot(rsnapshot_command)
+
+            snapshot, previous = self.getSnapshotDirs(rsnapshot_command)
+            with self._metrics.phase('disk_usage'):
+                usage = getSnapshotUsage(snapshot, previous, self._config['rsnapshot'].get('du_workers', 8))
+            for key in ['apparent', 'unique', 'files']:
+                self._metrics.values[f'snapshot_{key}'] = usage[key]
+            hdu = getHumanityDiskUsage(usage['unique'])
+            htotal = getHumanityDiskUsage(usage['apparent'])
+            hAverageSpeed = self.getAverageSpeed(usage['unique'], time_elapsed)
+
+            self._logger.info(f'stored {hdu} in {ht} ({hAverageSpeed}), '
+                              f'snapshot holds {htotal} in {usage["files"]} files')
+
+        # .sync is no rotation, the lowest interval catalogs the data once it took it over
+        if rsnapshot_command != 'sync':
+            with self._metrics.phase(self._phaseName('catalog', rsnapshot_command)):
+                self.updateCatalog(rsnapshot_command)
+
+    def reportSnapshots(self):
+        reports, self._reports = self._reports, []
+        for report in reports:
+            try:
+                self.reportSnapshot(*report)
+            except OSError as ex:
+                self._logger.error(f'unable to report snapshot {report[0]}: {ex}')
+
+    def expireRotation(self, rsnapshot_command):
+        trashDict = self._config['rsnapshot'].get('trash', {})
+        if not trashDict.get('enabled'):
+            return None
+
+        root_folder = self._config['rsnapshot']['root_folder']
+        try:
+            rsnapshot_config = readRsnapshotConfig(self._config['rsnapshot']['script'])
+        except (OSError, ValueError, IndexError):
+            return None
+
+        intervals = rsnapshot_config['retain']
+        names = [name for name, _ in intervals]
+        if rsnapshot_config.get('sync_first') == '1' or rsnapshot_command not in names:
+            return None
+
+        # rsnapshot only rotates a higher interval when the lower one has a last rotation to hand over
+        index = names.index(rsnapshot_command)
+        if index > 0:
+            lower, lower_retain = intervals[index - 1]
+            if not os.path.isdir(os.path.join(root_folder, f'{lower}.{lower_retain - 1}')):
+                return None
+
+        oldest = os.path.join(root_folder, f'{rsnapshot_command}.{intervals[index][1] - 1}')
+        if not os.path.isdir(oldest):
+            return None
+
+        try:
+            trashPath = trashCore(root_folder).expire(oldest)
+        except OSError as ex:
+            self._logger.error(f'unable to move {oldest} to the trash, rsnapshot deletes it inline: {ex}')
+            return None
+
+        self._logger.debug(f'moved expired rotation {oldest} to {trashPath}')
+        return oldest, trashPath
+
+    def restoreRotation(self, expired):
+        if expired is None or os.path.exists(expired[0]):
+            return
 
+        try:
+            trashCore.restore(expired[1], expired[0])
+            self._logger.info(f'restored expired rotation {expired[0]}')
+        except OSError as ex:
+            self._logger.error(f'unable to restore {expired[0]} from {expired[1]}: {ex}')
+
+    def reclaimTrash(self):
+        trashDict = self._config['rsnapshot'].get('trash', {})
+        if not trashDict.get('enabled'):
+            return
+
+        trash = trashCore(self._config['rsnapshot']['root_folder'], trashDict.get('workers', 8))
+        if not trash.backlog():
+            return
+
+        with self._metrics.phase('trash_reclaim') as phase:
+            result = trash.reclaim(trashDict.get('max_time', 0))
+            phase.ok = result['errors'] == 0
+
+        for key in ['files', 'freed', 'rate', 'backlog']:
+            self._metrics.values[f'trash_{key}'] = result[key]
+
+        ht = self.getHumanityTime(result['elapsed'])
+        self._logger.info(f'reclaimed {result["rotations"]} expired rotations ({result["files"]} files, '
+                          f'{getHumanityDiskUsage(result["freed"])} freed) in {ht} at {result["rate"]:.0f} files/s, '
+                          f'{result["backlog"]} rotations left in the trash')
+
+    def executeSnapshots(self, commands=None):
+        commands, lowest = self.getSnapshotCommands(commands)
+        self._coalesced = len(commands) > 1
+        if self._coalesced:
+            self._logger.info(f'running {", ".join(commands)} in one power cycle')
+
+        status = True
+        self._executed = set()
+        for rsnapshot_command in commands:
+            if rsnapshot_command in self._resumed:
+                self._logger.info(f'skipping rsnapshot {rsnapshot_command}, the interrupted run already did it')
+                continue
+
+            if not self.executeSnapshot(rsnapshot_command, lowest is None or rsnapshot_command == lowest):
+                status = False
+            else:
+                self._executed.add(rsnapshot_command)
+                self.journal('snapshot', command=rsnapshot_command)
+
+        return status
+
+    def getMountOptions(self, serverPath, client_mountpoint):
+        clientDict = self._config['client']
+        autotune = clientDict.get('autotune', {})
+        if not autotune.get('enabled'):
+            return clientDict.get('mount_options')
+
+        tuner = mountTuner(autotune.get('profile'), autotune.get('candidates'),
+                           autotune.get('sample_bytes', 256 * 1024 * 1024), autotune.get('max_time', 30),
+                           autotune.get('sample_path', ''))
+        profile = tuner.loadProfile(serverPath, autotune.get('max_age', 30) * 86400)
+        if profile is None:
+            self._logger.info(f'autotuning mount options for {serverPath}')
+            with self._metrics.phase('mount_autotune'):
+                try:
+                    profile = tuner.tune(serverPath, client_mountpoint, self._logger)
+                except OSError as ex:
+                    self._logger.error(f'autotune failed: {ex}')
+                    profile = None
+
+            if profile is None:
+                return clientDict.get('mount_options')
+
+            self._logger.info(f'autotune picked {profile["options"]} '
+                              f'({getHumanityDiskUsage(profile["throughput"])}/s)')
+
+        return profile['options']
+
+    def dedupeSnapshot(self, rsnapshot_command):
+        dedupeDict = self._config['rsnapshot']['dedupe']
+        snapshot, previous = self.getSnapshotDirs(rsnapshot_command)
+        start_time = time.time()
+        try:
+            dedupe = dedupeCore(dedupeDict.get('cache'), dedupeDict.get('workers', 4),
+                                dedupeDict.get('min_size', 65536))
+            try:
+                result = dedupe.run(snapshot, previous, self._config['rsnapshot'].get('du_workers', 8))
+            finally:
+                dedupe.close()
+        except (OSError, sqlite3.Error, BrokenProcessPool) as ex:
+            # a hash worker killed by a signal, e.g. SIGBUS on the mmap of a file truncated underneath it
+            self._logger.error(f'unable to dedupe {snapshot}: {ex}')
+            return
+
+        for key in ['linked', 'reclaimed', 'hashed']:
+            self._metrics.values[f'dedupe_{key}'] = result[key]
+
+        ht = self.getHumanityTime(time.time() - start_time)
+        self._logger.info(f'dedupe linked {result["linked"]} files and reclaimed '
+                          f'{getHumanityDiskUsage(result["reclaimed"])} in {ht} '
+                          f'({result["hashed"]} of {result["candidates"]} candidates hashed)')
+        if result['errors']:
+            self._logger.warning(f'dedupe failed to link {result["errors"]} files')
+
+    def verifySnapshot(self, rsnapshot_command):
+        verifyDict = self._config['rsnapshot']['verify']
+        try:
+            rsnapshot_config = readRsnapshotConfig(self._config['rsnapshot']['script'])
+        except (OSError, ValueError, IndexError) as ex:
+            self._logger.error(f'unable to read rsnapshot config for verify: {ex}')
+            return False
+
+        snapshot, _ = self.getSnapshotDirs(rsnapshot_command)
+        try:
+            pairs = [(point['source'], getSnapshotPath(rsnapshot_config, point, snapshot),
+                      getFilter(rsnapshot_config, point))
+                     for point in rsnapshot_config['backup'] if point['source'].startswith('/')]
+        except OSError as ex:
+            self._logger.error(f'unable to read the include and exclude rules for verify: {ex}')
+            return False
+        sample = 1.0 if verifyDict['mode'] == 'full' else verifyDict.get('sample', 0.01)
+        verify = verifyCore(verifyDict.get('workers', 4), sample, verifyDict.get('block_size', 4 * 1024 * 1024),
+                            verifyDict.get('max_rate', 0))
+        result = verify.run(pairs, self._config['rsnapshot'].get('du_workers', 8))
+
+        for key in ['files', 'bytes', 'mismatches', 'missing', 'unsynced', 'throughput']:
+            self._metrics.values[f'verify_{key}'] = result[key]
+
+        ht = self.getHumanityTime(result['elapsed'])
+        self._logger.info(f'verified {result["files"]} files ({getHumanityDiskUsage(result["bytes"])}) in {ht} '
+                          f'({getHumanityDiskUsage(result["throughput"])}/s): {result["mismatches"]} mismatches, '
+                          f'{result["missing"]} missing, {result["unsynced"]} not in the snapshot, '
+                          f'{result["errors"]} errors')
+        for relative, outcome in result['reported']:
+            self._logger.warning(f'verify: {relative} {outcome}')
+
+        return result['mismatches'] == 0 and result['unsynced'] == 0 and result['errors'] == 0
+
+    def updateCatalog(self, rsnapshot_command):
+        catalog_file = self._config['rsnapshot'].get('catalog')
+        if not catalog_file:
+            return
+
+        root_folder = self._config['rsnapshot']['root_folder']
+        start_time = time.time()
+        try:
+            catalog = catalogCore(catalog_file)
+            try:
+                carried, added = catalog.addSnapshot(rsnapshot_command,
+                                                     os.path.join(root_folder, f'{rsnapshot_command}.0'),
+                                                     self._config['rsnapshot'].get('du_workers', 8))
+                retain = len([name for name in os.listdir(root_folder)
+                              if name.startswith(f'{rsnapshot_command}.') and name.split('.')[-1].isdigit()])
+                catalog.prune(rsnapshot_command, retain)
+            finally:
+                catalog.close()
+        except (OSError, sqlite3.Error) as ex:
+            self._logger.error(f'unable to update catalog {catalog_file}: {ex}')
+            return
+
+        ht = self.getHumanityTime(time.time() - start_time)
+        self._logger.info(f'catalog updated in {ht}: {added} new or changed files, {carried} unchanged')
+
+    def getThrottle(self):
+        throttleDict = self._config['rsnapshot'].get('throttle', {})
+        if not throttleDict.get('enabled'):
+            return None
+
+        name, policy = selectPolicy(throttleDict)
+        device = throttleDict.get('device')
+        if not device and throttleDict.get('cgroup'):
+            try:
+                device = getBlockDevice(self._config['rsnapshot']['root_folder'])
+            except OSError as ex:
+                self._logger.error(f'unable to find the block device of the snapshot root: {ex}')
+
+        self._logger.info(f'snapshot runs with throttle policy {name}')
+        return throttleCore(name, policy, throttleDict.get('cgroup'), device, throttleDict.get('psi_target', 10.0),
+                            throttleDict.get('interval', 5), throttleDict.get('min_scale', 0.1), self._logger,
+                            self._name or self._config['server'].get('host'))
+
+    def recordThrottle(self, throttle, summary, stats, time_elapsed):
+        throughput = (stats['literal_bytes'] + stats['matched_bytes']) / time_elapsed if time_elapsed > 0 else 0
+        self._metrics.values['throttle_throughput'] = throughput
+        self._metrics.values['throttle_scale'] = summary['scale_mean']
+        if summary['psi_mean'] is not None:
+            self._metrics.values['throttle_psi'] = summary['psi_mean']
+
+        psi = f'{summary["psi_mean"]:.1f}%' if summary['psi_mean'] is not None else 'unknown'
+        self._logger.info(f'throttle policy {throttle.name}: {getHumanityDiskUsage(throughput)}/s, io pressure {psi}, '
+                          f'limits at {summary["scale_mean"] * 100:.0f}% after {summary["adjustments"]} adjustments')
+
+        stats_file = self._config['rsnapshot']['throttle'].get('stats')
+        if not stats_file:
+            return
+
+        try:
+            recordThroughput(stats_file, dict(summary, time=time.time(), throughput=throughput, elapsed=time_elapsed))
+            policies = getPolicyThroughput(stats_file)
+        except OSError as ex:
+            self._logger.error(f'unable to record throttle statistics: {ex}')
+            return
+
+        self._logger.info('throughput by policy: ' + ', '.join(
+            f'{name} {getHumanityDiskUsage(mean)}/s over {runs} runs' for name, (runs, mean) in sorted(policies.items())))
+
+    def runSnapshot(self, rsnapshot_script, rsnapshot_command):
+        throttle = self.getThrottle()
+        if throttle is None:
+            return self._runSnapshot(rsnapshot_script, rsnapshot_command, None)
+
+        start_time = time.time()
+        throttle.start()
+        try:
+            err, stats, stderr = self._runSnapshot(rsnapshot_script, rsnapshot_command, throttle)
+        finally:
+            summary = throttle.stop()
+
+        if err == 0:
+            self.recordThrottle(throttle, summary, stats, time.time() - start_time)
+        return err, stats, stderr
+
+    def _runSnapshot(self, rsnapshot_script, rsnapshot_command, throttle):
+        workers = self._config['rsnapshot'].get('workers', 1)
+        changeDict = self._config['rsnapshot'].get('change_detection', {})
+        # change detection needs the per backup point control of the sharded sync
+        if workers > 1 or changeDict.get('enabled'):
+            root_folder = self._config['rsnapshot']['root_folder']
+            state_file = os.path.join(root_folder, '.shards.json')
+            changes = None
+            if changeDict.get('enabled'):
+                changes = changeCore(changeDict.get('state') or os.path.join(root_folder, '.changes.json'),
+                                     changeDict.get('workers', 16))
+            try:
+                shards = shardCore(rsnapshot_script, workers, self._config['rsnapshot'].get('shard_state', state_file),
+                                   changes, throttle)
+            except (OSError, ValueError, IndexError) as ex:
+                self._logger.error(f'unable to read {rsnapshot_script}: {ex}')
+                shards = None
+
+            if shards is not None and shards.canShard(rsnapshot_command):
+                self._logger.info(f'running {rsnapshot_command} with {workers} parallel rsync workers')
+                return self.shardSnapshot(shards, rsnapshot_command)
+
+            self._logger.debug(f'{rsnapshot_command} can\'t be sharded, running rsnapshot')
+
+        rsnapshot_binary = self._config['rsnapshot'].get('binary', '/usr/bin/rsnapshot')
+        return self.streamSnapshot([rsnapshot_binary, '-c', rsnapshot_script, rsnapshot_command], throttle)
+
+    def logProgress(self, stats):
+        counters = stats.snapshot()
+        self._logger.info(f'rsnapshot running for {self.getHumanityTime(counters["elapsed"])}: '
+                          f'{counters["files_itemized"]} files, '
+                          f'{getHumanityDiskUsage(counters["bytes_itemized"])} itemized, '
+                          f'{getHumanityDiskUsage(counters["literal_bytes"])} literal '
+                          f'({getHumanityDiskUsage(counters["throughput"])}/s)')
+
+    def shardSnapshot(self, shards, rsnapshot_command):
+        progress_interval = self._config['rsnapshot'].get('progress_interval', 60)
+        stats = rsyncStats()
+        stderr = deque(maxlen=20)
+        try:
+            err = shards.run(rsnapshot_command, stats, stderr, lambda: self.logProgress(stats), progress_interval)
+        except OSError as ex:
+            stderr.append(str(ex))
+            err = -1
+
+        summary = shards.changeSummary
+        if summary is not None:
+            for key in ['skipped', 'narrowed', 'walk', 'saved']:
+                self._metrics.values[f'change_{key}'] = summary[key]
+            self._logger.info(f'change detection: {summary["skipped"]} of {summary["points"]} backup points '
+                              f'unchanged, {summary["narrowed"]} narrowed to changed subtrees, fingerprint walk '
+                              f'took {summary["walk"]:.2f} seconds, saved about {summary["saved"]:.2f} seconds of rsync')
+
+        return err, stats.snapshot(), list(stderr)
+
+    def streamSnapshot(self, command, throttle=None):
+        progress_interval = self._config['rsnapshot'].get('progress_interval', 60)
+        stats = rsyncStats()
+        stderr = deque(maxlen=20)
+
+        if throttle is not None:
+            command = throttle.wrap(command)
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                                   errors='replace', bufsize=1)
+
+        def readStdout():
+            for line in process.stdout:
+                stats.feed(line)
+
+        def readStderr():
+            for line in process.stderr:
+                stderr.append(line.rstrip('\n'))
+
+        readers = [threading.Thread(target=readStdout, daemon=True), threading.Thread(target=readStderr, daemon=True)]
+        for reader in readers:
+            reader.start()
+
+        while True:
+            try:
+                err = process.wait(timeout=progress_interval)
+                break
+            except subprocess.TimeoutExpired:
+                self.logProgress(stats)
+
+        for reader in readers:
+            reader.join()
+
+        return err, stats.snapshot(), list(stderr)
+
+    def close(self):
+        self._ipmi.close()
 
     def shuttingDown(self, status):
         self._logger.info('Shutting down backup core...')
-        logging.shutdown()
+        self.close()
+        shutdownLogging()
         sys.exit(status)
 
     def run(self):
+        self.shuttingDown(self.process())
+
+    def process(self, commands=None, slot=None):
+        self._metrics = phaseTimer()
+        self._ipmi.latencies.clear()
+        runId.set(self._metrics.runId)
+        target.set(self._name or self._config['server']['host'])
+        status = 1
+        try:
+            status = self.processPhases(commands, slot)
+        finally:
+            self.writeMetrics(status)
+
+        return status
+
+    def writeMetrics(self, status):
+        metricsDict = self._config.get('metrics', {})
+        for operation, latency in self._ipmi.latencies.items():
+            self._metrics.values[f'power_{operation}_latency'] = latency
+        if self._ipmi.latencies:
+            self._logger.debug('power driver latency: ' + ', '.join(
+                f'{operation} {latency * 1000:.1f} ms' for operation, latency in self._ipmi.latencies.items()))
+
+        record = self._metrics.getRecord(self._name or self._config['server']['host'], status)
+        self.lastRun = record
+        try:
+            if metricsDict.get('prometheus'):
+                filename = metricsDict['prometheus']
+                if self._name is not None:
+                    root, ext = os.path.splitext(filename)
+                    filename = f'{root}_{self._name}{ext}'
+                writePrometheus(filename, record)
+
+            if metricsDict.get('json'):
+                appendJson(metricsDict['json'], record)
+
+            history_file = self._config.get('history', {}).get('file')
+            if history_file:
+                if self._name is not None:
+                    root, ext = os.path.splitext(history_file)
+                    history_file = f'{root}_{self._name}{ext}'
+                runHistory(history_file).append(getHistoryRecord(record, self._config['rsnapshot'].get('root_folder')))
+        except OSError as ex:
+            self._logger.error(f'unable to write metrics: {ex}')
+
+    def journal(self, event, **fields):
+        try:
+            self._journal.record(event, **fields)
+        except OSError as ex:
+            self._logger.error(f'unable to write run journal: {ex}')
+
+    def resumeRun(self, commands=None, slot=None):
+        commands, _ = self.getSnapshotCommands(commands)
+        try:
+            previous = self._journal.getInFlight()
+        except (OSError, KeyError) as ex:
+            self._logger.error(f'unable to read run journal: {ex}')
+            previous = None
+
+        self._resumed = set()
+        if previous is not None:
+            age = time.time() - previous['started']
+            self._logger.info(f'run {previous["run_id"]} was interrupted after {previous["last"]} '
+                              f'{self.getHumanityTime(age)} ago, resuming')
+            # a rotation must never run twice, but neither may the next scheduled run be mistaken for a retry:
+            # without a slot both look alike, so the snapshots are only skipped when the slot matches
+            if slot is None or previous['slot'] != slot:
+                self._logger.info(f'run {previous["run_id"]} was for slot {previous["slot"]}, this run is for slot '
+                                  f'{slot}, running all snapshots again')
+            elif previous['commands'] == commands and age <= self._config['server'].get('resume_max_age', 21600):
+                self._resumed = set(previous['snapshots'])
+            self._metrics.values['resumed'] = 1
+
+        try:
+            self._journal.start(self._metrics.runId, commands, previous['run_id'] if previous else None, slot)
+            for rsnapshot_command in commands:
+                if rsnapshot_command in self._resumed:
+                    self._journal.record('snapshot', command=rsnapshot_command)
+        except OSError as ex:
+            self._logger.error(f'unable to write run journal: {ex}')
+
+        return previous
+
+    def processPhases(self, commands=None, slot=None):
         server_ip = self._config['server']['host']
         self._logger.info('starting backup core...')
+        ready_by = self._config['server'].get('ready_by')
+        if ready_by:
+            ready_by = getReadyBy(ready_by)
+        slot = slot or self._config['server'].get('slot') or (ready_by.isoformat() if ready_by else None)
+        previous = self.resumeRun(commands, slot)
+        if ready_by and previous is None:
+            power_on_at = ready_by - datetime.timedelta(seconds=self.getBootEstimate())
+            with self._metrics.phase('power_on_wait'):
+                self.waitUntil(power_on_at, f'to power on {server_ip} in time for {ready_by:%H:%M}')
+
+        server_mountpoint = self._config['server']['mountpoint']
+        client_mountpoint = self._config['client']['mountpoint']
+        serverPath = f'{server_ip}:{server_mountpoint}'
+
         self._logger.debug(f'ping {server_ip}')
-        if not canPing(server_ip):
+        with self._metrics.phase('initial_ping'):
+            server_up = canPing(server_ip)
+        if not server_up:
+            if os.path.ismount(client_mountpoint):
+                self._logger.warning(f'{client_mountpoint} is a stale mount of {serverPath}, unmounting')
+                if umount(client_mountpoint):
+                    self.journal('umounted')
+
             self._logger.info(f'server {server_ip} is down, try tp start it.')
-            if not self.startIPMIServer():
+            if not self.startIPMIServer(previous):
                 self._logger.critical(f'Unable to start server {server_ip}')
-                self.shuttingDown(1)
+                return 1
 
         self._logger.info(f'server {server_ip} is up.')
-
-        server_mountpoint = self._config['server']['mountpoint']
-        client_mountpoint = self._config['client']['mountpoint']
-        serverPath = f'{server_ip}:{server_mountpoint}'
+        self.journal('powered_on')
+        if ready_by:
+            with self._metrics.phase('slot_wait'):
+                self.waitUntil(ready_by, 'for the backup slot')
 
         if not os.path.ismount(client_mountpoint):
-            self._logger.debug(f'mounting {serverPath} to {client_mountpoint}')
-            if not mount('nfs', serverPath, client_mountpoint):
+            mount_options = self.getMountOptions(serverPath, client_mountpoint)
+            self._logger.debug(f'mounting {serverPath} to {client_mountpoint} ({mount_options or "default options"})')
+            with self._metrics.phase('mount') as phase:
+                phase.ok = mount('nfs', serverPath, client_mountpoint, mount_options)
+            if not phase.ok:
                 self._logger.critical('unable to mount.')
                 # self._logger.info(f'shutting down server {server_ip}.')
                 # self.stopIPMIServer()
-                self.shuttingDown(1)
+                return 1
         else:
             self._logger.debug(f'already mounted {serverPath} to {client_mountpoint}')
-
-        self.executeSnapshot()
-        self._logger.debug(f'unmounting {server_mountpoint} to {client_mountpoint}')
-        if not umount(client_mountpoint):
-            self._logger.critical('unable to umount.')
-            self.shuttingDown(1)
-
-        self._logger.info(f'shutting down server {server_ip}.')
-        self.stopIPMIServer()
-        self.shuttingDown(1)
+        self.journal('mounted')
+
+        status = 0 if self.executeSnapshots(commands) else 1
+
+        # statistics and catalog only read the local snapshot root, so they overlap with umount and power off
+        reporter = threading.Thread(target=contextvars.copy_context().run, args=(self.reportSnapshots,))
+        reporter.start()
+        try:
+            self._logger.debug(f'unmounting {server_mountpoint} to {client_mountpoint}')
+            with self._metrics.phase('umount') as phase:
+                phase.ok = umount(client_mountpoint)
+            if not phase.ok:
+                self._logger.critical('unable to umount.')
+                return 1
+            self.journal('umounted')
+
+            self._logger.info(f'shutting down server {server_ip}.')
+            if self.stopIPMIServer():
+                self.journal('powered_off')
+        finally:
+            reporter.join()
+            if self._powerOffWatch is not None:
+                self._powerOffWatch.join()
+                self._powerOffWatch = None
+
+        # expired rotations are only unlinked once the server is off and nothing else of this run needs the disk
+        self.reclaimTrash()
+        self.journal('finished', status=status)
+        return status
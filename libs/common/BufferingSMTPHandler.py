@@ -14,37 +14,111 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
+import gzip
 import logging
+import queue
+import smtplib
+import threading
+from email.message import EmailMessage
 from logging.handlers import BufferingHandler
 
+
 class BufferingSMTPHandler(BufferingHandler):
-    def __init__(self, mailhost, fromaddr, toaddrs, subject, capacity):
+    def __init__(self, mailhost, fromaddr, toaddrs, subject, capacity, digestSize=64 * 1024, queueSize=16):
         logging.handlers.BufferingHandler.__init__(self, capacity)
         self.mailhost = mailhost
         self.mailport = None
         self.fromaddr = fromaddr
         self.toaddrs = toaddrs
         self.subject = subject
+        self.digestSize = digestSize
         self.setFormatter(logging.Formatter('%(asctime)s - %(levelname)-8s - %(message)s'))
 
+        # delivery happens on a worker thread, flush() only hands the formatted lines over
+        self._queue = queue.Queue(queueSize)
+        self._smtp = None
+        self._worker = threading.Thread(target=self._deliver, name='smtp', daemon=True)
+        self._worker.start()
+
     def flush(self):
-        if len(self.buffer) > 0:
+        self.acquire()
+        try:
+            if len(self.buffer) > 0:
+                lines = [self.format(record) for record in self.buffer]
+                self.buffer = []
+                if self._worker.is_alive():
+                    self._queue.put(lines)
+        finally:
+            self.release()
+
+    def close(self):
+        self.flush()
+        if self._worker.is_alive():
+            self._queue.put(None)
+            self._worker.join()
+        BufferingHandler.close(self)
+
+    def _connect(self):
+        if self._smtp is not None:
             try:
-                import smtplib
-                port = self.mailport
-                if not port:
-                    port = smtplib.SMTP_PORT
-                smtp = smtplib.SMTP(self.mailhost, port)
-                msg = '''From: {}\r\nTo: {}\r\nSubject: {}\r\n\r\n'''.format(
-                            self.fromaddr,
-                            ",".join(self.toaddrs),
-                            self.subject
-                            )
-                for record in self.buffer:
-                    s = self.format(record)
-                    msg = msg + s + "\r\n"
-                smtp.sendmail(self.fromaddr, self.toaddrs, msg)
-                smtp.quit()
-            except:
+                if self._smtp.noop()[0] == 250:
+                    return self._smtp
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._disconnect()
+
+        self._smtp = smtplib.SMTP(self.mailhost, self.mailport or smtplib.SMTP_PORT)
+        return self._smtp
+
+    def _disconnect(self):
+        if self._smtp is None:
+            return
+
+        try:
+            self._smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        self._smtp = None
+
+    def getMessage(self, lines):
+        msg = EmailMessage()
+        msg['From'] = self.fromaddr
+        msg['To'] = ','.join(self.toaddrs)
+        msg['Subject'] = self.subject
+
+        body = '\r\n'.join(lines)
+        if len(body) <= self.digestSize:
+            msg.set_content(body)
+            return msg
+
+        digest = body[:self.digestSize].rsplit('\r\n', 1)[0]
+        msg.set_content(f'{digest}\r\n\r\n... {len(lines)} lines in total, the full log is attached.')
+        msg.add_attachment(gzip.compress(body.encode()), maintype='application', subtype='gzip',
+                           filename='ipmi-backup.log.gz')
+        return msg
+
+    def _deliver(self):
+        stopping = False
+        while not stopping:
+            lines = self._queue.get()
+            if lines is None:
+                break
+
+            # batches that piled up while the last mail was sent go out together
+            while True:
+                try:
+                    more = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if more is None:
+                    stopping = True
+                    break
+                lines += more
+
+            try:
+                self._connect().send_message(self.getMessage(lines), self.fromaddr, self.toaddrs)
+            except Exception:
+                self._disconnect()
                 self.handleError(None)  # no particular record
-            self.buffer = []
\ No newline at end of file
+
+        self._disconnect()
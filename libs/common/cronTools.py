@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# Copyright 2023 WebEye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import datetime
+
+
+def _parseField(field, low, high):
+    values = set()
+    for part in field.split(','):
+        step = 1
+        if '/' in part:
+            part, step = part.split('/')
+            step = int(step)
+
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start, end = (int(value) for value in part.split('-'))
+        else:
+            start = int(part)
+            end = high if step != 1 else start
+
+        if start < low or end > high or start > end:
+            raise ValueError(f'{field} out of range {low}-{high}')
+
+        values.update(range(start, end + 1, step))
+
+    return values
+
+
+class cronSchedule:
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f'invalid cron expression "{expression}"')
+
+        self.expression = expression
+        self._minutes = _parseField(fields[0], 0, 59)
+        self._hours = _parseField(fields[1], 0, 23)
+        self._days = _parseField(fields[2], 1, 31)
+        self._months = _parseField(fields[3], 1, 12)
+        self._weekdays = {day % 7 for day in _parseField(fields[4], 0, 7)}
+        self._anyDay = fields[2] == '*'
+        self._anyWeekday = fields[4] == '*'
+
+    def _matchesDay(self, moment):
+        day = moment.day in self._days
+        weekday = moment.isoweekday() % 7 in self._weekdays
+
+        # like cron: with both day fields restricted, either one may match
+        if self._anyDay or self._anyWeekday:
+            return day and weekday
+        return day or weekday
+
+    def next(self, after):
+        moment = after.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        limit = moment + datetime.timedelta(days=366 * 4)
+        while moment < limit:
+            if moment.month not in self._months or not self._matchesDay(moment):
+                moment = (moment + datetime.timedelta(days=1)).replace(hour=0, minute=0)
+            elif moment.hour not in self._hours:
+                moment = (moment + datetime.timedelta(hours=1)).replace(minute=0)
+            elif moment.minute not in self._minutes:
+                moment += datetime.timedelta(minutes=1)
+            else:
+                return moment
+
+        raise ValueError(f'cron expression "{self.expression}" never matches')
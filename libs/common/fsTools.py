@@ -15,12 +15,19 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 import decimal
+import os
+import stat
 import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from decimal import Decimal
 
 
-def mount(filesystem, serverPath, clientPath):
-    command = ['mount', '-t', filesystem, serverPath, clientPath]
+def mount(filesystem, serverPath, clientPath, options=None):
+    command = ['mount', '-t', filesystem]
+    if options:
+        command += ['-o', options if isinstance(options, str) else ','.join(options)]
+    command += [serverPath, clientPath]
     return subprocess.call(command, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT) == 0
 
 
@@ -29,15 +36,135 @@ def umount(clientPath):
     return subprocess.call(command, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT) == 0
 
 
+def _scanDirectory(path, root, previousRoot):
+    subdirs = []
+    files = 0
+    size = 0
+    linked = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                        continue
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+
+                if st.st_nlink == 1:
+                    files += 1
+                    size += st.st_size
+                    continue
+
+                # a hardlinked file is only new if the previous rotation does not hold the same inode
+                shared = False
+                if previousRoot is not None:
+                    try:
+                        pst = os.lstat(os.path.join(previousRoot, os.path.relpath(entry.path, root)))
+                        shared = pst.st_ino == st.st_ino and pst.st_dev == st.st_dev
+                    except OSError:
+                        pass
+                linked.append((st.st_dev, st.st_ino, st.st_size, shared))
+    except OSError:
+        pass
+
+    return subdirs, files, size, linked
+
+
+def getSnapshotUsage(path, previousPath=None, workers=8):
+    if previousPath is not None and not os.path.isdir(previousPath):
+        previousPath = None
+
+    usage = {'apparent': 0, 'unique': 0, 'files': 0, 'dirs': 0}
+    if not os.path.isdir(path):
+        return usage
+
+    seen = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(_scanDirectory, path, path, previousPath)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                subdirs, files, size, linked = future.result()
+                usage['dirs'] += 1
+                usage['files'] += files
+                usage['apparent'] += size
+                usage['unique'] += size
+                for dev, ino, size, shared in linked:
+                    if (dev, ino) in seen:
+                        continue
+                    seen.add((dev, ino))
+                    usage['files'] += 1
+                    usage['apparent'] += size
+                    if not shared:
+                        usage['unique'] += size
+
+                for subdir in subdirs:
+                    pending.add(executor.submit(_scanDirectory, subdir, path, previousPath))
+
+    return usage
+
+
+def _listDirectory(path):
+    subdirs = []
+    files = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    else:
+                        files.append((entry.path, entry.stat(follow_symlinks=False)))
+                except OSError:
+                    continue
+    except OSError:
+        pass
+
+    return subdirs, files
+
+
+def walkFiles(path, workers=8, prune=None):
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(_listDirectory, path)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                subdirs, files = future.result()
+                for subdir in subdirs:
+                    if prune is None or not prune(subdir):
+                        pending.add(executor.submit(_listDirectory, subdir))
+                yield from files
+
+
+def readBenchmark(path, sampleBytes, maxTime=30, blockSize=1024 * 1024):
+    total = 0
+    start_time = time.monotonic()
+    deadline = start_time + maxTime
+    for filename, st in walkFiles(path):
+        if not stat.S_ISREG(st.st_mode) or st.st_size == 0:
+            continue
+
+        try:
+            with open(filename, 'rb', buffering=0) as f:
+                while total < sampleBytes:
+                    data = f.read(blockSize)
+                    if not data:
+                        break
+                    total += len(data)
+        except OSError:
+            continue
+
+        if total >= sampleBytes or time.monotonic() > deadline:
+            break
+
+    elapsed = time.monotonic() - start_time
+    return total, total / elapsed if elapsed > 0 else 0
+
+
 def getDiskUsage(path):
-    command = ['du', '-sb', path]
-    process = subprocess.run(command, capture_output=True, text=True)
-    err = process.returncode
-    if err == 0:
-        du = process.stdout.split(chr(9))
-        return int(du[0])
-
-    return 0
+    return getSnapshotUsage(path)['apparent']
 
 
 def getHumanityDiskUsage(disk_usage):
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+# Copyright 2023 WebEye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import contextvars
+import copy
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+
+from libs.common.BufferingSMTPHandler import BufferingSMTPHandler
+
+runId = contextvars.ContextVar('runId', default=None)
+target = contextvars.ContextVar('target', default=None)
+phase = contextvars.ContextVar('phase', default=None)
+
+_listener = None
+
+
+class contextFilter(logging.Filter):
+
+    def filter(self, record):
+        record.run_id = runId.get()
+        record.target = target.get()
+        record.phase = phase.get()
+        return True
+
+
+class jsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created).astimezone().isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'message': record.getMessage(),
+            'run_id': getattr(record, 'run_id', None),
+            'target': getattr(record, 'target', None),
+            'phase': getattr(record, 'phase', None),
+            'thread': record.threadName
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+
+        return json.dumps(entry)
+
+
+class _queueHandler(logging.handlers.QueueHandler):
+
+    def prepare(self, record):
+        # the stock prepare folds the traceback into the message and drops exc_info, the formatters on
+        # the listener thread still want it apart, exc_text survives the queue
+        record = copy.copy(record)
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        record.exc_info = None
+        return record
+
+
+def _getFileHandler(logDict):
+    filename = logDict['filename']
+    if logDict.get('when'):
+        return logging.handlers.TimedRotatingFileHandler(filename, when=logDict['when'],
+                                                         backupCount=logDict.get('backup_count', 7))
+    if logDict.get('max_bytes'):
+        return logging.handlers.RotatingFileHandler(filename, maxBytes=logDict['max_bytes'],
+                                                    backupCount=logDict.get('backup_count', 7))
+    return logging.FileHandler(filename)
+
+
+def setupLogging(config):
+    global _listener
+
+    logger = logging.getLogger()
+    _log_handler = _getFileHandler(config['log'])
+    _str_log_level = config['log']['level']
+    _log_level = getattr(logging, _str_log_level)
+    logger.setLevel(_log_level)
+    _log_handler.setLevel(_log_level)
+
+    if config['log'].get('format') == 'json':
+        _log_format = jsonFormatter()
+    else:
+        _log_format = logging.Formatter('%(asctime)s - %(levelname)-8s - %(message)s')
+    _log_handler.setFormatter(_log_format)
+
+    _mail_handler = BufferingSMTPHandler('localhost', config['mail']['fromaddr'],
+                                         [config['mail']['toaddr']], 'ipmi backup', 500)
+    _mail_handler.setLevel(logging.DEBUG)
+
+    # handlers run on the listener thread, logging calls only pay for a queue put
+    _queue_handler = _queueHandler(queue.SimpleQueue())
+    _queue_handler.addFilter(contextFilter())
+    logger.addHandler(_queue_handler)
+
+    _listener = logging.handlers.QueueListener(_queue_handler.queue, _log_handler, _mail_handler,
+                                               respect_handler_level=True)
+    _listener.start()
+
+    return logger
+
+
+def flushLogging():
+    if _listener is None:
+        return
+
+    # stopping the listener drains the queue, the handlers can then be flushed safely
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.flush()
+    _listener.start()
+
+
+def shutdownLogging():
+    global _listener
+
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+    logging.shutdown()
+
+
+class prefixLoggerAdapter(logging.LoggerAdapter):
+
+    def process(self, msg, kwargs):
+        return f'[{self.extra["prefix"]}] {msg}', kwargs
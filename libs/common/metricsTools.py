@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# Copyright 2023 WebEye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import json
+import os
+import time
+import uuid
+from contextlib import contextmanager
+
+from libs.common import logTools
+
+
+class _phase:
+
+    def __init__(self):
+        self.ok = True
+
+
+class phaseTimer:
+
+    def __init__(self):
+        self.started = time.time()
+        self.runId = uuid.uuid4().hex[:12]
+        self._start = time.monotonic()
+        self.phases = {}
+        self.values = {}
+        self.failed = None
+
+    @contextmanager
+    def phase(self, name):
+        phase = _phase()
+        token = logTools.phase.set(name)
+        start = time.monotonic()
+        try:
+            yield phase
+        except BaseException:
+            phase.ok = False
+            raise
+        finally:
+            self.add(name, time.monotonic() - start, phase.ok)
+            logTools.phase.reset(token)
+
+    def add(self, name, duration, ok=True):
+        self.phases[name] = {'duration': duration, 'outcome': 'ok' if ok else 'failed'}
+        if not ok and self.failed is None:
+            self.failed = name
+
+    def elapsed(self):
+        return time.monotonic() - self._start
+
+    def getRecord(self, target, status):
+        return {
+            'run_id': self.runId,
+            'target': target,
+            'started': self.started,
+            'duration': self.elapsed(),
+            'status': status,
+            'failed_phase': self.failed,
+            'phases': self.phases,
+            'values': self.values
+        }
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    return ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+
+
+def writePrometheus(filename, record):
+    target = record['target']
+    lines = [
+        '# HELP ipmi_backup_phase_duration_seconds Duration of a backup phase.',
+        '# TYPE ipmi_backup_phase_duration_seconds gauge'
+    ]
+    for name, phase in record['phases'].items():
+        lines.append(f'ipmi_backup_phase_duration_seconds{{{_labels(target=target, phase=name)}}} '
+                     f'{phase["duration"]:.6f}')
+
+    lines += [
+        '# HELP ipmi_backup_phase_success Whether a backup phase succeeded.',
+        '# TYPE ipmi_backup_phase_success gauge'
+    ]
+    for name, phase in record['phases'].items():
+        lines.append(f'ipmi_backup_phase_success{{{_labels(target=target, phase=name)}}} '
+                     f'{1 if phase["outcome"] == "ok" else 0}')
+
+    lines += [
+        '# HELP ipmi_backup_value Values collected during the last run.',
+        '# TYPE ipmi_backup_value gauge'
+    ]
+    for name, value in record['values'].items():
+        lines.append(f'ipmi_backup_value{{{_labels(target=target, name=name)}}} {value}')
+
+    lines += [
+        '# HELP ipmi_backup_last_run_status Exit status of the last run (0 = success).',
+        '# TYPE ipmi_backup_last_run_status gauge',
+        f'ipmi_backup_last_run_status{{{_labels(target=target)}}} {record["status"]}',
+        '# HELP ipmi_backup_last_run_duration_seconds Wall time of the last run.',
+        '# TYPE ipmi_backup_last_run_duration_seconds gauge',
+        f'ipmi_backup_last_run_duration_seconds{{{_labels(target=target)}}} {record["duration"]:.6f}',
+        '# HELP ipmi_backup_last_run_timestamp_seconds Start time of the last run.',
+        '# TYPE ipmi_backup_last_run_timestamp_seconds gauge',
+        f'ipmi_backup_last_run_timestamp_seconds{{{_labels(target=target)}}} {record["started"]:.3f}'
+    ]
+
+    # the textfile collector may read at any time, so never expose a half written file
+    tmp = f'{filename}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmp, filename)
+
+
+def appendJson(filename, record):
+    with open(filename, 'a') as f:
+        f.write(json.dumps(record, sort_keys=True) + '\n')
@@ -14,11 +14,114 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
+import asyncio
+import os
+import shutil
+import struct
 import sys
 import subprocess
+import time
+
+RPCBIND_PORT = 111
+NFS_PORT = 2049
+NFS_PROGRAM = 100003
+NFS_VERSION = 3
+
+# NFSv4 only servers often run without rpcbind, port 2049 answers for v3 and v4, 'rpcbind' is opt-in
+DEFAULT_PROBE_STAGES = ['icmp', 'nfs']
 
 
 def canPing(host):
     param = '-n' if sys.platform == "win32" else '-c'
     command = ['ping', param, '1', host]
     return subprocess.call(command, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT) == 0
+
+
+async def probeIcmp(host, timeout=1.0):
+    param = '-n' if sys.platform == "win32" else '-c'
+    process = await asyncio.create_subprocess_exec('ping', param, '1', host,
+                                                   stdout=asyncio.subprocess.DEVNULL,
+                                                   stderr=asyncio.subprocess.DEVNULL)
+    try:
+        return await asyncio.wait_for(process.wait(), timeout) == 0
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        return False
+
+
+async def probeTcp(host, port, timeout=1.0):
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return True
+
+
+async def probeNfsNull(host, timeout=1.0, program=NFS_PROGRAM, version=NFS_VERSION, port=NFS_PORT):
+    xid = struct.unpack('>I', os.urandom(4))[0]
+    call = struct.pack('>10I', xid, 0, 2, program, version, 0, 0, 0, 0, 0)
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+
+    try:
+        writer.write(struct.pack('>I', 0x80000000 | len(call)) + call)
+        await writer.drain()
+        marker = struct.unpack('>I', await asyncio.wait_for(reader.readexactly(4), timeout))[0]
+        reply = await asyncio.wait_for(reader.readexactly(marker & 0x7FFFFFFF), timeout)
+        rxid, msgType, replyStat, _, verfLength = struct.unpack_from('>5I', reply)
+        acceptStat = struct.unpack_from('>I', reply, 20 + verfLength)[0]
+        return rxid == xid and msgType == 1 and replyStat == 0 and acceptStat == 0
+    except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, struct.error):
+        return False
+    finally:
+        writer.close()
+
+
+def getProbe(stage, host):
+    if stage == 'icmp':
+        return lambda timeout: probeIcmp(host, timeout)
+    elif stage == 'rpcbind':
+        return lambda timeout: probeTcp(host, RPCBIND_PORT, timeout)
+    elif stage == 'nfs':
+        return lambda timeout: probeTcp(host, NFS_PORT, timeout)
+    elif stage == 'nfs_null':
+        return lambda timeout: probeNfsNull(host, timeout)
+
+    raise ValueError(f'unknown probe stage {stage}')
+
+
+async def waitForReadyAsync(host, timeout, stages=None, initialDelay=0.1, maxDelay=2.0):
+    stages = stages or DEFAULT_PROBE_STAGES
+    if 'icmp' in stages and shutil.which('ping') is None:
+        stages = [stage for stage in stages if stage != 'icmp']
+
+    start_time = time.monotonic()
+    deadline = start_time + timeout
+    timings = {}
+    for stage in stages:
+        probe = getProbe(stage, host)
+        delay = initialDelay
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False, timings
+            if await probe(min(1.0, remaining)):
+                timings[stage] = time.monotonic() - start_time
+                break
+            await asyncio.sleep(min(delay, max(0.0, deadline - time.monotonic())))
+            delay = min(delay * 2, maxDelay)
+
+    return True, timings
+
+
+def waitForReady(host, timeout, stages=None):
+    return asyncio.run(waitForReadyAsync(host, timeout, stages))
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# Copyright 2023 WebEye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import re
+import threading
+import time
+
+ITEMIZE_PATTERN = re.compile(r'^([<>ch.*][fdLDS][.+?cstpoguax]{9,10}|\*deleting)\s+(.*)$')
+STATS_PATTERN = re.compile(r'^(Number of regular files transferred|Number of files transferred|Literal data|'
+                           r'Matched data|Total transferred file size|Total bytes sent|Total bytes received)'
+                           r': ([\d,.]+)')
+
+STATS_KEYS = {
+    'Number of regular files transferred': 'files_transferred',
+    'Number of files transferred': 'files_transferred',
+    'Literal data': 'literal_bytes',
+    'Matched data': 'matched_bytes',
+    'Total transferred file size': 'transferred_bytes',
+    'Total bytes sent': 'bytes_sent',
+    'Total bytes received': 'bytes_received'
+}
+
+
+def _parseNumber(value):
+    return int(value.replace(',', '').replace('.', ''))
+
+
+class rsyncStats:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._start_time = time.monotonic()
+        self.counters = {
+            'items': 0,
+            'files_itemized': 0,
+            'bytes_itemized': 0,
+            'deleted': 0,
+            'files_transferred': 0,
+            'literal_bytes': 0,
+            'matched_bytes': 0,
+            'transferred_bytes': 0,
+            'bytes_sent': 0,
+            'bytes_received': 0
+        }
+
+    def feed(self, line):
+        line = line.rstrip('\n')
+        match = ITEMIZE_PATTERN.match(line)
+        if match is not None:
+            code, rest = match.groups()
+            with self._lock:
+                self.counters['items'] += 1
+                if code == '*deleting':
+                    self.counters['deleted'] += 1
+                elif code[0] in '<>' and code[1] == 'f':
+                    self.counters['files_itemized'] += 1
+                    # --out-format='%i %l %n' puts the file size in front of the name
+                    size, _, _ = rest.partition(' ')
+                    if size.isdigit():
+                        self.counters['bytes_itemized'] += int(size)
+            return
+
+        match = STATS_PATTERN.match(line)
+        if match is not None:
+            key, value = match.groups()
+            with self._lock:
+                # rsnapshot runs one rsync per backup point, each prints its own --stats block
+                self.counters[STATS_KEYS[key]] += _parseNumber(value)
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self.counters)
+
+        elapsed = time.monotonic() - self._start_time
+        counters['elapsed'] = elapsed
+        counters['throughput'] = max(counters['literal_bytes'], counters['bytes_itemized']) / elapsed \
+            if elapsed > 0 else 0
+        return counters
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# Copyright 2023 WebEye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import datetime
+import json
+import math
+import os
+
+
+class bootHistory:
+
+    def __init__(self, filename, size=100):
+        self._filename = filename or None
+        self._size = size
+        self.samples = []
+
+        if self._filename is not None and os.path.isfile(self._filename):
+            try:
+                with open(self._filename) as f:
+                    self.samples = [float(sample) for sample in json.load(f).get('boots', [])]
+            except (OSError, ValueError, AttributeError):
+                self.samples = []
+
+    def add(self, duration):
+        self.samples = (self.samples + [duration])[-self._size:]
+        if self._filename is None:
+            return
+
+        tmp = f'{self._filename}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'boots': self.samples}, f)
+        os.replace(tmp, self._filename)
+
+    def percentile(self, p):
+        if not self.samples:
+            return None
+
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, max(0, math.ceil(p / 100 * len(samples)) - 1))]
+
+    def getTimeout(self, default, margin, minSamples=5):
+        if len(self.samples) < minSamples:
+            return default
+
+        # the history may only extend the configured timeout, a run of fast boots must not cut off a slow one
+        return max(default, self.percentile(99) + margin)
+
+    def getEstimate(self, default, margin, minSamples=5):
+        if len(self.samples) < minSamples:
+            return default
+
+        return self.percentile(99) + margin
+
+
+def getReadyBy(value, now=None):
+    now = now or datetime.datetime.now()
+    hh, mm = (int(part) for part in value.split(':'))
+    readyBy = now.replace(hour=hh, minute=mm, second=0, microsecond=0)
+
+    # a slot more than half a day ago is meant for tomorrow
+    if (now - readyBy).total_seconds() > 12 * 3600:
+        readyBy += datetime.timedelta(days=1)
+
+    return readyBy
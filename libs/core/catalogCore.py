@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+# Copyright 2023 WebEye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import os
+import sqlite3
+import time
+
+from libs.common.fsTools import walkFiles
+
+# one row per file version: a file that stays the same inode across rotations
+# only has its "last" snapshot id moved forward
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY,
+    interval TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS paths (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS entries (
+    interval TEXT NOT NULL,
+    path INTEGER NOT NULL,
+    first INTEGER NOT NULL,
+    last INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    PRIMARY KEY (interval, path, first)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS entries_last ON entries (interval, last, path);
+'''
+
+
+class catalogCore:
+
+    def __init__(self, filename):
+        self._db = sqlite3.connect(filename)
+        self._db.executescript(SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def _snapshots(self, interval):
+        rows = self._db.execute('SELECT id FROM snapshots WHERE interval = ? ORDER BY id DESC', (interval,))
+        return [row[0] for row in rows]
+
+    def resolve(self, rotation):
+        interval, _, index = rotation.rpartition('.')
+        if not interval or not index.isdigit():
+            return None, None
+
+        snapshots = self._snapshots(interval)
+        if int(index) >= len(snapshots):
+            return interval, None
+
+        return interval, snapshots[int(index)]
+
+    def addSnapshot(self, interval, path, workers=8):
+        snapshots = self._snapshots(interval)
+        previous = snapshots[0] if snapshots else None
+
+        with self._db:
+            cursor = self._db.execute('INSERT INTO snapshots (interval, created) VALUES (?, ?)',
+                                      (interval, time.time()))
+            snapshot = cursor.lastrowid
+
+            self._db.execute('CREATE TEMP TABLE IF NOT EXISTS scan '
+                             '(path TEXT PRIMARY KEY, inode INTEGER, size INTEGER, mtime INTEGER)')
+            self._db.execute('DELETE FROM scan')
+            self._db.executemany('INSERT OR REPLACE INTO scan VALUES (?, ?, ?, ?)',
+                                 ((os.path.relpath(filename, path), st.st_ino, st.st_size, int(st.st_mtime))
+                                  for filename, st in walkFiles(path, workers)))
+            self._db.execute('INSERT OR IGNORE INTO paths (path) SELECT path FROM scan')
+
+            carried = 0
+            if previous is not None:
+                carried = self._db.execute('''
+                    UPDATE entries SET last = :snapshot
+                    WHERE interval = :interval AND last = :previous AND EXISTS (
+                        SELECT 1 FROM scan JOIN paths ON paths.path = scan.path
+                        WHERE paths.id = entries.path AND scan.inode = entries.inode)
+                    ''', {'snapshot': snapshot, 'interval': interval, 'previous': previous}).rowcount
+
+            added = self._db.execute('''
+                INSERT INTO entries (interval, path, first, last, inode, size, mtime)
+                SELECT :interval, paths.id, :snapshot, :snapshot, scan.inode, scan.size, scan.mtime
+                FROM scan JOIN paths ON paths.path = scan.path
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM entries e WHERE e.interval = :interval AND e.path = paths.id AND e.last = :snapshot)
+                ''', {'snapshot': snapshot, 'interval': interval}).rowcount
+
+            self._db.execute('DELETE FROM scan')
+
+        return carried, added
+
+    def prune(self, interval, retain):
+        snapshots = self._snapshots(interval)
+        if len(snapshots) <= retain:
+            return
+
+        oldest = snapshots[retain - 1] if retain > 0 else snapshots[0] + 1
+        with self._db:
+            self._db.execute('DELETE FROM entries WHERE interval = ? AND last < ?', (interval, oldest))
+            self._db.execute('DELETE FROM snapshots WHERE interval = ? AND id < ?', (interval, oldest))
+
+    @staticmethod
+    def _rotationNames(interval, snapshots, first, last):
+        return [f'{interval}.{index}' for index, snapshot in enumerate(snapshots) if first <= snapshot <= last]
+
+    def lookup(self, pattern):
+        # the snapshot list of every interval is read once, not once per matching entry
+        snapshots = {}
+        for interval, snapshot in self._db.execute('SELECT interval, id FROM snapshots ORDER BY id DESC'):
+            snapshots.setdefault(interval, []).append(snapshot)
+
+        rows = self._db.execute('''
+            SELECT paths.path, entries.interval, entries.first, entries.last, entries.size, entries.mtime
+            FROM paths JOIN entries ON entries.path = paths.id
+            WHERE paths.path GLOB ? ORDER BY paths.path, entries.interval, entries.first DESC
+            ''', (pattern,))
+        result = []
+        for path, interval, first, last, size, mtime in rows:
+            rotations = self._rotationNames(interval, snapshots.get(interval, []), first, last)
+            if rotations:
+                result.append((path, size, mtime, rotations))
+
+        return result
+
+    def _except(self, a, b):
+        rows = self._db.execute('''
+            SELECT paths.path FROM (
+                SELECT path, inode FROM entries WHERE interval = ? AND first <= ? AND last >= ?
+                EXCEPT
+                SELECT path, inode FROM entries WHERE interval = ? AND first <= ? AND last >= ?
+            ) AS d JOIN paths ON paths.id = d.path
+            ''', (a[0], a[1], a[1], b[0], b[1], b[1]))
+        return {row[0] for row in rows}
+
+    def diff(self, rotationA, rotationB):
+        a = self.resolve(rotationA)
+        b = self.resolve(rotationB)
+        if a[1] is None or b[1] is None:
+            return None
+
+        onlyA = self._except(a, b)
+        onlyB = self._except(b, a)
+        changed = onlyA & onlyB
+        return sorted(onlyB - changed), sorted(onlyA - changed), sorted(changed)
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+# Copyright 2023 WebEye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+ROOT_KEY = '.'
+
+
+def _fingerprintDirectory(path, root):
+    subdirs = []
+    hashes = []
+    relative = os.path.relpath(path, root)
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+
+            name = entry.name if relative == '.' else os.path.join(relative, entry.name)
+            isDir = entry.is_dir(follow_symlinks=False)
+            if isDir:
+                subdirs.append(entry.path)
+
+            # a top level directory is a subtree of its own, top level files belong to the root
+            key = name.split(os.sep, 1)[0] if isDir or relative != '.' else ROOT_KEY
+            digest = hashlib.blake2b(f'{name}\0{st.st_mode}\0{st.st_size}\0{st.st_mtime_ns}\0{st.st_ctime_ns}'
+                                     .encode(errors='surrogateescape'), digest_size=8).digest()
+            hashes.append((key, int.from_bytes(digest, 'little')))
+
+    return subdirs, hashes
+
+
+class changeCore:
+
+    def __init__(self, stateFile, workers=16):
+        self._stateFile = stateFile
+        self._workers = workers
+        self._state = self._load()
+
+    def _load(self):
+        if self._stateFile is None or not os.path.isfile(self._stateFile):
+            return {}
+
+        try:
+            with open(self._stateFile) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self, fingerprints, snapshot):
+        self._state = {'snapshot': snapshot, 'points': fingerprints}
+        if self._stateFile is None:
+            return
+
+        tmp = f'{self._stateFile}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self._state, f)
+        os.replace(tmp, self._stateFile)
+
+    def fingerprint(self, path):
+        # directory mtimes alone miss files rewritten in place, so every entry is stat'ed,
+        # but in parallel and without anything of rsync's per file protocol work
+        st = os.stat(path)
+        sums = {ROOT_KEY: [st.st_mtime_ns % 2 ** 64, 0]}
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            pending = {executor.submit(_fingerprintDirectory, path, path)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    subdirs, hashes = future.result()
+                    for subdir in subdirs:
+                        pending.add(executor.submit(_fingerprintDirectory, subdir, path))
+                    for key, value in hashes:
+                        entry = sums.setdefault(key, [0, 0])
+                        entry[0] = (entry[0] + value) % 2 ** 64
+                        entry[1] += 1
+
+        return sums
+
+    def compare(self, source, fingerprint):
+        previous = self._state.get('points', {}).get(source)
+        if previous is None or previous.get(ROOT_KEY) != fingerprint[ROOT_KEY]:
+            return None
+
+        changed = sorted(key for key in fingerprint if previous.get(key) != fingerprint[key])
+        unchanged = sorted(key for key in fingerprint if key != ROOT_KEY and previous.get(key) == fingerprint[key])
+        return {'changed': changed, 'unchanged': unchanged}
+
+    def scan(self, points, snapshot):
+        start = time.monotonic()
+        fingerprints = {}
+        plans = {}
+        # the fingerprints describe one snapshot, after a sync that did not save them they are worthless
+        current = self._state.get('snapshot') is not None and self._state.get('snapshot') == snapshot
+        for point in points:
+            source = point['source']
+            if not source.startswith('/') or not os.path.isdir(source):
+                continue
+            try:
+                fingerprints[source] = self.fingerprint(source)
+            except OSError:
+                continue
+            plans[source] = self.compare(source, fingerprints[source]) if current else None
+
+        return fingerprints, plans, time.monotonic() - start
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+# Copyright 2023 WebEye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import hashlib
+import mmap
+import multiprocessing
+import os
+import sqlite3
+import stat
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from libs.common.fsTools import walkFiles
+
+# hashes of inodes that were not a candidate for this long are dropped from the cache
+CACHE_MAX_AGE = 30 * 86400
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS hashes (
+    dev INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    digest BLOB NOT NULL,
+    seen REAL NOT NULL,
+    PRIMARY KEY (dev, inode)
+) WITHOUT ROWID;
+'''
+
+
+def _hashFile(path):
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                if hasattr(m, 'madvise'):
+                    m.madvise(mmap.MADV_SEQUENTIAL)
+                digest.update(m)
+    except (OSError, ValueError):
+        return path, None
+
+    return path, digest.digest()
+
+
+class dedupeCore:
+
+    def __init__(self, cacheFile=None, workers=4, minSize=65536):
+        self._db = sqlite3.connect(cacheFile or ':memory:')
+        self._db.executescript(SCHEMA)
+        self._workers = workers
+        self._minSize = max(minSize, 1)
+
+    def close(self):
+        self._db.close()
+
+    def _scan(self, path, previousPath, workers):
+        # one entry per inode, files of the new snapshot that are not hardlinked anywhere are the new copies
+        inodes = {}
+        for root in [path, previousPath]:
+            if root is None or not os.path.isdir(root):
+                continue
+            for filename, st in walkFiles(root, workers):
+                if not stat.S_ISREG(st.st_mode) or st.st_size < self._minSize or st.st_ino in inodes:
+                    continue
+                inodes[st.st_ino] = (filename, st, root == path and st.st_nlink == 1)
+
+        buckets = {}
+        for entry in inodes.values():
+            buckets.setdefault((entry[1].st_dev, entry[1].st_size), []).append(entry)
+
+        return [bucket for bucket in buckets.values() if len(bucket) > 1 and any(entry[2] for entry in bucket)]
+
+    def _digests(self, entries):
+        now = time.time()
+        digests = {}
+        missing = []
+        for filename, st, _ in entries:
+            row = self._db.execute('SELECT size, mtime, digest FROM hashes WHERE dev = ? AND inode = ?',
+                                   (st.st_dev, st.st_ino)).fetchone()
+            if row is not None and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+                digests[filename] = row[2]
+            else:
+                missing.append((filename, st))
+
+        hashed = 0
+        if missing:
+            stats = dict(missing)
+            # forking a process that runs the log listener, reporter and power-off threads can copy held locks
+            with ProcessPoolExecutor(max_workers=self._workers,
+                                     mp_context=multiprocessing.get_context('forkserver')) as executor:
+                results = list(executor.map(_hashFile, list(stats), chunksize=16))
+            with self._db:
+                for filename, digest in results:
+                    if digest is None:
+                        continue
+                    st = stats[filename]
+                    digests[filename] = digest
+                    hashed += 1
+                    self._db.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)',
+                                     (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, digest, now))
+
+        with self._db:
+            self._db.executemany('UPDATE hashes SET seen = ? WHERE dev = ? AND inode = ?',
+                                 ((now, st.st_dev, st.st_ino) for _, st, _ in entries))
+
+        return digests, hashed
+
+    @staticmethod
+    def _link(source, target, st):
+        current = os.lstat(target)
+        if (current.st_ino, current.st_size, current.st_mtime_ns) != (st.st_ino, st.st_size, st.st_mtime_ns):
+            return False
+
+        parent = os.path.dirname(target)
+        parentStat = os.stat(parent)
+        tmp = os.path.join(parent, f'.{os.path.basename(target)}.dedupe')
+        os.link(source, tmp)
+        try:
+            os.replace(tmp, target)
+        except OSError:
+            os.unlink(tmp)
+            raise
+
+        # keep the directory looking untouched for rsync and the change detection of the next run
+        os.utime(parent, ns=(parentStat.st_atime_ns, parentStat.st_mtime_ns))
+        return True
+
+    def run(self, path, previousPath=None, scanWorkers=8):
+        started = time.time()
+        result = {'candidates': 0, 'hashed': 0, 'linked': 0, 'reclaimed': 0, 'errors': 0}
+        candidates = [entry for bucket in self._scan(path, previousPath, scanWorkers) for entry in bucket]
+        result['candidates'] = len(candidates)
+        digests, result['hashed'] = self._digests(candidates)
+
+        groups = {}
+        for filename, st, new in candidates:
+            if filename not in digests:
+                continue
+            # linking only shares content, so the metadata rsync compares has to match as well
+            key = (digests[filename], st.st_dev, st.st_mode, st.st_uid, st.st_gid, st.st_mtime_ns)
+            groups.setdefault(key, []).append((filename, st, new))
+
+        for group in groups.values():
+            if len(group) < 2:
+                continue
+            group.sort(key=lambda entry: (entry[2], -entry[1].st_nlink))
+            source = group[0][0]
+            for filename, st, new in group[1:]:
+                if not new:
+                    continue
+                try:
+                    if self._link(source, filename, st):
+                        result['linked'] += 1
+                        result['reclaimed'] += st.st_size
+                except OSError:
+                    result['errors'] += 1
+
+        with self._db:
+            self._db.execute('DELETE FROM hashes WHERE seen < ?', (started - CACHE_MAX_AGE,))
+
+        return result
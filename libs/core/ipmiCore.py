@@ -15,21 +15,43 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import logging
+import os
 import subprocess
+import time
+
+from libs.core.rmcpSession import rmcpSession, rmcpError, NETFN_CHASSIS, CMD_GET_CHASSIS_STATUS, \
+    CMD_CHASSIS_CONTROL
 
 
 class ipmiCore:
 
-    def __init__(self, host, username, password):
+    _chassisControl = {
+        'off': (0x00, 'off'),
+        'on': (0x01, 'on'),
+        'cycle': (0x02, 'cycle'),
+        'reset': (0x03, 'reset'),
+        'soft': (0x05, 'soft')
+    }
+
+    NATIVE_BACKOFF = 30
+    NATIVE_BACKOFF_MAX = 600
+
+    def __init__(self, host, username, password, backend='native', port=623):
         self._host = host
         self._username = username
         self._password = password
-        self._baseCommand = ['ipmitool', '-H', self._host, '-U', self._username, '-P', self._password]
+        self._backend = backend
+        self._logger = logging.getLogger()
+        self._baseCommand = ['ipmitool', '-H', self._host, '-p', str(port), '-U', self._username, '-E']
+        self._session = rmcpSession(host, username, password, port) if backend == 'native' else None
+        self._backoff = self.NATIVE_BACKOFF
+        self._nativeAfter = 0.0
 
-    @staticmethod
-    def _call(command):
+    def _call(self, command):
         try:
-            process = subprocess.run(command, capture_output=True, text=True)
+            env = dict(os.environ, IPMI_PASSWORD=self._password)
+            process = subprocess.run(command, capture_output=True, text=True, env=env)
             err = process.returncode
             if err != 0:
                 return err, process.stderr.split(chr(10))[0]
@@ -39,7 +61,41 @@ class ipmiCore:
         except FileNotFoundError as ex:
             return -1, ex
 
+    def _native(self, netFn, cmd, data=b''):
+        if self._session is None or time.monotonic() < self._nativeAfter:
+            return None
+
+        # the BMC drops idle sessions, so a failed command gets one retry on a fresh session
+        for attempt in range(2):
+            try:
+                if not self._session.isOpen():
+                    self._session.open()
+                response = self._session.command(netFn, cmd, data)
+                self._backoff = self.NATIVE_BACKOFF
+                return response
+
+            except (rmcpError, OSError) as ex:
+                self._logger.debug(f'ipmi: native session to {self._host} failed ({ex})')
+                self._session.close()
+
+        # a BMC that is busy or rebooting answers again later, native is retried after a growing backoff
+        self._logger.debug(f'ipmi: falling back to ipmitool for {self._host} for {self._backoff} seconds')
+        self._nativeAfter = time.monotonic() + self._backoff
+        self._backoff = min(self._backoff * 2, self.NATIVE_BACKOFF_MAX)
+        return None
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+
     def getChassisPowerStatus(self):
+        response = self._native(NETFN_CHASSIS, CMD_GET_CHASSIS_STATUS)
+        if response is not None:
+            cc, data = response
+            if cc != 0 or len(data) < 1:
+                return -1, f'get chassis status failed with completion code 0x{cc:02x}'
+            return 0, 'on' if data[0] & 0x01 else 'off'
+
         command = self._baseCommand + ['chassis', 'power', 'status']
         err, out = self._call(command)
 
@@ -57,6 +113,15 @@ class ipmiCore:
             return -1, out
 
     def setChassisPower(self, status):
+        if status in self._chassisControl:
+            control, result = self._chassisControl[status]
+            response = self._native(NETFN_CHASSIS, CMD_CHASSIS_CONTROL, bytes([control]))
+            if response is not None:
+                cc, _ = response
+                if cc != 0:
+                    return -1, f'chassis control failed with completion code 0x{cc:02x}'
+                return 0, result
+
         command = self._baseCommand + ['chassis', 'power', status]
         err, out = self._call(command)
 
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# Copyright 2023 WebEye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import json
+import os
+import time
+
+from libs.common.fsTools import mount, umount, readBenchmark
+
+DEFAULT_CANDIDATES = [
+    'vers=3,rsize=1048576,wsize=1048576,noatime',
+    'vers=4.2,rsize=1048576,wsize=1048576,noatime',
+    'vers=4.2,rsize=1048576,wsize=1048576,noatime,nconnect=4,actimeo=60',
+    'vers=4.2,rsize=1048576,wsize=1048576,noatime,nconnect=8,actimeo=60'
+]
+
+
+class mountTuner:
+
+    def __init__(self, profileFile, candidates=None, sampleBytes=256 * 1024 * 1024, maxTime=30, samplePath=''):
+        self._profileFile = profileFile
+        self._candidates = candidates or DEFAULT_CANDIDATES
+        self._sampleBytes = sampleBytes
+        self._maxTime = maxTime
+        self._samplePath = samplePath
+
+    def loadProfile(self, serverPath, maxAge=None):
+        if not self._profileFile or not os.path.isfile(self._profileFile):
+            return None
+
+        try:
+            with open(self._profileFile) as f:
+                profile = json.load(f).get(serverPath)
+        except (OSError, ValueError, AttributeError):
+            return None
+
+        if profile is None or (maxAge and time.time() - profile['tuned'] > maxAge):
+            return None
+
+        return profile
+
+    def saveProfile(self, serverPath, profile):
+        profiles = {}
+        if os.path.isfile(self._profileFile):
+            try:
+                with open(self._profileFile) as f:
+                    profiles = json.load(f)
+            except (OSError, ValueError):
+                profiles = {}
+
+        profiles[serverPath] = profile
+        tmp = f'{self._profileFile}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(profiles, f, indent=2)
+        os.replace(tmp, self._profileFile)
+
+    def _measure(self, serverPath, clientPath, options):
+        if not mount('nfs', serverPath, clientPath, options):
+            return None
+
+        try:
+            _, throughput = readBenchmark(os.path.join(clientPath, self._samplePath), self._sampleBytes,
+                                          self._maxTime)
+        finally:
+            umount(clientPath)
+
+        return throughput
+
+    def tune(self, serverPath, clientPath, logger):
+        # the first pass only warms the server's cache so every candidate reads from the same state
+        self._measure(serverPath, clientPath, self._candidates[0])
+
+        results = {}
+        for options in self._candidates:
+            throughput = self._measure(serverPath, clientPath, options)
+            if throughput is None:
+                logger.debug(f'autotune: unable to mount with {options}')
+                continue
+
+            results[options] = throughput
+            logger.debug(f'autotune: {options}: {throughput / 1024 / 1024:.1f} MB/s')
+
+        if not results:
+            return None
+
+        best = max(results, key=results.get)
+        profile = {'options': best, 'throughput': results[best], 'results': results, 'tuned': time.time()}
+        if self._profileFile:
+            self.saveProfile(serverPath, profile)
+        return profile
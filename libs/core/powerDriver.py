@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# Copyright 2023 WebEye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+from libs.core.ipmiCore import ipmiCore
+from libs.core.powerStateCache import powerStateCache
+from libs.core.redfishCore import redfishCore
+from libs.core.wolCore import wolCore
+
+POWER_DRIVERS = ['ipmi', 'redfish', 'wol']
+
+
+def getPowerDriver(ipmiDict, server_host=None):
+    driver = ipmiDict.get('driver', 'ipmi')
+    if driver == 'redfish':
+        redfishDict = ipmiDict.get('redfish', {})
+        core = redfishCore(ipmiDict['host'], ipmiDict['user'], ipmiDict['password'], redfishDict.get('port', 443),
+                           redfishDict.get('scheme', 'https'), redfishDict.get('verify', False),
+                           redfishDict.get('system'))
+    elif driver == 'wol':
+        wolDict = ipmiDict['wol']
+        core = wolCore(wolDict['mac'], server_host, wolDict.get('broadcast', '255.255.255.255'),
+                       wolDict.get('port', 9), wolDict.get('off_command'))
+    else:
+        core = ipmiCore(ipmiDict['host'], ipmiDict['user'], ipmiDict['password'], ipmiDict.get('backend', 'native'),
+                        ipmiDict.get('port', 623))
+
+    key = ipmiDict.get('host') or server_host
+    return powerStateCache(core, key, ipmiDict.get('cache_file'), ipmiDict.get('cache_ttl', 10))
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# Copyright 2023 WebEye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import fcntl
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+
+class powerStateCache:
+
+    def __init__(self, ipmi, host, cacheFile=None, ttl=10):
+        self._ipmi = ipmi
+        self._host = host
+        self._cacheFile = cacheFile
+        self._lockName = re.sub(r'[^\w.-]', '_', str(host))
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._cached = None
+        self.latencies = {}
+
+    def _timed(self, operation, call, *args):
+        start = time.monotonic()
+        try:
+            return call(*args)
+        finally:
+            self.latencies[operation] = time.monotonic() - start
+
+    def _readFile(self):
+        if not self._cacheFile or not os.path.isfile(self._cacheFile):
+            return {}
+
+        try:
+            with open(self._cacheFile) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _writeFile(self, entry):
+        if not self._cacheFile:
+            return
+
+        # all hosts share the file, the read-modify-write is the only part serialized across them
+        with self._fileLock(f'{self._cacheFile}.lock'):
+            states = self._readFile()
+            if entry is None:
+                states.pop(self._host, None)
+            else:
+                states[self._host] = entry
+
+            tmp = f'{self._cacheFile}.{os.getpid()}.{threading.get_ident()}.tmp'
+            try:
+                with open(tmp, 'w') as f:
+                    json.dump(states, f)
+                os.replace(tmp, self._cacheFile)
+            except OSError:
+                pass
+
+    @contextmanager
+    def _fileLock(self, filename):
+        if not self._cacheFile:
+            yield
+            return
+
+        with open(filename, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _hostLock(self):
+        # other processes asking for the same host wait here and then read our answer, a slow BMC only
+        # holds up callers of its own host
+        return self._fileLock(f'{self._cacheFile}.{self._lockName}.lock')
+
+    def getCachedStatus(self, maxAge=None):
+        maxAge = self._ttl if maxAge is None else maxAge
+        entries = [entry for entry in [self._cached, self._readFile().get(self._host)] if entry is not None]
+        if not entries:
+            return None
+
+        entry = max(entries, key=lambda e: e['time'])
+        if time.time() - entry['time'] > maxAge:
+            return None
+
+        return entry
+
+    def getChassisPowerStatus(self, maxAge=None):
+        entry = self.getCachedStatus(maxAge)
+        if entry is not None:
+            return 0, entry['status']
+
+        with self._lock:
+            with self._hostLock():
+                entry = self.getCachedStatus(maxAge)
+                if entry is not None:
+                    return 0, entry['status']
+
+                err, status = self._timed('status', self._ipmi.getChassisPowerStatus)
+                if err == 0:
+                    self._cached = {'time': time.time(), 'status': status}
+                    self._writeFile(self._cached)
+
+        return err, status
+
+    def setChassisPower(self, status):
+        with self._lock:
+            with self._hostLock():
+                self._cached = None
+                self._writeFile(None)
+                return self._timed(status, self._ipmi.setChassisPower, status)
+
+    def close(self):
+        self._ipmi.close()
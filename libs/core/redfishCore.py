@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+# Copyright 2023 WebEye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import base64
+import http.client
+import json
+import logging
+import ssl
+import urllib.parse
+
+
+class redfishCore:
+
+    _resetTypes = {
+        'on': 'On',
+        'off': 'ForceOff',
+        'soft': 'GracefulShutdown',
+        'cycle': 'PowerCycle',
+        'reset': 'ForceRestart'
+    }
+
+    def __init__(self, host, username, password, port=443, scheme='https', verify=False, system=None, timeout=10):
+        self._host = host
+        self._port = port
+        self._scheme = scheme
+        self._username = username
+        self._password = password
+        self._verify = verify
+        self._system = system
+        self._timeout = timeout
+        self._logger = logging.getLogger()
+        self._connection = None
+        self._token = None
+        self._session = None
+        self._loggedIn = False
+
+    def _connect(self):
+        if self._scheme == 'https':
+            context = ssl.create_default_context() if self._verify else ssl._create_unverified_context()
+            return http.client.HTTPSConnection(self._host, self._port, timeout=self._timeout, context=context)
+
+        return http.client.HTTPConnection(self._host, self._port, timeout=self._timeout)
+
+    def _request(self, method, path, body=None, auth=True):
+        headers = {'Accept': 'application/json', 'Connection': 'keep-alive'}
+        if body is not None:
+            headers['Content-Type'] = 'application/json'
+            body = json.dumps(body)
+        if auth and self._token is not None:
+            headers['X-Auth-Token'] = self._token
+        elif auth:
+            credentials = base64.b64encode(f'{self._username}:{self._password}'.encode()).decode()
+            headers['Authorization'] = f'Basic {credentials}'
+
+        # a BMC closes idle keep-alive connections, so a failed request gets one retry on a fresh one
+        for attempt in range(2):
+            if self._connection is None:
+                self._connection = self._connect()
+            try:
+                self._connection.request(method, path, body, headers)
+                response = self._connection.getresponse()
+                data = response.read()
+                return response.status, response.getheaders(), json.loads(data) if data else {}
+            except (http.client.HTTPException, OSError) as ex:
+                self._logger.debug(f'redfish: request to {self._host} failed ({ex})')
+                self._connection.close()
+                self._connection = None
+                if attempt:
+                    raise
+
+    def _login(self):
+        status, headers, _ = self._request('POST', '/redfish/v1/SessionService/Sessions',
+                                           {'UserName': self._username, 'Password': self._password}, False)
+        headers = {key.lower(): value for key, value in headers}
+        if status in (200, 201) and 'x-auth-token' in headers:
+            self._token = headers['x-auth-token']
+            self._session = urllib.parse.urlsplit(headers['location']).path if 'location' in headers else None
+        # without a session service every request carries basic auth instead
+
+    def _call(self, method, path, body=None):
+        if not self._loggedIn:
+            self._login()
+            self._loggedIn = True
+
+        status, _, data = self._request(method, path, body)
+        if status == 401 and self._token is not None:
+            self._token = None
+            self._login()
+            status, _, data = self._request(method, path, body)
+
+        return status, data
+
+    def _getSystem(self):
+        if self._system is None:
+            status, data = self._call('GET', '/redfish/v1/Systems')
+            members = data.get('Members', [])
+            if status != 200 or not members:
+                raise OSError(f'no computer system found (status {status})')
+            self._system = members[0]['@odata.id']
+
+        return self._system
+
+    def close(self):
+        if self._connection is None:
+            return
+
+        try:
+            if self._session is not None:
+                self._request('DELETE', self._session)
+        except (http.client.HTTPException, OSError):
+            pass
+        finally:
+            self._connection.close()
+            self._connection = None
+            self._token = None
+            self._session = None
+            self._loggedIn = False
+
+    def getChassisPowerStatus(self):
+        try:
+            status, data = self._call('GET', self._getSystem())
+        except (http.client.HTTPException, OSError, ValueError) as ex:
+            return -1, str(ex)
+
+        if status != 200 or 'PowerState' not in data:
+            return -1, f'get power state failed with status {status}'
+
+        # PoweringOn still counts as on, like the chassis power bit of ipmi
+        return 0, 'off' if data['PowerState'] == 'Off' else 'on'
+
+    def setChassisPower(self, status):
+        if status not in self._resetTypes:
+            return -1, f'unsupported power state {status}'
+
+        try:
+            system = self._getSystem()
+            code, _ = self._call('POST', f'{system}/Actions/ComputerSystem.Reset',
+                                 {'ResetType': self._resetTypes[status]})
+        except (http.client.HTTPException, OSError, ValueError) as ex:
+            return -1, str(ex)
+
+        if code not in (200, 202, 204):
+            return -1, f'reset {self._resetTypes[status]} failed with status {code}'
+
+        return 0, status
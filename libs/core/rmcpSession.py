@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+# Copyright 2023 WebEye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import hashlib
+import hmac
+import os
+import socket
+import struct
+
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    Cipher = None
+
+# IPMI v2.0 over LAN (RMCP+, "lanplus"), cipher suite 3 (RAKP-HMAC-SHA1,
+# HMAC-SHA1-96, AES-CBC-128) when the cryptography package is available,
+# cipher suite 2 (no confidentiality) otherwise.
+
+RMCP_HEADER = bytes([0x06, 0x00, 0xFF, 0x07])
+
+AUTH_NONE = 0x00
+AUTH_RMCPP = 0x06
+
+PAYLOAD_IPMI = 0x00
+PAYLOAD_OPEN_SESSION_REQUEST = 0x10
+PAYLOAD_OPEN_SESSION_RESPONSE = 0x11
+PAYLOAD_RAKP1 = 0x12
+PAYLOAD_RAKP2 = 0x13
+PAYLOAD_RAKP3 = 0x14
+PAYLOAD_RAKP4 = 0x15
+
+PAYLOAD_ENCRYPTED = 0x80
+PAYLOAD_AUTHENTICATED = 0x40
+
+NETFN_CHASSIS = 0x00
+NETFN_APP = 0x06
+
+CMD_GET_CHASSIS_STATUS = 0x01
+CMD_CHASSIS_CONTROL = 0x02
+CMD_GET_CHANNEL_AUTH_CAPS = 0x38
+CMD_SET_SESSION_PRIVILEGE = 0x3B
+CMD_CLOSE_SESSION = 0x3C
+
+PRIV_ADMIN = 0x04
+NAME_ONLY_LOOKUP = 0x10
+
+BMC_ADDRESS = 0x20
+CONSOLE_ADDRESS = 0x81
+
+AUTH_RAKP_HMAC_SHA1 = 0x01
+INTEGRITY_HMAC_SHA1_96 = 0x01
+CONFIDENTIALITY_NONE = 0x00
+CONFIDENTIALITY_AES_CBC_128 = 0x01
+
+
+class rmcpError(Exception):
+    pass
+
+
+def hasAES():
+    return Cipher is not None
+
+
+def checksum(data):
+    return -sum(data) & 0xFF
+
+
+def hmacSha1(key, data):
+    return hmac.new(key, data, hashlib.sha1).digest()
+
+
+def buildMessage(rsAddr, netFn, rqAddr, rqSeq, cmd, data=b''):
+    header = bytes([rsAddr, netFn << 2])
+    body = bytes([rqAddr, rqSeq << 2, cmd]) + data
+    return header + bytes([checksum(header)]) + body + bytes([checksum(body)])
+
+
+def parseMessage(message):
+    if len(message) < 7 or checksum(message[:3]) != 0 or checksum(message[3:]) != 0:
+        raise rmcpError('malformed ipmi message')
+
+    return {
+        'netFn': message[1] >> 2,
+        'rqSeq': message[4] >> 2,
+        'cmd': message[5],
+        'data': message[6:-1]
+    }
+
+
+def encryptPayload(key, payload):
+    iv = os.urandom(16)
+    padLen = (16 - (len(payload) + 1) % 16) % 16
+    plain = payload + bytes(range(1, padLen + 1)) + bytes([padLen])
+    encryptor = Cipher(algorithms.AES(key[:16]), modes.CBC(iv)).encryptor()
+    return iv + encryptor.update(plain) + encryptor.finalize()
+
+
+def decryptPayload(key, payload):
+    if len(payload) < 32 or len(payload) % 16 != 0:
+        raise rmcpError('malformed encrypted payload')
+
+    decryptor = Cipher(algorithms.AES(key[:16]), modes.CBC(payload[:16])).decryptor()
+    plain = decryptor.update(payload[16:]) + decryptor.finalize()
+    return plain[:-(plain[-1] + 1)]
+
+
+def wrapPacket(payloadType, payload, sessionId=0, sessionSeq=0, k1=None, k2=None):
+    if k2 is not None:
+        payload = encryptPayload(k2, payload)
+        payloadType |= PAYLOAD_ENCRYPTED
+
+    if k1 is not None:
+        payloadType |= PAYLOAD_AUTHENTICATED
+
+    body = struct.pack('<BBIIH', AUTH_RMCPP, payloadType, sessionId, sessionSeq, len(payload)) + payload
+    if k1 is not None:
+        padLen = (4 - (len(body) + 2) % 4) % 4
+        body += b'\xff' * padLen + bytes([padLen, 0x07])
+        body += hmacSha1(k1, body)[:12]
+
+    return RMCP_HEADER + body
+
+
+def unwrapPacket(packet, k1=None, k2=None):
+    if len(packet) < 16 or packet[0] != RMCP_HEADER[0] or packet[3] != RMCP_HEADER[3]:
+        raise rmcpError('not a rmcp packet')
+
+    if packet[4] != AUTH_RMCPP:
+        raise rmcpError(f'unexpected auth type {packet[4]}')
+
+    payloadType = packet[5]
+    sessionId, sessionSeq, length = struct.unpack_from('<IIH', packet, 6)
+    payload = packet[16:16 + length]
+    if len(payload) != length:
+        raise rmcpError('truncated rmcp packet')
+
+    if payloadType & PAYLOAD_AUTHENTICATED:
+        if k1 is None or not hmac.compare_digest(hmacSha1(k1, packet[4:-12])[:12], packet[-12:]):
+            raise rmcpError('integrity check failed')
+
+    if payloadType & PAYLOAD_ENCRYPTED:
+        if k2 is None:
+            raise rmcpError('unexpected encrypted payload')
+        payload = decryptPayload(k2, payload)
+
+    return payloadType & 0x3F, sessionId, sessionSeq, payload
+
+
+def wrapLegacyPacket(message):
+    return RMCP_HEADER + struct.pack('<BIIB', AUTH_NONE, 0, 0, len(message)) + message
+
+
+def unwrapLegacyPacket(packet):
+    if len(packet) < 14 or packet[0] != RMCP_HEADER[0] or packet[4] != AUTH_NONE:
+        raise rmcpError('not a legacy ipmi packet')
+
+    return packet[14:14 + packet[13]]
+
+
+def deriveKeys(kuid, rm, rc, role, username):
+    sik = hmacSha1(kuid, rm + rc + bytes([role, len(username)]) + username)
+    return sik, hmacSha1(sik, b'\x01' * 20), hmacSha1(sik, b'\x02' * 20)
+
+
+class rmcpSession:
+
+    def __init__(self, host, username, password, port=623, timeout=1.0, retries=3):
+        self._host = host
+        self._port = port
+        self._username = username.encode()[:16]
+        self._kuid = password.encode()[:20]
+        self._timeout = timeout
+        self._retries = retries
+
+        self._sock = None
+        self._sessionId = 0
+        self._sessionSeq = 0
+        self._rqSeq = 0
+        self._tag = 0
+        self._k1 = None
+        self._k2 = None
+
+    def isOpen(self):
+        return self._sock is not None and self._sessionId != 0
+
+    def _nextTag(self):
+        self._tag = (self._tag + 1) & 0xFF
+        return self._tag
+
+    def _transact(self, packet, accept):
+        for _ in range(self._retries):
+            self._sock.send(packet)
+            try:
+                while True:
+                    result = accept(self._sock.recv(1024))
+                    if result is not None:
+                        return result
+            except socket.timeout:
+                continue
+
+        raise rmcpError(f'no response from {self._host}:{self._port}')
+
+    def _exchange(self, payloadType, payload, responseType):
+        tag = payload[0]
+
+        def accept(packet):
+            try:
+                rtype, _, _, rpayload = unwrapPacket(packet)
+            except rmcpError:
+                return None
+            if rtype != responseType or len(rpayload) < 8 or rpayload[0] != tag:
+                return None
+            if rpayload[1] != 0:
+                raise rmcpError(f'session setup failed with status 0x{rpayload[1]:02x}')
+            return rpayload
+
+        return self._transact(wrapPacket(payloadType, payload), accept)
+
+    def _getChannelAuthCaps(self):
+        message = buildMessage(BMC_ADDRESS, NETFN_APP, CONSOLE_ADDRESS, 0, CMD_GET_CHANNEL_AUTH_CAPS,
+                               bytes([0x8E, PRIV_ADMIN]))
+
+        def accept(packet):
+            try:
+                response = parseMessage(unwrapLegacyPacket(packet))
+            except rmcpError:
+                return None
+            if response['cmd'] != CMD_GET_CHANNEL_AUTH_CAPS:
+                return None
+            return response
+
+        response = self._transact(wrapLegacyPacket(message), accept)
+        if len(response['data']) < 1 or response['data'][0] != 0:
+            raise rmcpError('get channel authentication capabilities failed')
+
+    def open(self):
+        self.close()
+        family, socktype, proto, _, address = socket.getaddrinfo(self._host, self._port, 0, socket.SOCK_DGRAM)[0]
+        self._sock = socket.socket(family, socktype, proto)
+        self._sock.settimeout(self._timeout)
+        self._sock.connect(address)
+
+        try:
+            self._handshake()
+        except (rmcpError, OSError):
+            self.close()
+            raise
+
+    def _handshake(self):
+        self._getChannelAuthCaps()
+
+        confidentiality = CONFIDENTIALITY_AES_CBC_128 if hasAES() else CONFIDENTIALITY_NONE
+        consoleId = struct.unpack('<I', os.urandom(4))[0] | 1
+        request = struct.pack('<BBHI', self._nextTag(), PRIV_ADMIN, 0, consoleId)
+        request += bytes([0x00, 0, 0, 8, AUTH_RAKP_HMAC_SHA1, 0, 0, 0])
+        request += bytes([0x01, 0, 0, 8, INTEGRITY_HMAC_SHA1_96, 0, 0, 0])
+        request += bytes([0x02, 0, 0, 8, confidentiality, 0, 0, 0])
+        response = self._exchange(PAYLOAD_OPEN_SESSION_REQUEST, request, PAYLOAD_OPEN_SESSION_RESPONSE)
+        bmcId = struct.unpack_from('<I', response, 8)[0]
+
+        rm = os.urandom(16)
+        role = PRIV_ADMIN | NAME_ONLY_LOOKUP
+        user = bytes([role, len(self._username)]) + self._username
+        request = struct.pack('<B3xI', self._nextTag(), bmcId) + rm + bytes([role, 0, 0, len(self._username)])
+        request += self._username
+        response = self._exchange(PAYLOAD_RAKP1, request, PAYLOAD_RAKP2)
+        rc, guid = response[8:24], response[24:40]
+        expected = hmacSha1(self._kuid, struct.pack('<II', consoleId, bmcId) + rm + rc + guid + user)
+        if not hmac.compare_digest(expected, response[40:60]):
+            raise rmcpError('rakp2: invalid key exchange authentication code (wrong password?)')
+
+        sik, k1, k2 = deriveKeys(self._kuid, rm, rc, role, self._username)
+        authCode = hmacSha1(self._kuid, rc + struct.pack('<I', consoleId) + user)
+        request = struct.pack('<BBxxI', self._nextTag(), 0, bmcId) + authCode
+        response = self._exchange(PAYLOAD_RAKP3, request, PAYLOAD_RAKP4)
+        expected = hmacSha1(sik, rm + struct.pack('<I', bmcId) + guid)[:12]
+        if not hmac.compare_digest(expected, response[8:20]):
+            raise rmcpError('rakp4: invalid integrity check value')
+
+        self._sessionId = bmcId
+        self._sessionSeq = 0
+        self._k1 = k1
+        self._k2 = k2 if confidentiality == CONFIDENTIALITY_AES_CBC_128 else None
+
+        cc, _ = self.command(NETFN_APP, CMD_SET_SESSION_PRIVILEGE, bytes([PRIV_ADMIN]))
+        if cc != 0:
+            raise rmcpError(f'set session privilege level failed with completion code 0x{cc:02x}')
+
+    def command(self, netFn, cmd, data=b''):
+        if not self.isOpen():
+            raise rmcpError('session is not open')
+
+        self._sessionSeq = (self._sessionSeq + 1) & 0xFFFFFFFF or 1
+        self._rqSeq = self._rqSeq % 63 + 1
+        rqSeq = self._rqSeq
+        message = buildMessage(BMC_ADDRESS, netFn, CONSOLE_ADDRESS, rqSeq, cmd, data)
+        packet = wrapPacket(PAYLOAD_IPMI, message, self._sessionId, self._sessionSeq, self._k1, self._k2)
+
+        def accept(packet):
+            try:
+                rtype, _, _, payload = unwrapPacket(packet, self._k1, self._k2)
+                response = parseMessage(payload)
+            except rmcpError:
+                return None
+            if rtype != PAYLOAD_IPMI or response['rqSeq'] != rqSeq or response['cmd'] != cmd:
+                return None
+            return response
+
+        response = self._transact(packet, accept)
+        if len(response['data']) < 1:
+            raise rmcpError('missing completion code')
+
+        return response['data'][0], response['data'][1:]
+
+    def close(self):
+        if self._sock is None:
+            return
+
+        if self._sessionId != 0:
+            try:
+                self.command(NETFN_APP, CMD_CLOSE_SESSION, struct.pack('<I', self._sessionId))
+            except (rmcpError, OSError):
+                pass
+
+        self._sock.close()
+        self._sock = None
+        self._sessionId = 0
+        self._k1 = None
+        self._k2 = None
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+# Copyright 2023 WebEye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import glob
+import os
+import re
+
+LIST_KEYS = ['exclude', 'include', 'exclude_file', 'include_file']
+
+DEFAULTS = {
+    'cmd_rsync': '/usr/bin/rsync',
+    'cmd_cp': '/bin/cp',
+    'cmd_ssh': None,
+    'ssh_args': '',
+    'rsync_short_args': '-a',
+    'rsync_long_args': '--delete --numeric-ids --relative --delete-excluded',
+    'one_fs': '0',
+    'link_dest': '0',
+    'sync_first': '0',
+    'lockfile': None,
+    'stop_on_stale_lockfile': '1'
+}
+
+
+def _parseOptions(value):
+    options = {}
+    for option in value.split(','):
+        key, _, optionValue = option.partition('=')
+        if key.strip() in LIST_KEYS:
+            options.setdefault(key.strip(), []).append(optionValue.strip())
+        elif key.strip():
+            options[key.strip()] = optionValue.strip()
+
+    return options
+
+
+def _readConfig(filename, config):
+    with open(filename) as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line.strip() or line.lstrip().startswith('#'):
+                continue
+
+            fields = [field for field in line.split('\t') if field != '']
+            key, values = fields[0], fields[1:]
+            if key in ('retain', 'interval'):
+                config['retain'].append((values[0], int(values[1])))
+            elif key == 'backup':
+                config['backup'].append({
+                    'source': values[0],
+                    'dest': values[1],
+                    'options': _parseOptions(values[2]) if len(values) > 2 else {}
+                })
+            elif key in ('backup_script', 'backup_exec'):
+                config['unsupported'].append(key)
+            elif key in LIST_KEYS:
+                config[key].append(values[0])
+            elif key == 'include_conf':
+                for include in glob.glob(values[0]):
+                    _readConfig(include, config)
+            else:
+                config[key] = values[0] if values else ''
+
+
+def readRsnapshotConfig(filename):
+    config = dict(DEFAULTS, snapshot_root=None, retain=[], backup=[], unsupported=[])
+    for key in LIST_KEYS:
+        config[key] = []
+
+    _readConfig(filename, config)
+    return config
+
+
+def isRemoteShell(source):
+    # host:path goes through ssh, rsync://host/module and host::module talk to an rsync daemon
+    if source.startswith('/') or '://' in source:
+        return False
+
+    host, separator, path = source.partition(':')
+    return bool(separator) and '/' not in host and not path.startswith(':')
+
+
+def getRsyncCommand(config, point, destination, linkDest=None):
+    options = point['options']
+    command = [config['cmd_rsync']]
+    command += options.get('rsync_short_args', config['rsync_short_args']).split()
+    command += options.get('rsync_long_args', config['rsync_long_args']).split()
+    if options.get('one_fs', config['one_fs']) == '1':
+        command.append('--one-file-system')
+
+    for key, flag in [('include', '--include'), ('exclude', '--exclude'),
+                      ('include_file', '--include-from'), ('exclude_file', '--exclude-from')]:
+        for value in config[key] + options.get(key, []):
+            command.append(f'{flag}={value}')
+
+    if isRemoteShell(point['source']):
+        ssh = config['cmd_ssh'] or 'ssh'
+        ssh_args = options.get('ssh_args', config['ssh_args'])
+        command.append(f'--rsh={ssh} {ssh_args}'.strip())
+
+    if linkDest is not None:
+        command.append(f'--link-dest={linkDest}')
+
+    command += [point['source'], destination]
+    return command
+
+
+def _readFilterFile(filename, include):
+    rules = []
+    with open(filename) as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line.strip() or line[0] in '#;':
+                continue
+            # filter files may carry the rule type in front of each pattern
+            if line[:2] in ('+ ', '- '):
+                rules.append((line[0] == '+', line[2:]))
+            else:
+                rules.append((include, line))
+
+    return rules
+
+
+def _patternRegex(pattern):
+    regex = ''
+    index = 0
+    while index < len(pattern):
+        if pattern.startswith('**', index):
+            regex += '.*'
+            index += 2
+        elif pattern[index] == '*':
+            regex += '[^/]*'
+            index += 1
+        elif pattern[index] == '?':
+            regex += '[^/]'
+            index += 1
+        elif pattern[index] == '[' and ']' in pattern[index + 2:]:
+            end = pattern.index(']', index + 2)
+            regex += '[' + pattern[index + 1:end].replace('!', '^', 1) + ']'
+            index = end + 1
+        else:
+            regex += re.escape(pattern[index])
+            index += 1
+
+    # an anchored pattern starts at the transfer root, any other matches the end of the path
+    return re.compile(('^' if pattern.startswith('/') else '(^|/)') + regex + '$')
+
+
+def getFilter(config, point):
+    options = point['options']
+    rules = []
+    for key, include in [('include', True), ('exclude', False)]:
+        rules += [(include, value) for value in config[key] + options.get(key, [])]
+    for key, include in [('include_file', True), ('exclude_file', False)]:
+        for filename in config[key] + options.get(key, []):
+            rules += _readFilterFile(filename, include)
+    if not rules:
+        return None
+
+    compiled = [(include, pattern.endswith('/'), _patternRegex(pattern.rstrip('/'))) for include, pattern in rules]
+
+    # the rules see the path as rsync sends it: below the source with --relative or a trailing slash,
+    # below the source directory name otherwise
+    args = (options.get('rsync_short_args', config['rsync_short_args']).split() +
+            options.get('rsync_long_args', config['rsync_long_args']).split())
+    if '--relative' in args or '-R' in args:
+        base = point['source'].rstrip('/')
+    elif point['source'].endswith('/'):
+        base = ''
+    else:
+        base = '/' + os.path.basename(point['source'])
+
+    def excluded(relative, isDir):
+        path = f'{base}/{relative}'
+        for include, dirOnly, regex in compiled:
+            if (isDir or not dirOnly) and regex.search(path):
+                return not include
+        return False
+
+    return excluded
+
+
+def getSnapshotPath(config, point, snapshot):
+    options = point['options']
+    destination = os.path.join(snapshot, point['dest'])
+    args = (options.get('rsync_short_args', config['rsync_short_args']).split() +
+            options.get('rsync_long_args', config['rsync_long_args']).split())
+    if '--relative' in args or '-R' in args:
+        return os.path.join(destination, point['source'].lstrip('/'))
+    if point['source'].endswith('/'):
+        return destination
+
+    return os.path.join(destination, os.path.basename(point['source']))
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+# Copyright 2023 WebEye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import datetime
+import os
+import struct
+
+MAGIC = b'IPBH'
+VERSION = 1
+
+# one fixed-width record per run, so years of history are a single read and iter_unpack
+FIELDS = [
+    ('started', 'd'),
+    ('duration', 'f'),
+    ('status', 'B'),
+    ('time_to_ready', 'f'),
+    ('mount', 'f'),
+    ('rsnapshot', 'f'),
+    ('verify', 'f'),
+    ('disk_usage', 'f'),
+    ('powered_on', 'f'),
+    ('files_transferred', 'Q'),
+    ('literal_bytes', 'Q'),
+    ('unique', 'Q'),
+    ('apparent', 'Q'),
+    ('files', 'Q'),
+    ('disk_free', 'Q'),
+    ('disk_total', 'Q'),
+]
+RECORD = struct.Struct('<' + ''.join(kind for _, kind in FIELDS))
+HEADER = struct.Struct('<4sHH')
+
+
+def _duration(phases, name):
+    # coalesced runs name their phases <name>_<command>
+    return sum(phase['duration'] for key, phase in phases.items()
+               if key == name or (key.startswith(f'{name}_') and 'wait' not in key))
+
+
+def getHistoryRecord(record, rootFolder=None):
+    phases, values = record['phases'], record['values']
+    disk_free = disk_total = 0
+    if rootFolder and os.path.isdir(rootFolder):
+        st = os.statvfs(rootFolder)
+        disk_free, disk_total = st.f_bavail * st.f_frsize, st.f_blocks * st.f_frsize
+
+    powered_on = sum(_duration(phases, name) for name in ['time_to_ready', 'mount', 'rsnapshot', 'verify', 'umount'])
+    return {
+        'started': record['started'],
+        'duration': record['duration'],
+        'status': record['status'],
+        'time_to_ready': _duration(phases, 'time_to_ready'),
+        'mount': _duration(phases, 'mount'),
+        'rsnapshot': _duration(phases, 'rsnapshot'),
+        'verify': _duration(phases, 'verify'),
+        'disk_usage': _duration(phases, 'disk_usage'),
+        'powered_on': powered_on,
+        'files_transferred': int(values.get('rsync_files_transferred', 0)),
+        'literal_bytes': int(values.get('rsync_literal_bytes', 0)),
+        'unique': int(values.get('snapshot_unique', 0)),
+        'apparent': int(values.get('snapshot_apparent', 0)),
+        'files': int(values.get('snapshot_files', 0)),
+        'disk_free': disk_free,
+        'disk_total': disk_total
+    }
+
+
+class runHistory:
+
+    def __init__(self, filename):
+        self._filename = filename
+
+    def append(self, entry):
+        with open(self._filename, 'ab') as f:
+            if f.tell() == 0:
+                f.write(HEADER.pack(MAGIC, VERSION, RECORD.size))
+            f.write(RECORD.pack(*(entry[name] for name, _ in FIELDS)))
+
+    def load(self, since=None):
+        if not os.path.isfile(self._filename):
+            return []
+
+        with open(self._filename, 'rb') as f:
+            data = f.read()
+
+        if len(data) < HEADER.size:
+            return []
+        magic, version, size = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION or size != RECORD.size:
+            raise ValueError(f'{self._filename} is no run history of version {VERSION}')
+
+        # a crash during append leaves a partial last record behind
+        body = memoryview(data)[HEADER.size:]
+        body = body[:len(body) - len(body) % RECORD.size]
+        names = [name for name, _ in FIELDS]
+        entries = [dict(zip(names, values)) for values in RECORD.iter_unpack(body)]
+        if since is not None:
+            entries = [entry for entry in entries if entry['started'] >= since]
+
+        return entries
+
+
+def _trend(points):
+    # least squares slope and intercept of (x, y)
+    n = len(points)
+    if n < 2:
+        return None
+
+    meanX = sum(x for x, _ in points) / n
+    meanY = sum(y for _, y in points) / n
+    varX = sum((x - meanX) ** 2 for x, _ in points)
+    if varX == 0:
+        return None
+
+    slope = sum((x - meanX) * (y - meanY) for x, y in points) / varX
+    return slope, meanY - slope * meanX
+
+
+def _crossing(trend, limit, now):
+    if trend is None or trend[0] <= 0:
+        return None
+
+    moment = (limit - trend[1]) / trend[0]
+    return datetime.datetime.fromtimestamp(max(moment, now))
+
+
+def getForecast(entries, window=None, now=None):
+    now = now or datetime.datetime.now().timestamp()
+    ok = [entry for entry in entries if entry['status'] == 0]
+    if not ok:
+        return None
+
+    latest = ok[-1]
+    day = 86400
+    forecast = {
+        'runs': len(entries),
+        'failed': len(entries) - len(ok),
+        'first': datetime.datetime.fromtimestamp(entries[0]['started']),
+        'last': datetime.datetime.fromtimestamp(latest['started']),
+        'apparent': latest['apparent'],
+        'unique_mean': sum(entry['unique'] for entry in ok) / len(ok),
+        'duration_mean': sum(entry['duration'] for entry in ok) / len(ok),
+        'duration_max': max(entry['duration'] for entry in ok),
+        'ready_mean': sum(entry['time_to_ready'] for entry in ok) / len(ok),
+        'powered_on_mean': sum(entry['powered_on'] for entry in ok) / len(ok),
+        'throughput_mean': sum(entry['unique'] / entry['rsnapshot'] for entry in ok if entry['rsnapshot'] > 0) /
+                           max(1, len([entry for entry in ok if entry['rsnapshot'] > 0])),
+        'disk_free': latest['disk_free'],
+        'disk_total': latest['disk_total']
+    }
+
+    apparent = _trend([(entry['started'], entry['apparent']) for entry in ok])
+    forecast['apparent_growth'] = apparent[0] * day if apparent else None
+
+    # the window is what the server is on for, waiting for a ready_by slot does not count
+    powered_on = _trend([(entry['started'], entry['powered_on']) for entry in ok])
+    forecast['powered_on_growth'] = powered_on[0] * day if powered_on else None
+    forecast['window'] = window
+    forecast['window_exceeded'] = _crossing(powered_on, window, now) if window else None
+
+    used = _trend([(entry['started'], entry['disk_total'] - entry['disk_free']) for entry in ok if entry['disk_total']])
+    forecast['disk_growth'] = used[0] * day if used else None
+    forecast['disk_full'] = _crossing(used, latest['disk_total'], now) if latest['disk_total'] else None
+    return forecast
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# Copyright 2023 WebEye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import json
+import os
+import time
+
+
+class runJournal:
+
+    def __init__(self, filename):
+        self._filename = filename
+
+    def _fsyncDirectory(self):
+        fd = os.open(os.path.dirname(os.path.abspath(self._filename)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def load(self):
+        records = []
+        if self._filename is None or not os.path.isfile(self._filename):
+            return records
+
+        with open(self._filename) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # a crash in the middle of a write leaves a torn last line, everything before it is valid
+                    break
+
+        return records
+
+    def getInFlight(self):
+        records = self.load()
+        if not records or records[0].get('event') != 'start':
+            return None
+
+        state = {'run_id': records[0]['run_id'], 'started': records[0]['time'], 'commands': records[0]['commands'],
+                 'slot': records[0].get('slot'), 'last': records[-1]['event'], 'snapshots': [], 'booting': False,
+                 'powered_on': False, 'mounted': False}
+        for record in records[1:]:
+            event = record['event']
+            if event == 'finished':
+                return None
+            elif event == 'snapshot':
+                state['snapshots'].append(record['command'])
+            elif event == 'booting':
+                state['booting'] = True
+            elif event in ('powered_on', 'powered_off'):
+                state['powered_on'] = event == 'powered_on'
+                state['booting'] = False
+            elif event in ('mounted', 'umounted'):
+                state['mounted'] = event == 'mounted'
+
+        return state
+
+    def start(self, runId, commands, resumed=None, slot=None):
+        if self._filename is None:
+            return
+
+        tmp = f'{self._filename}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(json.dumps({'event': 'start', 'time': time.time(), 'run_id': runId, 'commands': commands,
+                                'resumed': resumed, 'slot': slot}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._filename)
+        self._fsyncDirectory()
+
+    def record(self, event, **fields):
+        if self._filename is None:
+            return
+
+        with open(self._filename, 'a') as f:
+            f.write(json.dumps(dict(fields, event=event, time=time.time())) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+# Copyright 2023 WebEye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from libs.core.rsnapshotConfig import readRsnapshotConfig, getRsyncCommand, getSnapshotPath
+
+# rsync exit code 24: some source files vanished during the transfer, rsnapshot only warns about it
+RSYNC_OK = (0, 24)
+
+
+def _identity(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    return [st.st_ino, st.st_mtime_ns]
+
+
+class shardCore:
+
+    def __init__(self, script, workers, stateFile=None, changes=None, throttle=None):
+        self._config = readRsnapshotConfig(script)
+        self._workers = workers
+        self._stateFile = stateFile
+        self._changes = changes
+        self._throttle = throttle
+        self.changeSummary = None
+
+    def canShard(self, command):
+        if self._config['unsupported'] or not self._config['backup'] or not self._config['retain']:
+            return False
+
+        if self._config['sync_first'] == '1':
+            return False
+
+        # only the lowest interval syncs, higher intervals are plain rotations
+        return self._config['retain'][0][0] == command and self._config['snapshot_root'] is not None
+
+    def _loadState(self):
+        if self._stateFile is None or not os.path.isfile(self._stateFile):
+            return {}
+
+        try:
+            with open(self._stateFile) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _saveState(self, state):
+        if self._stateFile is None:
+            return
+
+        tmp = f'{self._stateFile}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, self._stateFile)
+
+    def rotate(self, command):
+        root = self._config['snapshot_root']
+        retain = self._config['retain'][0][1]
+
+        oldest = os.path.join(root, f'{command}.{retain - 1}')
+        if os.path.isdir(oldest):
+            shutil.rmtree(oldest)
+
+        for index in range(retain - 2, -1, -1):
+            source = os.path.join(root, f'{command}.{index}')
+            if os.path.isdir(source):
+                os.rename(source, os.path.join(root, f'{command}.{index + 1}'))
+
+    def _linkCopy(self, source, destination, stderr):
+        # copying the contents into the directory works whether the sync already created it or not
+        os.makedirs(destination, exist_ok=True)
+        process = subprocess.run([self._config['cmd_cp'], '-al', os.path.join(source, '.'), destination],
+                                 capture_output=True, text=True, errors='replace')
+        if process.returncode != 0:
+            stderr.append(f'{source}: {process.stderr.strip()}')
+        return process.returncode
+
+    def _sync(self, point, command, stats, stderr, plan=None):
+        root = self._config['snapshot_root']
+        destination = os.path.join(root, f'{command}.0', point['dest'])
+        linkDest = os.path.join(root, f'{command}.1', point['dest'])
+        os.makedirs(destination, exist_ok=True)
+
+        start_time = time.monotonic()
+        pointDir = getSnapshotPath(self._config, point, os.path.join(root, f'{command}.0'))
+        previousDir = getSnapshotPath(self._config, point, os.path.join(root, f'{command}.1'))
+        if plan is not None and not os.path.isdir(previousDir):
+            plan = None
+
+        # nothing changed: the previous snapshot of the point is the new one, hardlinked locally
+        if plan is not None and not plan['changed']:
+            return self._linkCopy(previousDir, pointDir, stderr), time.monotonic() - start_time
+
+        rsync = getRsyncCommand(self._config, point, destination, linkDest if os.path.isdir(linkDest) else None)
+        if plan is not None:
+            # rsync only walks the changed subtrees, --delete-excluded is harmless in a fresh <command>.0
+            prefix = os.path.relpath(pointDir, destination)
+            excludes = [f'--exclude=/{os.path.normpath(os.path.join(prefix, key))}/' for key in plan['unchanged']]
+            rsync[-2:-2] = excludes
+
+        if self._throttle is not None:
+            rsync = self._throttle.wrap(rsync)
+
+        with tempfile.TemporaryFile() as errors:
+            process = subprocess.Popen(rsync, stdout=subprocess.PIPE, stderr=errors, text=True, errors='replace',
+                                       bufsize=1)
+            for line in process.stdout:
+                stats.feed(line)
+            returncode = process.wait()
+
+            errors.seek(max(0, errors.seek(0, os.SEEK_END) - 4096))
+            for line in errors.read().decode(errors='replace').splitlines()[-5:]:
+                stderr.append(f'{point["source"]}: {line}')
+
+        if plan is not None and returncode in RSYNC_OK:
+            for key in plan['unchanged']:
+                err = self._linkCopy(os.path.join(previousDir, key), os.path.join(pointDir, key), stderr)
+                if err != 0:
+                    return err, time.monotonic() - start_time
+
+        return returncode, time.monotonic() - start_time
+
+    def _lock(self, stderr):
+        lockfile = self._config['lockfile']
+        if not lockfile:
+            return True
+
+        for attempt in range(2):
+            try:
+                fd = os.open(lockfile, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            except FileExistsError:
+                try:
+                    with open(lockfile) as f:
+                        pid = int(f.read().strip() or 0)
+                except (OSError, ValueError):
+                    pid = 0
+
+                # same rules as rsnapshot: a live pid always wins, a stale lockfile only if allowed
+                try:
+                    if pid > 0:
+                        os.kill(pid, 0)
+                        stderr.append(f'lockfile {lockfile} exists, rsnapshot {pid} is still running')
+                        return False
+                except ProcessLookupError:
+                    pass
+                except PermissionError:
+                    stderr.append(f'lockfile {lockfile} exists, rsnapshot {pid} is still running')
+                    return False
+
+                if self._config['stop_on_stale_lockfile'] != '0':
+                    stderr.append(f'stale lockfile {lockfile} of pid {pid}, remove it or set stop_on_stale_lockfile 0')
+                    return False
+
+                os.unlink(lockfile)
+                continue
+
+            with os.fdopen(fd, 'w') as f:
+                f.write(f'{os.getpid()}\n')
+            return True
+
+        return False
+
+    def _unlock(self):
+        try:
+            os.unlink(self._config['lockfile'])
+        except OSError:
+            pass
+
+    def run(self, command, stats, stderr, progress, progress_interval):
+        if not self._lock(stderr):
+            return 1
+
+        try:
+            return self._run(command, stats, stderr, progress, progress_interval)
+        finally:
+            if self._config['lockfile']:
+                self._unlock()
+
+    def _run(self, command, stats, stderr, progress, progress_interval):
+        state = self._loadState()
+        points = sorted(self._config['backup'], key=lambda point: state.get(point['source'], 0), reverse=True)
+
+        fingerprints, plans = {}, {}
+        if self._changes is not None:
+            previous = _identity(os.path.join(self._config['snapshot_root'], f'{command}.0'))
+            fingerprints, plans, walk = self._changes.scan(points, previous)
+            self.changeSummary = {'points': len(points), 'walk': walk, 'saved': 0.0,
+                                  'skipped': len([plan for plan in plans.values() if plan and not plan['changed']]),
+                                  'narrowed': len([plan for plan in plans.values() if plan and plan['changed']])}
+
+        self.rotate(command)
+        snapshot = os.path.join(self._config['snapshot_root'], f'{command}.0')
+        os.makedirs(snapshot, exist_ok=True)
+
+        err = 0
+        with ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix='shard') as executor:
+            pending = {executor.submit(self._sync, point, command, stats, stderr, plans.get(point['source'])): point
+                       for point in points}
+            while pending:
+                done, _ = wait(pending, timeout=progress_interval, return_when=FIRST_COMPLETED)
+                if not done:
+                    progress()
+                    continue
+
+                for future in done:
+                    point = pending.pop(future)
+                    returncode, elapsed = future.result()
+                    # the shard order and the saved time estimate both want the duration of a full sync
+                    if plans.get(point['source']) is None:
+                        state[point['source']] = elapsed
+                    elif point['source'] in state:
+                        self.changeSummary['saved'] += max(0.0, state[point['source']] - elapsed)
+                    if returncode not in RSYNC_OK:
+                        stderr.append(f'rsync {point["source"]} returned {returncode}')
+                        err = returncode
+
+        os.utime(snapshot)
+        self._saveState(state)
+        if self._changes is not None and err == 0:
+            self._changes.save(fingerprints, _identity(snapshot))
+        return err
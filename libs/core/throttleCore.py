@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+# Copyright 2023 WebEye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import datetime
+import json
+import os
+import re
+import shutil
+import threading
+
+PSI_FILE = '/proc/pressure/io'
+CPU_PERIOD = 100000
+
+
+def readPressure(filename=PSI_FILE):
+    try:
+        with open(filename) as f:
+            for line in f:
+                if line.startswith('some '):
+                    return float(dict(field.split('=') for field in line.split()[1:])['avg10'])
+    except (OSError, ValueError, KeyError):
+        pass
+
+    return None
+
+
+def getBlockDevice(path):
+    st = os.stat(path)
+    device = f'{os.major(st.st_dev)}:{os.minor(st.st_dev)}'
+    # io.max only takes whole disks, a partition is throttled through its parent
+    sysPath = os.path.realpath(f'/sys/dev/block/{device}')
+    if os.path.isfile(os.path.join(sysPath, 'partition')):
+        with open(os.path.join(os.path.dirname(sysPath), 'dev')) as f:
+            device = f.read().strip()
+
+    return device
+
+
+def selectPolicy(throttleDict, now=None):
+    now = now or datetime.datetime.now()
+    minute = now.hour * 60 + now.minute
+    name = throttleDict.get('default', 'default')
+    for window in throttleDict.get('windows', []):
+        start, end = [int(part[:2]) * 60 + int(part[3:]) for part in (window['from'], window['to'])]
+        # a window may wrap around midnight
+        if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+            name = window['policy']
+            break
+
+    return name, throttleDict.get('policies', {}).get(name, {})
+
+
+def recordThroughput(filename, entry):
+    with open(filename, 'a') as f:
+        f.write(json.dumps(entry, sort_keys=True) + '\n')
+
+
+def getPolicyThroughput(filename, last=20):
+    runs = {}
+    if not os.path.isfile(filename):
+        return {}
+
+    with open(filename) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            runs.setdefault(entry['policy'], []).append(entry['throughput'])
+
+    return {policy: (len(values), sum(values[-last:]) / len(values[-last:])) for policy, values in runs.items()}
+
+
+class throttleCore:
+
+    def __init__(self, name, policy, cgroupRoot=None, device=None, psiTarget=10.0, interval=5.0, minScale=0.1,
+                 logger=None, instance=None):
+        self.name = name
+        self._instance = re.sub(r'[^\w.-]', '_', instance) if instance else None
+        self._nice = policy.get('nice')
+        self._ioniceClass = policy.get('ionice_class')
+        self._ioniceLevel = policy.get('ionice_level', 7)
+        self._rbps = policy.get('io_max', {}).get('rbps', 0)
+        self._wbps = policy.get('io_max', {}).get('wbps', 0)
+        self._cpu = policy.get('cpu_max', 0)
+        self._adaptive = policy.get('adaptive', False)
+        self._cgroupRoot = cgroupRoot
+        self._device = device
+        self._psiTarget = psiTarget
+        self._interval = interval
+        self._minScale = minScale
+        self._logger = logger
+
+        self._cgroup = None
+        self._cgroupUsed = False
+        self._scale = 1.0
+        self._stop = threading.Event()
+        self._thread = None
+        self._samples = []
+        self._scales = []
+        self._adjustments = 0
+
+    def wrap(self, command):
+        prefix = []
+        if self._ioniceClass is not None and shutil.which('ionice'):
+            prefix += ['ionice', '-c', str(self._ioniceClass)]
+            if self._ioniceClass == 2:
+                prefix += ['-n', str(self._ioniceLevel)]
+        if self._nice and shutil.which('nice'):
+            prefix += ['nice', '-n', str(self._nice)]
+
+        # the shell joins the cgroup and execs the command in place, so nothing runs unthrottled and no python
+        # code runs between fork and exec of a threaded process
+        if self._cgroup is not None:
+            prefix = ['sh', '-c', 'echo $$ > "$0" && exec "$@"', os.path.join(self._cgroup, 'cgroup.procs')] + prefix
+
+        return prefix + command
+
+    def _hasLimits(self):
+        return bool(self._cpu or (self._device and (self._rbps or self._wbps)))
+
+    def _writeLimits(self):
+        if self._device and (self._rbps or self._wbps):
+            rbps = int(self._rbps * self._scale) if self._rbps else 'max'
+            wbps = int(self._wbps * self._scale) if self._wbps else 'max'
+            with open(os.path.join(self._cgroup, 'io.max'), 'w') as f:
+                f.write(f'{self._device} rbps={rbps} wbps={wbps}')
+
+        if self._cpu:
+            with open(os.path.join(self._cgroup, 'cpu.max'), 'w') as f:
+                f.write(f'{max(1000, int(self._cpu / 100 * CPU_PERIOD * self._scale))} {CPU_PERIOD}')
+
+    def _setupCgroup(self):
+        if not self._cgroupRoot or not self._hasLimits():
+            return
+        if not os.path.isfile(os.path.join(self._cgroupRoot, 'cgroup.controllers')):
+            self._logger.debug(f'{self._cgroupRoot} is no cgroup v2 directory, using nice and ionice only')
+            return
+
+        try:
+            with open(os.path.join(self._cgroupRoot, 'cgroup.subtree_control'), 'w') as f:
+                f.write('+io +cpu')
+        except OSError:
+            pass
+
+        try:
+            # fleet targets run in the same process, the target name keeps their cgroups apart
+            suffix = f'{self._instance}-{os.getpid()}' if self._instance else str(os.getpid())
+            self._cgroup = os.path.join(self._cgroupRoot, f'ipmi-backup-{suffix}')
+            os.makedirs(self._cgroup, exist_ok=True)
+            self._writeLimits()
+            self._cgroupUsed = True
+        except OSError as ex:
+            self._logger.error(f'unable to set up cgroup {self._cgroup}: {ex}')
+            self._removeCgroup()
+
+    def _removeCgroup(self):
+        if self._cgroup is None:
+            return
+
+        try:
+            os.rmdir(self._cgroup)
+        except OSError:
+            pass
+        self._cgroup = None
+
+    def _feedback(self):
+        while not self._stop.wait(self._interval):
+            pressure = readPressure()
+            if pressure is None:
+                continue
+
+            self._samples.append(pressure)
+            scale = self._scale
+            if pressure > self._psiTarget:
+                scale = max(self._minScale, self._scale * 0.7)
+            elif pressure < self._psiTarget / 2:
+                scale = min(1.0, self._scale * 1.25)
+            self._scales.append(scale)
+            if scale == self._scale:
+                continue
+
+            self._logger.debug(f'io pressure {pressure:.1f}%, limits of {self.name} at {scale * 100:.0f}%')
+            self._scale = scale
+            self._adjustments += 1
+            try:
+                self._writeLimits()
+            except OSError as ex:
+                self._logger.error(f'unable to adjust {self._cgroup}: {ex}')
+
+    def start(self):
+        self._setupCgroup()
+        if self._adaptive and self._cgroup is not None and readPressure() is not None:
+            self._thread = threading.Thread(target=self._feedback, daemon=True)
+            self._thread.start()
+        elif self._adaptive:
+            self._logger.debug('adaptive throttling needs a cgroup and /proc/pressure/io, limits stay fixed')
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self._removeCgroup()
+
+        return {
+            'policy': self.name,
+            'cgroup': self._cgroupUsed,
+            'psi_mean': sum(self._samples) / len(self._samples) if self._samples else readPressure(),
+            'scale_mean': sum(self._scales) / len(self._scales) if self._scales else self._scale,
+            'adjustments': self._adjustments
+        }
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# Copyright 2023 WebEye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+TRASH_FOLDER = '_trash'
+
+
+def _clearDirectory(path):
+    subdirs = []
+    files = 0
+    freed = 0
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+                continue
+
+            st = entry.stat(follow_symlinks=False)
+            os.unlink(entry.path)
+            files += 1
+            # a hardlink shared with a younger rotation frees nothing
+            if st.st_nlink == 1:
+                freed += st.st_blocks * 512
+
+    return subdirs, files, freed
+
+
+class trashCore:
+
+    def __init__(self, root, workers=8):
+        self._trash = os.path.join(root, TRASH_FOLDER)
+        self._workers = workers
+
+    def expire(self, path):
+        os.makedirs(self._trash, exist_ok=True)
+        trashPath = os.path.join(self._trash, f'{os.path.basename(path)}.{time.time_ns()}')
+        os.rename(path, trashPath)
+        return trashPath
+
+    @staticmethod
+    def restore(trashPath, path):
+        os.rename(trashPath, path)
+
+    def backlog(self):
+        try:
+            return sorted(entry.path for entry in os.scandir(self._trash) if entry.is_dir(follow_symlinks=False))
+        except FileNotFoundError:
+            return []
+
+    def reclaim(self, maxTime=0):
+        result = {'rotations': 0, 'files': 0, 'freed': 0, 'errors': 0}
+        start = time.monotonic()
+        for rotation in self.backlog():
+            if maxTime and time.monotonic() - start >= maxTime:
+                break
+
+            directories = [rotation]
+            with ThreadPoolExecutor(max_workers=self._workers) as executor:
+                pending = {executor.submit(_clearDirectory, rotation)}
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        try:
+                            subdirs, files, freed = future.result()
+                        except OSError:
+                            result['errors'] += 1
+                            continue
+
+                        result['files'] += files
+                        result['freed'] += freed
+                        directories += subdirs
+                        # running out of time leaves the rest of the tree for the next reclaim
+                        if not maxTime or time.monotonic() - start < maxTime:
+                            for subdir in subdirs:
+                                pending.add(executor.submit(_clearDirectory, subdir))
+
+            for directory in sorted(directories, key=lambda d: d.count(os.sep), reverse=True):
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    pass
+
+            if not os.path.exists(rotation):
+                result['rotations'] += 1
+
+        result['elapsed'] = time.monotonic() - start
+        result['rate'] = result['files'] / result['elapsed'] if result['elapsed'] > 0 else 0
+        result['backlog'] = len(self.backlog())
+        return result
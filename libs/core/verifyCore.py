@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+# Copyright 2023 WebEye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import os
+import random
+import stat
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from libs.common.fsTools import walkFiles
+
+
+class _throttle:
+
+    def __init__(self, rate):
+        self._rate = rate
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def consume(self, size):
+        if not self._rate:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            self._next = max(self._next, now) + size / self._rate
+            delay = self._next - now - 1.0
+
+        # allow a one second burst, beyond that every reader waits for its share
+        if delay > 0:
+            time.sleep(delay)
+
+
+class verifyCore:
+
+    def __init__(self, workers=4, sample=1.0, blockSize=4 * 1024 * 1024, maxRate=0):
+        self._workers = workers
+        self._sample = sample
+        self._blockSize = blockSize
+        self._throttle = _throttle(maxRate)
+
+    def _compareContent(self, source, snapshot):
+        with open(source, 'rb') as a, open(snapshot, 'rb') as b:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(a.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                os.posix_fadvise(b.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            while True:
+                blockA = a.read(self._blockSize)
+                blockB = b.read(self._blockSize)
+                self._throttle.consume(len(blockA))
+                if blockA != blockB:
+                    return False
+                if not blockA:
+                    return True
+
+    def _verifyFile(self, source, snapshot, snapshotStat):
+        try:
+            sourceStat = os.lstat(source)
+        except FileNotFoundError:
+            return 'missing', 0
+        except OSError:
+            return 'error', 0
+
+        if (sourceStat.st_size != snapshotStat.st_size or int(sourceStat.st_mtime) != int(snapshotStat.st_mtime) or
+                stat.S_IMODE(sourceStat.st_mode) != stat.S_IMODE(snapshotStat.st_mode)):
+            return 'metadata', 0
+
+        try:
+            same = self._compareContent(source, snapshot)
+        except OSError:
+            return 'error', 0
+
+        return 'ok' if same else 'content', sourceStat.st_size
+
+    def _findUnsynced(self, sourceRoot, synced, excluded, scanWorkers):
+        def prune(directory):
+            return excluded is not None and excluded(os.path.relpath(directory, sourceRoot), True)
+
+        for source, sourceStat in walkFiles(sourceRoot, scanWorkers, prune):
+            if not stat.S_ISREG(sourceStat.st_mode):
+                continue
+
+            relative = os.path.relpath(source, sourceRoot)
+            if relative not in synced and (excluded is None or not excluded(relative, False)):
+                yield relative
+
+    def run(self, pairs, scanWorkers=8, maxReported=20):
+        result = {'files': 0, 'bytes': 0, 'mismatches': 0, 'missing': 0, 'unsynced': 0, 'errors': 0, 'reported': []}
+        start = time.monotonic()
+
+        def report(relative, outcome):
+            if len(result['reported']) < maxReported:
+                result['reported'].append((relative, outcome))
+
+        def collect(future, relative):
+            outcome, size = future.result()
+            result['files'] += 1
+            result['bytes'] += size
+            if outcome in ('metadata', 'content'):
+                result['mismatches'] += 1
+            elif outcome == 'missing':
+                result['missing'] += 1
+            elif outcome == 'error':
+                result['errors'] += 1
+            if outcome != 'ok':
+                report(relative, outcome)
+
+        # the snapshot side is sampled for the content compare, every file it holds is remembered so the
+        # source side walk finds what never made it into the snapshot
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            pending = {}
+            for sourceRoot, snapshotRoot, excluded in pairs:
+                synced = set()
+                if os.path.isdir(snapshotRoot):
+                    for snapshot, snapshotStat in walkFiles(snapshotRoot, scanWorkers):
+                        if not stat.S_ISREG(snapshotStat.st_mode):
+                            continue
+
+                        relative = os.path.relpath(snapshot, snapshotRoot)
+                        synced.add(relative)
+                        if random.random() >= self._sample:
+                            continue
+
+                        future = executor.submit(self._verifyFile, os.path.join(sourceRoot, relative), snapshot,
+                                                 snapshotStat)
+                        pending[future] = relative
+                        if len(pending) >= self._workers * 4:
+                            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                            for future in done:
+                                collect(future, pending.pop(future))
+
+                if os.path.isdir(sourceRoot):
+                    for relative in self._findUnsynced(sourceRoot, synced, excluded, scanWorkers):
+                        result['unsynced'] += 1
+                        report(relative, 'unsynced')
+
+            for future in list(pending):
+                collect(future, pending.pop(future))
+
+        result['elapsed'] = time.monotonic() - start
+        result['throughput'] = result['bytes'] / result['elapsed'] if result['elapsed'] > 0 else 0
+        return result
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+# Copyright 2023 WebEye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import socket
+import subprocess
+
+from libs.common.netTools import canPing
+
+
+class wolCore:
+
+    def __init__(self, mac, host, broadcast='255.255.255.255', port=9, offCommand=None):
+        self._mac = bytes.fromhex(mac.replace(':', '').replace('-', ''))
+        if len(self._mac) != 6:
+            raise ValueError(f'invalid mac address {mac}')
+        self._host = host
+        self._broadcast = broadcast
+        self._port = port
+        self._offCommand = offCommand
+
+    def close(self):
+        pass
+
+    def getChassisPowerStatus(self):
+        # wake on lan has no way to ask, a host that answers pings is on
+        try:
+            return 0, 'on' if canPing(self._host) else 'off'
+        except FileNotFoundError as ex:
+            return -1, ex
+
+    def setChassisPower(self, status):
+        if status == 'on':
+            try:
+                with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+                    sock.sendto(b'\xff' * 6 + self._mac * 16, (self._broadcast, self._port))
+            except OSError as ex:
+                return -1, str(ex)
+            return 0, 'on'
+
+        if status in ('soft', 'off') and self._offCommand:
+            try:
+                process = subprocess.run(self._offCommand, capture_output=True, text=True)
+            except FileNotFoundError as ex:
+                return -1, ex
+            if process.returncode != 0:
+                return process.returncode, process.stderr.split(chr(10))[0]
+            return 0, status
+
+        return -1, f'wake on lan can not switch to {status}'
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+# Copyright 2023 WebEye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import datetime
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+from collections import deque
+
+from libs.backupCore import backupCore
+from libs.common.cronTools import cronSchedule
+from libs.common.logTools import setupLogging, flushLogging, shutdownLogging
+
+
+class _controlHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        line = self.rfile.readline().decode(errors='replace').strip()
+        response = self.server.daemon.control(line)
+        self.wfile.write((json.dumps(response, default=str) + '\n').encode())
+
+
+class _controlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class daemonCore:
+
+    def __init__(self, config):
+        self._config = config
+
+        daemonDict = self._config.get('daemon', {})
+        self._socketPath = daemonDict.get('socket', '/run/ipmi-backup.sock')
+        self._jobs = {}
+        for job in daemonDict.get('jobs', []):
+            self._jobs[job['name']] = {
+                'schedule': cronSchedule(job['schedule']),
+                'commands': job.get('command', job['name']),
+                'next_run': None,
+                'last_run': None,
+                'last_status': None,
+                'last_duration': None,
+                'slot': None
+            }
+
+        self._logger = setupLogging(self._config)
+        self._core = backupCore(self._config, prefix='daemon')
+
+        self._condition = threading.Condition()
+        self._queue = deque()
+        self._running = None
+        self._stopping = False
+        self._server = None
+
+    def enqueue(self, name, reason, slot=None):
+        with self._condition:
+            if name not in self._jobs:
+                return False, f'unknown job {name}'
+
+            # a job that is already waiting or running is not queued twice
+            if name in self._queue or name == self._running:
+                return False, f'job {name} is already queued or running'
+
+            self._queue.append(name)
+            self._jobs[name]['slot'] = slot
+            self._logger.info(f'queued job {name} ({reason})')
+            self._condition.notify_all()
+            return True, f'job {name} queued'
+
+    def getStatus(self):
+        with self._condition:
+            return {
+                'pid': os.getpid(),
+                'running': self._running,
+                'queue': list(self._queue),
+                'jobs': {name: {key: value for key, value in job.items() if key != 'schedule'}
+                         for name, job in self._jobs.items()}
+            }
+
+    def control(self, line):
+        action, _, argument = line.partition(' ')
+        if action == 'status':
+            return self.getStatus()
+        elif action == 'queue':
+            with self._condition:
+                return {'running': self._running, 'queue': list(self._queue)}
+        elif action == 'run':
+            ok, message = self.enqueue(argument.strip(), 'requested')
+            return {'ok': ok, 'message': message}
+
+        return {'ok': False, 'message': f'unknown command "{line}"'}
+
+    def worker(self):
+        while True:
+            with self._condition:
+                while not self._queue and not self._stopping:
+                    self._condition.wait()
+                if self._stopping:
+                    return
+                name = self._queue.popleft()
+                self._running = name
+
+            job = self._jobs[name]
+            self._logger.info(f'starting job {name}')
+            start_time = time.monotonic()
+            try:
+                status = self._core.process(job['commands'], job['slot'])
+            except Exception:
+                self._logger.exception(f'job {name} failed')
+                status = 1
+
+            with self._condition:
+                self._running = None
+                job['last_run'] = datetime.datetime.now()
+                job['last_status'] = status
+                job['last_duration'] = time.monotonic() - start_time
+
+            self._logger.info(f'job {name} finished with status {status}')
+            flushLogging()
+
+    def scheduler(self):
+        with self._condition:
+            now = datetime.datetime.now()
+            for job in self._jobs.values():
+                job['next_run'] = job['schedule'].next(now)
+
+            while not self._stopping:
+                now = datetime.datetime.now()
+                for name, job in self._jobs.items():
+                    if job['next_run'] <= now:
+                        slot = f'{name}@{job["next_run"]:%Y-%m-%dT%H:%M}'
+                        job['next_run'] = job['schedule'].next(now)
+                        self.enqueue(name, 'scheduled', slot)
+
+                upcoming = min([job['next_run'] for job in self._jobs.values()], default=None)
+                timeout = 60 if upcoming is None else max(0.0, (upcoming - datetime.datetime.now()).total_seconds())
+                self._condition.wait(min(timeout, 60))
+
+    def stop(self, *_):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+
+    def startControlServer(self):
+        if os.path.exists(self._socketPath):
+            os.unlink(self._socketPath)
+
+        self._server = _controlServer(self._socketPath, _controlHandler)
+        self._server.daemon = self
+        os.chmod(self._socketPath, 0o600)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def shuttingDown(self, status):
+        self._logger.info('Shutting down daemon core...')
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            if os.path.exists(self._socketPath):
+                os.unlink(self._socketPath)
+
+        self._core.close()
+        shutdownLogging()
+        sys.exit(status)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        self._logger.info(f'starting daemon core with {len(self._jobs)} jobs, control socket {self._socketPath}')
+        try:
+            self.startControlServer()
+        except OSError as ex:
+            self._logger.critical(f'unable to open control socket {self._socketPath}: {ex}')
+            self.shuttingDown(1)
+
+        worker = threading.Thread(target=self.worker, name='worker')
+        worker.start()
+        self.scheduler()
+        worker.join()
+        self.shuttingDown(0)
+
+
+def sendControl(socketPath, line):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socketPath)
+        sock.sendall((line + '\n').encode())
+        with sock.makefile('rb') as f:
+            return json.loads(f.readline())
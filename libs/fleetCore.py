@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# Copyright 2023 WebEye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from libs.backupCore import backupCore
+from libs.common.logTools import setupLogging, shutdownLogging
+
+
+class fleetCore:
+
+    def __init__(self, config, targets):
+        self._config = config
+        self._targets = targets
+
+        fleetDict = self._config.get('fleet', {})
+        self._workers = fleetDict.get('workers', 4)
+        self._slots = fleetDict.get('rsnapshot_slots', 2)
+        self._rsnapshotSlots = threading.BoundedSemaphore(self._slots)
+
+        self._logger = setupLogging(self._config)
+
+    def runTarget(self, target):
+        name = target['name']
+        core = None
+        try:
+            core = backupCore(target, name, self._rsnapshotSlots)
+            return core.process()
+        except Exception:
+            self._logger.exception(f'[{name}] backup failed')
+            return 1
+        finally:
+            if core is not None:
+                core.close()
+
+    def shuttingDown(self, status):
+        self._logger.info('Shutting down fleet core...')
+        shutdownLogging()
+        sys.exit(status)
+
+    def run(self):
+        self._logger.info(f'starting fleet core with {len(self._targets)} targets '
+                          f'({self._workers} workers, {self._slots} rsnapshot slots)...')
+        start_time = time.time()
+
+        with ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix='target') as executor:
+            results = list(executor.map(self.runTarget, self._targets))
+
+        failed = [target['name'] for target, status in zip(self._targets, results) if status != 0]
+        self._logger.info(f'fleet finished in {int(time.time() - start_time)} seconds, '
+                          f'{len(self._targets) - len(failed)} succeeded, {len(failed)} failed')
+        if failed:
+            self._logger.critical(f'failed targets: {", ".join(failed)}')
+
+        self.shuttingDown(1 if failed else 0)
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+# Copyright 2023 WebEye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import email
+import email.policy
+import gzip
+import logging
+import time
+
+import pytest
+
+from libs.common.BufferingSMTPHandler import BufferingSMTPHandler
+from tools.fakeSmtp import fakeSmtp
+
+
+@pytest.fixture
+def mail():
+    servers = []
+    handlers = []
+
+    def create(capacity=1000, delay=0.0, **kwargs):
+        server = fakeSmtp(delay=delay).start()
+        handler = BufferingSMTPHandler(server.server_address[0], 'a@localhost', ['b@localhost'], 'test', capacity,
+                                       **kwargs)
+        handler.mailport = server.server_address[1]
+        logger = logging.Logger('mail')
+        logger.addHandler(handler)
+        servers.append(server)
+        handlers.append(handler)
+        return server, handler, logger
+
+    yield create
+    for handler in handlers:
+        handler.close()
+    for server in servers:
+        server.stop()
+
+
+def waitFor(server, messages, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while server.messages < messages and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return server.messages
+
+
+def getMessages(server):
+    return [email.message_from_bytes(data, policy=email.policy.default) for data in server.received]
+
+
+def getContent(server):
+    return '\n'.join(msg.get_content() for msg in getMessages(server))
+
+
+def test_connection_reused_across_flushes(mail):
+    server, handler, logger = mail()
+
+    for batch in range(3):
+        logger.info('batch %d', batch)
+        handler.flush()
+        assert waitFor(server, batch + 1) == batch + 1
+
+    assert server.connections == 1
+    for batch, msg in enumerate(getMessages(server)):
+        assert f'batch {batch}' in msg.get_content()
+
+
+def test_capacity_triggers_flush(mail):
+    server, _, logger = mail(capacity=10)
+
+    for index in range(25):
+        logger.info('line %d', index)
+
+    # two full buffers went out, possibly merged into one mail, the rest waits for the next flush
+    deadline = time.monotonic() + 5.0
+    while 'line 19' not in getContent(server) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    content = getContent(server)
+    assert all(f'line {index}\r\n' in content for index in range(20))
+    assert 'line 20' not in content
+    assert server.connections == 1
+
+
+def test_digest_and_gzip_attachment(mail):
+    server, handler, logger = mail(digestSize=400)
+
+    for index in range(50):
+        logger.info('rsync progress line %d', index)
+    handler.close()
+
+    [msg] = getMessages(server)
+    digest = msg.get_body(('plain',)).get_content()
+    assert 'rsync progress line 0' in digest
+    assert 'rsync progress line 49' not in digest
+    assert '50 lines in total' in digest
+
+    [attachment] = list(msg.iter_attachments())
+    assert attachment.get_filename() == 'ipmi-backup.log.gz'
+    assert attachment.get_content_type() == 'application/gzip'
+    lines = gzip.decompress(attachment.get_content()).decode().split('\r\n')
+    assert len(lines) == 50
+    assert lines[-1].endswith('rsync progress line 49')
+
+
+def test_small_log_has_no_attachment(mail):
+    server, handler, logger = mail()
+
+    logger.info('all done')
+    handler.close()
+
+    [msg] = getMessages(server)
+    assert not list(msg.iter_attachments())
+    assert msg.get_content().rstrip().endswith('all done')
+
+
+def test_close_delivers_queued_batch(mail):
+    # a slow server keeps the worker busy, so the later flushes are still queued when close() is called
+    server, handler, logger = mail(delay=0.2)
+
+    for batch in range(4):
+        logger.info('batch %d', batch)
+        handler.flush()
+    logger.info('unflushed')
+    handler.close()
+
+    content = getContent(server)
+    for batch in range(4):
+        assert f'batch {batch}' in content
+    assert 'unflushed' in content
+    assert server.messages < 5
+    assert not handler._worker.is_alive()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# Copyright 2023 WebEye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import os
+
+import pytest
+
+from libs.backupCore import backupCore
+
+
+def createCore(tmp_path, conf):
+    script = tmp_path / 'rsnapshot.conf'
+    script.write_text(f'snapshot_root\t{tmp_path}/\nretain\tdaily\t7\nretain\tweekly\t4\nretain\tmonthly\t3\n'
+                      f'{conf}backup\t/srv/\t./\n')
+    config = {
+        'ipmi': {'host': '127.0.0.1', 'user': 'admin', 'password': 'secret', 'backend': 'ipmitool'},
+        'server': {'host': '127.0.0.1', 'timeout': 10},
+        'rsnapshot': {'script': str(script), 'command': 'daily', 'root_folder': str(tmp_path)}
+    }
+    return backupCore(config, 'test')
+
+
+@pytest.mark.parametrize('commands, expected', [
+    ('daily', ['daily']),
+    ('daily,weekly', ['weekly', 'daily']),
+    ('daily,monthly,weekly', ['monthly', 'weekly', 'daily']),
+])
+def test_intervals_rotate_highest_first_and_the_lowest_syncs(tmp_path, commands, expected):
+    core = createCore(tmp_path, '')
+
+    assert core.getSnapshotCommands(commands) == (expected, 'daily')
+
+
+@pytest.mark.parametrize('commands, expected', [
+    ('sync,daily,weekly', ['sync', 'weekly', 'daily']),
+    ('weekly,daily,sync', ['sync', 'weekly', 'daily']),
+    ('daily', ['daily']),
+])
+def test_sync_first_syncs_before_any_rotation(tmp_path, commands, expected):
+    core = createCore(tmp_path, 'sync_first\t1\n')
+
+    assert core.getSnapshotCommands(commands) == (expected, 'sync')
+
+
+def test_sync_first_snapshot_is_the_sync_directory(tmp_path):
+    core = createCore(tmp_path, 'sync_first\t1\n')
+
+    assert core.getSnapshotDirs('sync') == (os.path.join(tmp_path, '.sync'), os.path.join(tmp_path, 'daily.0'))
+    core._executed.add('daily')
+    assert core.getSnapshotDirs('sync') == (os.path.join(tmp_path, '.sync'), os.path.join(tmp_path, 'daily.1'))
+    assert core.getSnapshotDirs('weekly') == (os.path.join(tmp_path, 'weekly.0'), os.path.join(tmp_path, 'weekly.1'))
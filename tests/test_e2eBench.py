@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+# Copyright 2023 WebEye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import json
+import os
+import shutil
+
+import pytest
+
+from libs.backupCore import backupCore
+from libs.core.dedupeCore import dedupeCore
+from libs.core.trashCore import trashCore
+from tools.e2eBench import createBench, createSource, changeSource
+
+
+@pytest.fixture
+def bench(tmp_path, monkeypatch):
+    started = []
+
+    def create(fail=None, running=True, files=20, **kwargs):
+        config, bmc, environ = createBench(str(tmp_path), 0.2, **kwargs)
+        for key, value in environ.items():
+            monkeypatch.setenv(key, value)
+        if fail is not None:
+            monkeypatch.setenv(f'FAKE_FAIL_{fail.upper()}', '1')
+
+        if files:
+            createSource(config['client']['mountpoint'], files, files * 1024)
+        if running:
+            bmc.start()
+            started.append(bmc)
+        return config, bmc
+
+    yield create
+    for bmc in started:
+        bmc.stop()
+
+
+def runCore(config):
+    core = backupCore(config, 'test')
+    try:
+        status = core.process()
+    finally:
+        core.close()
+    return status, core.lastRun
+
+
+def test_run_powers_on_snapshots_and_powers_off(bench):
+    config, bmc = bench()
+    status, record = runCore(config)
+
+    assert status == 0
+    assert record['failed_phase'] is None
+    assert bmc.power == 'off'
+    for phase in ['ipmi_status', 'power_on', 'time_to_ready', 'mount', 'rsnapshot', 'umount', 'power_off']:
+        assert record['phases'][phase]['outcome'] == 'ok', phase
+    snapshot = os.path.join(config['rsnapshot']['root_folder'], 'daily.0')
+    assert sum(len(files) for _, _, files in os.walk(snapshot)) == 20
+
+
+def test_second_run_rotates_and_links_unchanged_files(bench):
+    config, _ = bench()
+    assert runCore(config)[0] == 0
+    changeSource(config['client']['mountpoint'], 0.25, 1)
+    status, record = runCore(config)
+
+    assert status == 0
+    root = config['rsnapshot']['root_folder']
+    assert os.path.isdir(os.path.join(root, 'daily.1'))
+    linked = [filename for dirpath, _, filenames in os.walk(os.path.join(root, 'daily.0'))
+              for filename in filenames if os.stat(os.path.join(dirpath, filename)).st_nlink > 1]
+    assert len(linked) == 15
+
+
+def test_failed_mount_leaves_the_server_on(bench):
+    config, bmc = bench(fail='mount')
+    status, record = runCore(config)
+
+    assert status == 1
+    assert record['failed_phase'] == 'mount'
+    assert 'power_off' not in record['phases']
+    assert 'rsnapshot' not in record['phases']
+    assert bmc.power == 'on'
+
+
+def test_failed_rsnapshot_still_unmounts_and_powers_off(bench):
+    config, bmc = bench(fail='rsnapshot')
+    status, record = runCore(config)
+
+    assert status == 1
+    assert record['failed_phase'] == 'rsnapshot'
+    assert record['phases']['umount']['outcome'] == 'ok'
+    assert record['phases']['power_off']['outcome'] == 'ok'
+    assert bmc.power == 'off'
+
+
+def test_failed_umount_leaves_the_server_on(bench):
+    config, bmc = bench(fail='umount')
+    status, record = runCore(config)
+
+    assert status == 1
+    assert record['failed_phase'] == 'umount'
+    assert 'power_off' not in record['phases']
+    assert bmc.power == 'on'
+
+
+def test_server_that_never_answers_times_out(bench):
+    config, bmc = bench(fail='ping', timeout=1)
+    status, record = runCore(config)
+
+    assert status == 1
+    assert record['failed_phase'] == 'time_to_ready'
+    assert 'mount' not in record['phases']
+
+
+def test_unreachable_bmc_fails_before_power_on(bench):
+    config, bmc = bench(running=False)
+    status, record = runCore(config)
+
+    assert status == 1
+    assert record['failed_phase'] == 'ipmi_status'
+    assert 'power_on' not in record['phases']
+    assert bmc.power == 'off'
+
+
+def test_server_already_on_is_not_touched(bench):
+    config, bmc = bench(fail='ping')
+    bmc.power = 'on'
+    status, record = runCore(config)
+
+    assert status == 1
+    assert 'power_on' not in record['phases']
+    assert bmc.power == 'on'
+
+
+def writeTree(root, files):
+    for name, content in files.items():
+        path = os.path.join(root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(content)
+
+
+def rewrite(path, content):
+    # same size, new content, a later mtime, and the directory itself stays untouched
+    st = os.stat(path)
+    with open(path, 'r+') as f:
+        f.write(content)
+    os.utime(path, (st.st_atime, st.st_mtime + 2))
+
+
+def readRsyncLog():
+    with open(os.path.join(os.environ['FAKE_STATE'], 'rsync.log')) as f:
+        return [json.loads(line) for line in f]
+
+
+SHARD_TREE = {'p1/top': 'p1 top', 'p1/a/1': 'p1 a 1', 'p1/a/2': 'p1 a 2', 'p1/b/1': 'p1 b 1',
+              'p2/top': 'p2 top', 'p2/a/1': 'p2 a 1', 'p2/b/1': 'p2 b 1', 'p2/b/2': 'p2 b 2'}
+
+
+def shardPath(config, rotation, name):
+    # rsnapshot's default --relative layout: <rotation>/<dest>/<full source path>
+    source = config['client']['mountpoint']
+    return os.path.join(config['rsnapshot']['root_folder'], rotation, 'localhost', source.lstrip('/'), name)
+
+
+def test_sharded_rotation_links_unchanged_files_at_the_rsnapshot_path(bench):
+    config, _ = bench(files=0, points=['p1', 'p2'], workers=2)
+    writeTree(config['client']['mountpoint'], SHARD_TREE)
+    assert runCore(config)[0] == 0
+    rewrite(os.path.join(config['client']['mountpoint'], 'p1/a/1'), 'P1 A 1')
+    status, record = runCore(config)
+
+    assert status == 0
+    assert record['failed_phase'] is None
+    assert len(readRsyncLog()) == 4
+    for name in SHARD_TREE:
+        current, previous = shardPath(config, 'daily.0', name), shardPath(config, 'daily.1', name)
+        assert os.path.isfile(current) and os.path.isfile(previous), name
+        assert os.path.samefile(current, previous) == (name != 'p1/a/1'), name
+    with open(shardPath(config, 'daily.0', 'p1/a/1')) as f:
+        assert f.read() == 'P1 A 1'
+
+
+def test_sharded_sync_waits_for_a_running_rsnapshot(bench, tmp_path):
+    lockfile = tmp_path / 'rsnapshot.pid'
+    lockfile.write_text(f'{os.getpid()}\n')
+    config, _ = bench(files=0, points=['p1', 'p2'], workers=2, rsnapshotConf=f'lockfile\t{lockfile}\n')
+    writeTree(config['client']['mountpoint'], SHARD_TREE)
+    status, record = runCore(config)
+
+    assert status == 1
+    assert record['failed_phase'] == 'rsnapshot'
+    assert not os.path.exists(os.path.join(config['rsnapshot']['root_folder'], 'daily.0'))
+    assert lockfile.read_text() == f'{os.getpid()}\n'
+
+
+def test_sharded_sync_removes_its_lockfile(bench, tmp_path):
+    lockfile = tmp_path / 'rsnapshot.pid'
+    config, _ = bench(files=0, points=['p1', 'p2'], workers=2, rsnapshotConf=f'lockfile\t{lockfile}\n')
+    writeTree(config['client']['mountpoint'], SHARD_TREE)
+
+    assert runCore(config)[0] == 0
+    assert not lockfile.exists()
+
+
+def runChanged(bench, change):
+    config, _ = bench(files=0, points=['p1', 'p2'], workers=2, changes=True)
+    source = config['client']['mountpoint']
+    writeTree(source, SHARD_TREE)
+    assert runCore(config)[0] == 0
+    change(source)
+    calls = len(readRsyncLog())
+    status, record = runCore(config)
+
+    assert status == 0
+    return config, record, readRsyncLog()[calls:]
+
+
+def test_unchanged_point_is_skipped(bench):
+    config, record, calls = runChanged(bench, lambda source: rewrite(os.path.join(source, 'p1/top'), 'P1 TOP'))
+
+    assert record['values']['change_skipped'] == 1
+    assert [call[-2].rstrip('/').rsplit('/', 1)[-1] for call in calls] == ['p1']
+    for name in ['p2/top', 'p2/a/1', 'p2/b/1', 'p2/b/2']:
+        assert os.path.samefile(shardPath(config, 'daily.0', name), shardPath(config, 'daily.1', name)), name
+
+
+def test_point_is_narrowed_to_the_changed_subtree(bench):
+    config, record, calls = runChanged(bench, lambda source: rewrite(os.path.join(source, 'p1/a/2'), 'P1 A 2'))
+
+    assert record['values']['change_narrowed'] == 1
+    assert len(calls) == 1
+    excludes = [arg for arg in calls[0] if arg.startswith('--exclude=')]
+    assert len(excludes) == 1 and excludes[0].endswith('/p1/b/')
+    assert os.path.samefile(shardPath(config, 'daily.0', 'p1/b/1'), shardPath(config, 'daily.1', 'p1/b/1'))
+    assert not os.path.samefile(shardPath(config, 'daily.0', 'p1/a/2'), shardPath(config, 'daily.1', 'p1/a/2'))
+    with open(shardPath(config, 'daily.0', 'p1/a/2')) as f:
+        assert f.read() == 'P1 A 2'
+
+
+def test_file_rewritten_in_place_in_an_unchanged_directory_is_picked_up(bench):
+    def change(source):
+        directory = os.path.join(source, 'p2/b')
+        st = os.stat(directory)
+        rewrite(os.path.join(directory, '2'), 'P2 B 2')
+        os.utime(directory, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    config, record, calls = runChanged(bench, change)
+
+    assert [call[-2].rstrip('/').rsplit('/', 1)[-1] for call in calls] == ['p2']
+    with open(shardPath(config, 'daily.0', 'p2/b/2')) as f:
+        assert f.read() == 'P2 B 2'
+    with open(shardPath(config, 'daily.1', 'p2/b/2')) as f:
+        assert f.read() == 'p2 b 2'
+
+
+def dedupeRuns(bench):
+    config, _ = bench(dedupe=True)
+    source = os.path.join(config['client']['mountpoint'], 'd00000')
+    assert runCore(config)[0] == 0
+    # every file of createSource has the same content, only the mtimes tell them apart
+    os.rename(os.path.join(source, 'f00000003'), os.path.join(source, 'moved'))
+    shutil.copyfile(os.path.join(source, 'f00000004'), os.path.join(source, 'copy'))
+    status, record = runCore(config)
+
+    assert status == 0
+    return config, record
+
+
+def test_dedupe_links_a_moved_file_but_not_a_copy_with_another_mtime(bench):
+    config, record = dedupeRuns(bench)
+    root = config['rsnapshot']['root_folder']
+
+    assert record['values']['dedupe_linked'] == 1
+    assert os.path.samefile(os.path.join(root, 'daily.0/d00000/moved'), os.path.join(root, 'daily.1/d00000/f00000003'))
+    assert os.stat(os.path.join(root, 'daily.0/d00000/copy')).st_nlink == 1
+
+
+def test_dedupe_cache_spares_the_second_hash(bench):
+    config, record = dedupeRuns(bench)
+    root = config['rsnapshot']['root_folder']
+    assert record['values']['dedupe_hashed'] > 0
+
+    dedupe = dedupeCore(config['rsnapshot']['dedupe']['cache'], minSize=1)
+    try:
+        result = dedupe.run(os.path.join(root, 'daily.0'), os.path.join(root, 'daily.1'))
+    finally:
+        dedupe.close()
+
+    assert result['candidates'] > 0
+    assert result['hashed'] == 0
+    assert result['linked'] == 0
+
+
+def trashRuns(bench, monkeypatch, fail=None, maxTime=0):
+    config, bmc = bench(trash=True)
+    root = config['rsnapshot']['root_folder']
+    for _ in range(3):
+        assert runCore(config)[0] == 0
+    with open(os.path.join(root, 'daily.2', 'expired'), 'w') as f:
+        f.write('expired')
+
+    config['rsnapshot']['trash']['max_time'] = maxTime
+    if fail is not None:
+        monkeypatch.setenv(f'FAKE_FAIL_{fail.upper()}', '1')
+    status, record = runCore(config)
+    return config, bmc, status, record, os.path.join(root, '_trash')
+
+
+def test_trash_takes_the_expired_rotation(bench, monkeypatch):
+    # a reclaim budget that is gone before the first rotation leaves the trash as the run made it
+    config, _, status, record, trash = trashRuns(bench, monkeypatch, maxTime=1e-9)
+
+    assert status == 0
+    rotations = os.listdir(trash)
+    assert len(rotations) == 1 and rotations[0].startswith('daily.2.')
+    assert os.path.isfile(os.path.join(trash, rotations[0], 'expired'))
+    assert not os.path.exists(os.path.join(config['rsnapshot']['root_folder'], 'daily.2', 'expired'))
+
+
+def test_trash_gives_the_rotation_back_when_rsnapshot_fails(bench, monkeypatch):
+    config, _, status, record, trash = trashRuns(bench, monkeypatch, fail='rsnapshot')
+
+    assert status == 1
+    assert record['failed_phase'] == 'rsnapshot'
+    assert os.path.isfile(os.path.join(config['rsnapshot']['root_folder'], 'daily.2', 'expired'))
+    assert not os.path.isdir(trash) or not os.listdir(trash)
+
+
+def test_trash_is_reclaimed_after_power_off(bench, monkeypatch):
+    powerAtReclaim = []
+    reclaim = trashCore.reclaim
+
+    def watchedReclaim(self, *args):
+        powerAtReclaim.append(bmcs[0].power)
+        return reclaim(self, *args)
+
+    bmcs = []
+
+    def watchedBench(**kwargs):
+        config, bmc = bench(**kwargs)
+        bmcs.append(bmc)
+        return config, bmc
+
+    monkeypatch.setattr(trashCore, 'reclaim', watchedReclaim)
+    config, bmc, status, record, trash = trashRuns(watchedBench, monkeypatch)
+
+    assert status == 0
+    assert powerAtReclaim == ['off']
+    assert record['phases']['trash_reclaim']['outcome'] == 'ok'
+    assert record['values']['trash_files'] == 21
+    assert record['values']['trash_backlog'] == 0
+    assert not os.listdir(trash)
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+# Copyright 2023 WebEye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import pytest
+
+from libs.core.redfishCore import redfishCore
+from tools.fakeRedfish import fakeRedfish
+
+
+@pytest.fixture
+def redfish():
+    servers = []
+    clients = []
+
+    def create(**kwargs):
+        server = fakeRedfish('admin', 'secret', **kwargs).start()
+        client = redfishCore(server.address[0], 'admin', 'secret', port=server.address[1], scheme='http')
+        servers.append(server)
+        clients.append(client)
+        return server, client
+
+    yield create
+    for client in clients:
+        client.close()
+    for server in servers:
+        server.stop()
+
+
+def test_login_uses_session_token(redfish):
+    server, client = redfish()
+
+    assert client.getChassisPowerStatus() == (0, 'off')
+    assert len(server.sessions) == 1
+    assert client._token == list(server.sessions.values())[0]
+
+    client.close()
+    assert server.sessions == {}
+
+
+def test_relogin_after_401(redfish):
+    server, client = redfish(power='on')
+    assert client.getChassisPowerStatus() == (0, 'on')
+    expired = client._token
+
+    # the BMC dropped the session, the next call logs in again and succeeds
+    server.sessions.clear()
+    assert client.getChassisPowerStatus() == (0, 'on')
+    assert len(server.sessions) == 1
+    assert client._token != expired
+
+
+def test_one_reconnect_after_dropped_keepalive(redfish):
+    server, client = redfish()
+    assert client.getChassisPowerStatus() == (0, 'off')
+    assert server.connections == 1
+
+    server.dropNext = True
+    assert client.getChassisPowerStatus() == (0, 'off')
+    assert client.getChassisPowerStatus() == (0, 'off')
+    assert server.connections == 2
+
+
+def test_basic_auth_without_session_service(redfish):
+    server, client = redfish(sessionService=False)
+
+    assert client.getChassisPowerStatus() == (0, 'off')
+    assert client.setChassisPower('on') == (0, 'on')
+    assert server.power == 'on'
+    assert client._token is None
+    assert server.sessions == {}
+
+
+def test_wrong_password_fails(redfish):
+    server, _ = redfish()
+    client = redfishCore(server.address[0], 'admin', 'wrong', port=server.address[1], scheme='http')
+
+    status, message = client.getChassisPowerStatus()
+    assert status == -1
+    assert '401' in message
+
+
+@pytest.mark.parametrize('status,resetType,power', [
+    ('on', 'On', 'on'),
+    ('off', 'ForceOff', 'off'),
+    ('soft', 'GracefulShutdown', 'off'),
+    ('cycle', 'PowerCycle', 'on'),
+    ('reset', 'ForceRestart', 'on'),
+])
+def test_reset_type_mapping(redfish, status, resetType, power):
+    server, client = redfish(power='on' if power == 'off' else 'off')
+
+    assert client.setChassisPower(status) == (0, status)
+    assert server.resets == [resetType]
+    assert client.getChassisPowerStatus() == (0, power)
+
+
+def test_unsupported_power_state(redfish):
+    server, client = redfish()
+
+    assert client.setChassisPower('hibernate')[0] == -1
+    assert server.resets == []
@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+# Copyright 2023 WebEye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import argparse
+import logging
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+from libs.backupCore import backupCore
+from tools.fakeBmc import fakeBmc
+
+FAKE_PING = '''#!/bin/sh
+[ -n "$FAKE_FAIL_PING" ] && exit 1
+[ -f "$FAKE_STATE/ready_at" ] || exit 1
+awk -v now="$(date +%s.%N)" '{ exit !(now >= $1) }' "$FAKE_STATE/ready_at"
+'''
+
+FAKE_MOUNT = '''#!/bin/sh
+[ -n "$FAKE_FAIL_MOUNT" ] && exit 32
+exit 0
+'''
+
+FAKE_UMOUNT = '''#!/bin/sh
+[ -n "$FAKE_FAIL_UMOUNT" ] && exit 32
+exit 0
+'''
+
+# rotates like rsnapshot and syncs like rsync --link-dest: unchanged files are hardlinked
+# from <command>.1, changed ones are copied and itemized
+FAKE_RSNAPSHOT = '''#!{python}
+import os, shutil, sys
+
+if os.environ.get('FAKE_FAIL_RSNAPSHOT'):
+    print('fake rsnapshot: injected failure', file=sys.stderr)
+    sys.exit(1)
+
+root, source, retain = os.environ['FAKE_ROOT'], os.environ['FAKE_SOURCE'], int(os.environ['FAKE_RETAIN'])
+command = sys.argv[-1]
+oldest = os.path.join(root, f'{{command}}.{{retain - 1}}')
+if os.path.isdir(oldest):
+    shutil.rmtree(oldest)
+for index in range(retain - 2, -1, -1):
+    path = os.path.join(root, f'{{command}}.{{index}}')
+    if os.path.isdir(path):
+        os.rename(path, os.path.join(root, f'{{command}}.{{index + 1}}'))
+
+previous, snapshot = os.path.join(root, f'{{command}}.1'), os.path.join(root, f'{{command}}.0')
+transferred = literal = 0
+for dirpath, _, filenames in os.walk(source):
+    relative = os.path.relpath(dirpath, source)
+    os.makedirs(os.path.join(snapshot, relative), exist_ok=True)
+    for filename in filenames:
+        src = os.path.join(dirpath, filename)
+        dst = os.path.join(snapshot, relative, filename)
+        old = os.path.join(previous, relative, filename)
+        st = os.stat(src)
+        try:
+            ost = os.stat(old)
+            if ost.st_size == st.st_size and int(ost.st_mtime) == int(st.st_mtime):
+                os.link(old, dst)
+                continue
+        except OSError:
+            pass
+        shutil.copy2(src, dst)
+        transferred += 1
+        literal += st.st_size
+        print(f'>f+++++++++ {{st.st_size}} {{os.path.join(relative, filename)}}')
+
+print(f'Number of regular files transferred: {{transferred}}')
+print(f'Literal data: {{literal}} bytes')
+print('Matched data: 0 bytes')
+'''
+
+# enough of rsync for the sharded sync: --relative, --include/--exclude, --link-dest with the size and mtime
+# quick check, itemized output and the --stats lines; every call is logged to $FAKE_STATE/rsync.log
+FAKE_RSYNC = '''#!{python}
+import fnmatch, json, os, shutil, sys
+
+if os.environ.get('FAKE_FAIL_RSYNC'):
+    print('fake rsync: injected failure', file=sys.stderr)
+    sys.exit(23)
+
+args = sys.argv[1:]
+with open(os.path.join(os.environ['FAKE_STATE'], 'rsync.log'), 'a') as f:
+    f.write(json.dumps(args) + '\\n')
+
+options = [arg for arg in args if arg.startswith('-')]
+source, destination = [arg for arg in args if not arg.startswith('-')][-2:]
+linkDest = next((arg.split('=', 1)[1] for arg in options if arg.startswith('--link-dest=')), None)
+rules = [(arg.startswith('--include='), arg.split('=', 1)[1]) for arg in options
+         if arg.startswith(('--include=', '--exclude='))]
+
+if '--relative' in options or '-R' in options:
+    base = source.rstrip('/')
+    target = os.path.join(destination, base.lstrip('/'))
+elif source.endswith('/'):
+    base, target = '', destination
+else:
+    base = '/' + os.path.basename(source)
+    target = os.path.join(destination, os.path.basename(source))
+
+
+def excluded(path, isDir):
+    for include, pattern in rules:
+        if pattern.endswith('/') and not isDir:
+            continue
+        pattern = pattern.rstrip('/')
+        if pattern.startswith('/'):
+            hit = fnmatch.fnmatchcase(path, pattern)
+        else:
+            hit = fnmatch.fnmatchcase(path, '*/' + pattern)
+        if hit:
+            return not include
+    return False
+
+
+transferred = literal = 0
+for dirpath, dirnames, filenames in os.walk(source):
+    relative = os.path.relpath(dirpath, source)
+    relative = '' if relative == '.' else relative
+    dirnames[:] = [name for name in dirnames if not excluded(f'{{base}}/{{os.path.join(relative, name)}}', True)]
+    os.makedirs(os.path.join(target, relative), exist_ok=True)
+    for filename in filenames:
+        name = os.path.join(relative, filename)
+        if excluded(f'{{base}}/{{name}}', False):
+            continue
+        src, dst = os.path.join(source, name), os.path.join(target, name)
+        st = os.stat(src)
+        if os.path.lexists(dst):
+            os.unlink(dst)
+        if linkDest is not None:
+            old = os.path.join(linkDest, os.path.relpath(target, destination), name)
+            try:
+                ost = os.stat(old)
+                if ost.st_size == st.st_size and int(ost.st_mtime) == int(st.st_mtime):
+                    os.link(old, dst)
+                    continue
+            except OSError:
+                pass
+        shutil.copy2(src, dst)
+        transferred += 1
+        literal += st.st_size
+        print(f'>f+++++++++ {{st.st_size}} {{os.path.join(base, name)}}')
+
+print(f'Number of regular files transferred: {{transferred}}')
+print(f'Literal data: {{literal}} bytes')
+print('Matched data: 0 bytes')
+'''
+
+EXTERNAL_PHASES = ['time_to_ready', 'rsnapshot', 'verify', 'disk_usage', 'catalog', 'trash_reclaim']
+
+
+def writeScript(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+    os.chmod(path, 0o755)
+
+
+def createSource(source, files, sizeBytes, filesPerDir=1000):
+    block = os.urandom(1024 * 1024)
+    fileSize = max(1, sizeBytes // max(1, files))
+    for index in range(files):
+        directory = os.path.join(source, f'd{index // filesPerDir:05}')
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f'f{index:08}'), 'wb') as f:
+            remaining = fileSize
+            while remaining > 0:
+                f.write(block[:remaining])
+                remaining -= len(block)
+
+
+def changeSource(source, fraction, run):
+    filenames = sorted(os.path.join(dirpath, filename) for dirpath, _, names in os.walk(source) for filename in names)
+    step = max(1, int(1 / fraction)) if fraction > 0 else 0
+    if step == 0:
+        return 0
+
+    changed = 0
+    for filename in filenames[run % step::step]:
+        with open(filename, 'r+b') as f:
+            f.write(os.urandom(64))
+        st = os.stat(filename)
+        os.utime(filename, (st.st_atime, st.st_mtime + 2))
+        changed += 1
+    return changed
+
+
+def createBench(base, bootDelay=2.0, verify='off', trash=False, throttle=False, timeout=30, points=None, workers=1,
+                changes=False, rsnapshotConf='', dedupe=False):
+    state, bindir = os.path.join(base, 'state'), os.path.join(base, 'bin')
+    source, root = os.path.join(base, 'source'), os.path.join(base, 'snapshots')
+    for directory in [state, bindir, source, root]:
+        os.makedirs(directory)
+
+    writeScript(os.path.join(bindir, 'ping'), FAKE_PING)
+    writeScript(os.path.join(bindir, 'mount'), FAKE_MOUNT)
+    writeScript(os.path.join(bindir, 'umount'), FAKE_UMOUNT)
+    writeScript(os.path.join(bindir, 'rsnapshot'), FAKE_RSNAPSHOT.format(python=sys.executable))
+    writeScript(os.path.join(bindir, 'rsync'), FAKE_RSYNC.format(python=sys.executable))
+    script = os.path.join(base, 'rsnapshot.conf')
+    with open(script, 'w') as f:
+        f.write(f'snapshot_root\t{root}/\nretain\tdaily\t3\ncmd_rsync\t{os.path.join(bindir, "rsync")}\n'
+                f'cmd_cp\t{shutil.which("cp") or "/bin/cp"}\n{rsnapshotConf}')
+        if points is None:
+            # the fake rsnapshot copies the tree straight into <command>.0, like rsync without --relative
+            f.write(f'rsync_long_args\t--delete --numeric-ids\nbackup\t{source}/\t./\n')
+        else:
+            # one backup point per source subdirectory, with rsnapshot's default --relative layout
+            for point in points:
+                f.write(f'backup\t{os.path.join(source, point)}/\tlocalhost/\n')
+
+    readyFile = os.path.join(state, 'ready_at')
+
+    def onPowerChange(power):
+        if power == 'on':
+            with open(readyFile, 'w') as f:
+                f.write(f'{time.time() + bootDelay:.6f}\n')
+        elif os.path.exists(readyFile):
+            os.unlink(readyFile)
+
+    bmc = fakeBmc('admin', 'secret', onPowerChange=onPowerChange)
+
+    config = {
+        'ipmi': {'host': bmc.address[0], 'port': bmc.address[1], 'user': 'admin', 'password': 'secret',
+                 'backend': 'native'},
+        'server': {'host': '127.0.0.1', 'timeout': bootDelay + timeout, 'mountpoint': '/export', 'probe': ['icmp']},
+        'client': {'mountpoint': source},
+        'rsnapshot': {'script': script, 'command': 'daily', 'root_folder': root,
+                      'binary': os.path.join(bindir, 'rsnapshot'), 'progress_interval': 3600, 'workers': workers,
+                      'change_detection': {'enabled': changes},
+                      'verify': {'mode': verify, 'sample': 0.1}, 'trash': {'enabled': trash},
+                      'dedupe': {'enabled': dedupe, 'cache': os.path.join(base, 'dedupe.db'), 'min_size': 1},
+                      'throttle': {'enabled': throttle, 'stats': os.path.join(base, 'throttle.json'),
+                                   'policies': {'default': {'nice': 10, 'ionice_class': 3}}}},
+        'log': {},
+        'mail': {}
+    }
+    environ = {'PATH': bindir + os.pathsep + os.environ['PATH'], 'FAKE_STATE': state, 'FAKE_ROOT': root,
+               'FAKE_SOURCE': source, 'FAKE_RETAIN': '3'}
+
+    return config, bmc, environ
+
+
+def main():
+    parser = argparse.ArgumentParser(description='end-to-end backupCore benchmark with local stand-ins')
+    parser.add_argument('-r', '--runs', default=3, type=int)
+    parser.add_argument('-n', '--files', default=10000, type=int)
+    parser.add_argument('-s', '--size-mb', default=256, type=int, help='total size of the synthetic source tree')
+    parser.add_argument('-c', '--change', default=0.05, type=float, help='fraction of files changed between runs')
+    parser.add_argument('-b', '--boot-delay', default=2.0, type=float, help='seconds from power on to ping')
+    parser.add_argument('-f', '--fail', choices=['ipmi', 'ping', 'mount', 'rsnapshot', 'umount'],
+                        help='inject a failure into one stage')
+    parser.add_argument('-V', '--verify', default='off', choices=['off', 'sample', 'full'],
+                        help='verify mode of the snapshot against the source')
+    parser.add_argument('-t', '--trash', action='store_true', help='defer deletion of expired rotations')
+    parser.add_argument('-T', '--throttle', action='store_true', help='run the snapshot under nice and idle ionice')
+    parser.add_argument('-d', '--directory', default='/dev/shm' if os.path.isdir('/dev/shm') else None,
+                        help='where the trees are created (tmpfs recommended)')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING,
+                        format='%(asctime)s - %(levelname)-8s - %(message)s')
+
+    base = tempfile.mkdtemp(prefix='ipmi-backup-bench-', dir=args.directory)
+    try:
+        config, bmc, environ = createBench(base, args.boot_delay, args.verify, args.trash, args.throttle)
+        os.environ.update(environ)
+        if args.fail and args.fail != 'ipmi':
+            os.environ[f'FAKE_FAIL_{args.fail.upper()}'] = '1'
+
+        source = config['client']['mountpoint']
+        start_time = time.monotonic()
+        createSource(source, args.files, args.size_mb * 1024 * 1024)
+        print(f'created {args.files} files ({args.size_mb} MB) in {time.monotonic() - start_time:.2f} s under {base}')
+
+        if args.fail != 'ipmi':
+            bmc.start()
+
+        print(f'{"run":>3} {"status":>6} {"wall":>8} {"ready":>8} {"rsnap":>8} {"du":>8} {"overhead":>9}')
+        overheads = []
+        for run in range(args.runs):
+            if run > 0:
+                changeSource(source, args.change, run)
+
+            core = backupCore(config, 'bench')
+            status = core.process()
+            core.close()
+
+            record = core.lastRun
+            phases = record['phases']
+            external = sum(phases[name]['duration'] for name in EXTERNAL_PHASES if name in phases)
+            overhead = record['duration'] - external
+            overheads.append(overhead)
+
+            def duration(name):
+                return phases[name]['duration'] if name in phases else 0.0
+
+            print(f'{run:3} {status:6} {record["duration"]:8.3f} {duration("time_to_ready"):8.3f} '
+                  f'{duration("rsnapshot"):8.3f} {duration("disk_usage"):8.3f} {overhead:9.3f}'
+                  + (f'  failed: {record["failed_phase"]}' if record['failed_phase'] else ''))
+
+        print(f'orchestration overhead: mean {statistics.mean(overheads):.3f} s, '
+              f'min {min(overheads):.3f} s, max {max(overheads):.3f} s')
+        bmc.stop()
+    finally:
+        shutil.rmtree(base, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+# Copyright 2023 WebEye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import argparse
+import hmac
+import os
+import socket
+import struct
+import threading
+import time
+
+from libs.core.rmcpSession import rmcpError, wrapPacket, unwrapPacket, wrapLegacyPacket, unwrapLegacyPacket, \
+    buildMessage, parseMessage, deriveKeys, hmacSha1, hasAES, \
+    PAYLOAD_IPMI, PAYLOAD_OPEN_SESSION_REQUEST, PAYLOAD_OPEN_SESSION_RESPONSE, PAYLOAD_RAKP1, PAYLOAD_RAKP2, \
+    PAYLOAD_RAKP3, PAYLOAD_RAKP4, NETFN_APP, NETFN_CHASSIS, CMD_GET_CHASSIS_STATUS, CMD_CHASSIS_CONTROL, \
+    CMD_GET_CHANNEL_AUTH_CAPS, CMD_SET_SESSION_PRIVILEGE, CMD_CLOSE_SESSION, BMC_ADDRESS, CONSOLE_ADDRESS, \
+    PRIV_ADMIN, CONFIDENTIALITY_AES_CBC_128
+
+
+class fakeBmc:
+
+    def __init__(self, username, password, host='127.0.0.1', port=0, delay=0.0, power='off', onPowerChange=None):
+        self._username = username.encode()
+        self._kuid = password.encode()[:20]
+        self._delay = delay
+        self.power = power
+        self._onPowerChange = onPowerChange
+        self.handshakes = 0
+        self.commands = 0
+
+        self._sessions = {}
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind((host, port))
+        self._sock.settimeout(0.2)
+        self.address = self._sock.getsockname()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self.serve, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+        self._sock.close()
+
+    def serve(self):
+        while self._running:
+            try:
+                packet, peer = self._sock.recvfrom(1024)
+            except socket.timeout:
+                continue
+
+            if self._delay:
+                time.sleep(self._delay)
+
+            try:
+                response = self._handle(packet)
+            except (rmcpError, struct.error, IndexError):
+                continue
+
+            if response is not None:
+                self._sock.sendto(response, peer)
+
+    def _handle(self, packet):
+        if len(packet) > 4 and packet[4] == 0x00:
+            request = parseMessage(unwrapLegacyPacket(packet))
+            if request['cmd'] != CMD_GET_CHANNEL_AUTH_CAPS:
+                return None
+            data = bytes([0x00, 0x01, 0x80, 0x04, 0x02, 0, 0, 0, 0])
+            return wrapLegacyPacket(self._reply(request, data))
+
+        sessionId = struct.unpack_from('<I', packet, 6)[0]
+        session = self._sessions.get(sessionId)
+        if session is not None and session.get('k1') is not None:
+            payloadType, _, _, payload = unwrapPacket(packet, session['k1'], session['k2'])
+        else:
+            payloadType, _, _, payload = unwrapPacket(packet)
+
+        if payloadType == PAYLOAD_OPEN_SESSION_REQUEST:
+            return self._openSession(payload)
+        elif payloadType == PAYLOAD_RAKP1:
+            return self._rakp1(payload)
+        elif payloadType == PAYLOAD_RAKP3:
+            return self._rakp3(payload)
+        elif payloadType == PAYLOAD_IPMI and session is not None and session.get('k1') is not None:
+            return self._command(sessionId, session, parseMessage(payload))
+
+        return None
+
+    @staticmethod
+    def _reply(request, data):
+        return buildMessage(CONSOLE_ADDRESS, request['netFn'] + 1, BMC_ADDRESS, request['rqSeq'], request['cmd'],
+                            data)
+
+    def _openSession(self, payload):
+        tag, consoleId = payload[0], struct.unpack_from('<I', payload, 4)[0]
+        confidentiality = payload[28]
+        if confidentiality == CONFIDENTIALITY_AES_CBC_128 and not hasAES():
+            return wrapPacket(PAYLOAD_OPEN_SESSION_RESPONSE, bytes([tag, 0x11]) + bytes(6))
+
+        bmcId = struct.unpack('<I', os.urandom(4))[0] | 1
+        self._sessions[bmcId] = {'consoleId': consoleId, 'aes': confidentiality == CONFIDENTIALITY_AES_CBC_128}
+        response = struct.pack('<BBBxII', tag, 0, PRIV_ADMIN, consoleId, bmcId) + payload[8:32]
+        return wrapPacket(PAYLOAD_OPEN_SESSION_RESPONSE, response)
+
+    def _rakp1(self, payload):
+        tag, bmcId = payload[0], struct.unpack_from('<I', payload, 4)[0]
+        session = self._sessions.get(bmcId)
+        if session is None:
+            return wrapPacket(PAYLOAD_RAKP2, bytes([tag, 0x02]) + bytes(6))
+
+        role, length = payload[24], payload[27]
+        username = payload[28:28 + length]
+        if username != self._username:
+            return wrapPacket(PAYLOAD_RAKP2, bytes([tag, 0x0D]) + bytes(6))
+
+        session.update({'rm': payload[8:24], 'rc': os.urandom(16), 'guid': os.urandom(16), 'role': role,
+                        'username': username})
+        authCode = hmacSha1(self._kuid, struct.pack('<II', session['consoleId'], bmcId) + session['rm'] +
+                            session['rc'] + session['guid'] + bytes([role, length]) + username)
+        response = struct.pack('<BBxxI', tag, 0, session['consoleId']) + session['rc'] + session['guid'] + authCode
+        return wrapPacket(PAYLOAD_RAKP2, response)
+
+    def _rakp3(self, payload):
+        tag, bmcId = payload[0], struct.unpack_from('<I', payload, 4)[0]
+        session = self._sessions.get(bmcId)
+        if session is None or 'rc' not in session:
+            return wrapPacket(PAYLOAD_RAKP4, bytes([tag, 0x02]) + bytes(6))
+
+        user = bytes([session['role'], len(session['username'])]) + session['username']
+        expected = hmacSha1(self._kuid, session['rc'] + struct.pack('<I', session['consoleId']) + user)
+        if not hmac.compare_digest(expected, payload[8:28]):
+            return wrapPacket(PAYLOAD_RAKP4, bytes([tag, 0x0F]) + bytes(6))
+
+        sik, k1, k2 = deriveKeys(self._kuid, session['rm'], session['rc'], session['role'], session['username'])
+        session['k1'] = k1
+        session['k2'] = k2 if session['aes'] else None
+        self.handshakes += 1
+
+        icv = hmacSha1(sik, session['rm'] + struct.pack('<I', bmcId) + session['guid'])[:12]
+        return wrapPacket(PAYLOAD_RAKP4, struct.pack('<BBxxI', tag, 0, session['consoleId']) + icv)
+
+    def _command(self, bmcId, session, request):
+        self.commands += 1
+        netFn, cmd, data = request['netFn'], request['cmd'], request['data']
+        if netFn == NETFN_APP and cmd == CMD_SET_SESSION_PRIVILEGE:
+            response = bytes([0x00, data[0]])
+        elif netFn == NETFN_APP and cmd == CMD_CLOSE_SESSION:
+            response = bytes([0x00])
+        elif netFn == NETFN_CHASSIS and cmd == CMD_GET_CHASSIS_STATUS:
+            response = bytes([0x00, 0x01 if self.power == 'on' else 0x00, 0x00, 0x00])
+        elif netFn == NETFN_CHASSIS and cmd == CMD_CHASSIS_CONTROL:
+            self.power = 'on' if data[0] in (0x01, 0x02, 0x03) else 'off'
+            if self._onPowerChange is not None:
+                self._onPowerChange(self.power)
+            response = bytes([0x00])
+        else:
+            response = bytes([0xC1])
+
+        packet = wrapPacket(PAYLOAD_IPMI, self._reply(request, response), session['consoleId'], 0, session['k1'],
+                            session['k2'])
+        if netFn == NETFN_APP and cmd == CMD_CLOSE_SESSION:
+            self._sessions.pop(bmcId, None)
+        return packet
+
+
+def main():
+    parser = argparse.ArgumentParser(description='local RMCP+ BMC stand-in')
+    parser.add_argument('-a', '--address', default='127.0.0.1', type=str)
+    parser.add_argument('-p', '--port', default=6230, type=int)
+    parser.add_argument('-u', '--user', default='admin', type=str)
+    parser.add_argument('-P', '--password', default='admin', type=str)
+    parser.add_argument('-d', '--delay', default=0.0, type=float, help='per packet processing delay in seconds')
+    args = parser.parse_args()
+
+    bmc = fakeBmc(args.user, args.password, args.address, args.port, args.delay)
+    print(f'fake bmc listening on {bmc.address[0]}:{bmc.address[1]}')
+    bmc.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        bmc.stop()
+
+
+if __name__ == '__main__':
+    main()
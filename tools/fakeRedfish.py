@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+# Copyright 2023 WebEye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import argparse
+import base64
+import json
+import secrets
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SYSTEM = '/redfish/v1/Systems/1'
+
+
+class _handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out as separate writes, with nagle every keep-alive request waits for a delayed ack
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.owner.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=None, headers=None):
+        data = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+        # like a BMC timing out an idle keep-alive connection, without announcing it to the client
+        owner = self.server.owner
+        if owner.dropNext:
+            owner.dropNext = False
+            self.close_connection = True
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def _authorized(self):
+        owner = self.server.owner
+        if self.headers.get('X-Auth-Token') in owner.sessions.values():
+            return True
+        credentials = base64.b64encode(f'{owner.username}:{owner.password}'.encode()).decode()
+        return self.headers.get('Authorization') == f'Basic {credentials}'
+
+    def _handle(self, method):
+        owner = self.server.owner
+        owner.requests += 1
+        if owner.delay:
+            time.sleep(owner.delay)
+
+        body = self._body()
+        if method == 'POST' and self.path == '/redfish/v1/SessionService/Sessions' and owner.sessionService:
+            if body.get('UserName') != owner.username or body.get('Password') != owner.password:
+                return self._send(401, {'error': 'invalid credentials'})
+            token = secrets.token_hex(16)
+            sessionId = str(len(owner.sessions) + 1)
+            owner.sessions[sessionId] = token
+            return self._send(201, {'Id': sessionId}, {
+                'X-Auth-Token': token, 'Location': f'/redfish/v1/SessionService/Sessions/{sessionId}'})
+
+        if not self._authorized():
+            return self._send(401, {'error': 'unauthorized'})
+
+        if method == 'DELETE' and self.path.startswith('/redfish/v1/SessionService/Sessions/'):
+            owner.sessions.pop(self.path.rsplit('/', 1)[-1], None)
+            return self._send(204)
+        if method == 'GET' and self.path == '/redfish/v1/Systems':
+            return self._send(200, {'Members': [{'@odata.id': SYSTEM}]})
+        if method == 'GET' and self.path == SYSTEM:
+            return self._send(200, {'Id': '1', 'PowerState': 'On' if owner.power == 'on' else 'Off'})
+        if method == 'POST' and self.path == f'{SYSTEM}/Actions/ComputerSystem.Reset':
+            resetType = body.get('ResetType')
+            if resetType not in ('On', 'ForceOff', 'GracefulShutdown', 'ForceRestart', 'PowerCycle'):
+                return self._send(400, {'error': f'invalid ResetType {resetType}'})
+            owner.resets.append(resetType)
+            owner.setPower('off' if resetType in ('ForceOff', 'GracefulShutdown') else 'on')
+            return self._send(204)
+
+        return self._send(404, {'error': 'not found'})
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+
+class fakeRedfish:
+
+    def __init__(self, username, password, host='127.0.0.1', port=0, delay=0.0, power='off', onPowerChange=None,
+                 sessionService=True):
+        self.username = username
+        self.password = password
+        self.delay = delay
+        self.power = power
+        self.sessionService = sessionService
+        self.sessions = {}
+        self.resets = []
+        self.connections = 0
+        self.requests = 0
+        self.dropNext = False
+        self._onPowerChange = onPowerChange
+
+        self._server = ThreadingHTTPServer((host, port), _handler)
+        self._server.daemon_threads = True
+        self._server.owner = self
+        self.address = self._server.server_address
+        self._thread = None
+
+    def setPower(self, power):
+        self.power = power
+        if self._onPowerChange is not None:
+            self._onPowerChange(power)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='local plain http redfish stand-in')
+    parser.add_argument('-a', '--address', default='127.0.0.1', type=str)
+    parser.add_argument('-p', '--port', default=8000, type=int)
+    parser.add_argument('-u', '--user', default='admin', type=str)
+    parser.add_argument('-P', '--password', default='admin', type=str)
+    parser.add_argument('-d', '--delay', default=0.0, type=float, help='per request processing delay in seconds')
+    args = parser.parse_args()
+
+    redfish = fakeRedfish(args.user, args.password, args.address, args.port, args.delay)
+    print(f'fake redfish listening on http://{redfish.address[0]}:{redfish.address[1]}')
+    redfish.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        redfish.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# Copyright 2023 WebEye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import argparse
+import socketserver
+import threading
+import time
+
+
+class _smtpHandler(socketserver.StreamRequestHandler):
+
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode())
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+
+        self.reply('220 localhost fake smtp')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+
+            command = line.decode(errors='replace').strip().upper()
+            if command.startswith('DATA'):
+                self.reply('354 end data with <CR><LF>.<CR><LF>')
+                message = []
+                for data in self.rfile:
+                    if data in (b'.\r\n', b'.\n'):
+                        break
+                    message.append(data[1:] if data.startswith(b'..') else data)
+                message = b''.join(message)
+                time.sleep(server.delay)
+                with server.lock:
+                    server.messages += 1
+                    server.bytes += len(message)
+                    server.received.append(message)
+                self.reply('250 ok')
+            elif command.startswith('QUIT'):
+                self.reply('221 bye')
+                return
+            elif command.startswith('EHLO') or command.startswith('HELO'):
+                self.reply('250 localhost')
+            else:
+                self.reply('250 ok')
+
+
+class fakeSmtp(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0, delay=0.0):
+        socketserver.ThreadingTCPServer.__init__(self, (host, port), _smtpHandler)
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.messages = 0
+        self.bytes = 0
+        self.received = []
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='local SMTP stand-in')
+    parser.add_argument('-p', '--port', default=2525, type=int)
+    parser.add_argument('-d', '--delay', default=0.0, type=float, help='delay per message in seconds')
+    args = parser.parse_args()
+
+    server = fakeSmtp(port=args.port, delay=args.delay)
+    print(f'fake smtp listening on {server.server_address[0]}:{server.server_address[1]}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+# Copyright 2023 WebEye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from libs.core.ipmiCore import ipmiCore
+from libs.core.redfishCore import redfishCore
+from tools.fakeBmc import fakeBmc
+from tools.fakeRedfish import fakeRedfish
+
+# stand-in for the ipmitool binary: every call pays fork/exec, interpreter start
+# and a full RMCP+ handshake, which is what the subprocess backend costs per command
+IPMITOOL_SHIM = '''#!{python}
+import os, sys
+sys.path.insert(0, {root!r})
+from libs.core.rmcpSession import rmcpSession, NETFN_CHASSIS, CMD_GET_CHASSIS_STATUS, CMD_CHASSIS_CONTROL
+
+args = sys.argv[1:]
+host, port, user = args[args.index('-H') + 1], int(args[args.index('-p') + 1]), args[args.index('-U') + 1]
+session = rmcpSession(host, user, os.environ['IPMI_PASSWORD'], port)
+session.open()
+if args[-1] == 'status':
+    cc, data = session.command(NETFN_CHASSIS, CMD_GET_CHASSIS_STATUS)
+    print('Chassis Power is ' + ('on' if data[0] & 1 else 'off'))
+else:
+    control = {{'on': 1, 'off': 0, 'soft': 5}}[args[-1]]
+    session.command(NETFN_CHASSIS, CMD_CHASSIS_CONTROL, bytes([control]))
+    print({{'on': 'Chassis Power Control: Up/On', 'off': 'Chassis Power Control: Down/Off',
+           'soft': 'Chassis Power Control: Soft'}}[args[-1]])
+session.close()
+'''
+
+
+def measure(ipmi, iterations):
+    samples = []
+    for _ in range(iterations):
+        start_time = time.perf_counter()
+        err, status = ipmi.getChassisPowerStatus()
+        samples.append(time.perf_counter() - start_time)
+        if err != 0:
+            raise RuntimeError(f'getChassisPowerStatus() returns {err}, {status}')
+
+    return samples
+
+
+def report(name, samples, handshakes):
+    samples = sorted(samples)
+    p50 = samples[len(samples) // 2] * 1000
+    p95 = samples[int(len(samples) * 0.95) - 1] * 1000
+    mean = statistics.mean(samples) * 1000
+    print(f'{name:10} mean {mean:8.2f} ms  p50 {p50:8.2f} ms  p95 {p95:8.2f} ms  handshakes {handshakes}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='power driver latency benchmark against local bmc stand-ins')
+    parser.add_argument('-n', '--iterations', default=50, type=int)
+    parser.add_argument('-d', '--delay', default=0.0, type=float, help='per packet bmc processing delay in seconds')
+    args = parser.parse_args()
+
+    bmc = fakeBmc('admin', 'secret', delay=args.delay).start()
+    host, port = bmc.address
+
+    with tempfile.TemporaryDirectory() as shimDir:
+        shim = os.path.join(shimDir, 'ipmitool')
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        with open(shim, 'w') as f:
+            f.write(IPMITOOL_SHIM.format(python=sys.executable, root=root))
+        os.chmod(shim, 0o755)
+        os.environ['PATH'] = shimDir + os.pathsep + os.environ['PATH']
+
+        handshakes = bmc.handshakes
+        samples = measure(ipmiCore(host, 'admin', 'secret', 'ipmitool', port), args.iterations)
+        report('ipmitool', samples, bmc.handshakes - handshakes)
+
+        handshakes = bmc.handshakes
+        ipmi = ipmiCore(host, 'admin', 'secret', 'native', port)
+        samples = measure(ipmi, args.iterations)
+        ipmi.close()
+        report('native', samples, bmc.handshakes - handshakes)
+
+    bmc.stop()
+
+    # handshakes of the redfish driver are tcp connections, the session login happens once per connection
+    redfish = fakeRedfish('admin', 'secret', delay=args.delay).start()
+    host, port = redfish.address
+    driver = redfishCore(host, 'admin', 'secret', port, 'http')
+    samples = measure(driver, args.iterations)
+    driver.close()
+    report('redfish', samples, redfish.connections)
+    redfish.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# Copyright 2023 WebEye
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import argparse
+import logging
+import smtplib
+import time
+from logging.handlers import BufferingHandler
+
+from libs.common.BufferingSMTPHandler import BufferingSMTPHandler
+from tools.fakeSmtp import fakeSmtp
+
+
+class legacySMTPHandler(BufferingHandler):
+    # the delivery path before the background worker: string concatenation and a new
+    # connection on the logging thread for every flush
+    def __init__(self, mailhost, mailport, fromaddr, toaddrs, subject, capacity):
+        BufferingHandler.__init__(self, capacity)
+        self.mailhost = mailhost
+        self.mailport = mailport
+        self.fromaddr = fromaddr
+        self.toaddrs = toaddrs
+        self.subject = subject
+        self.setFormatter(logging.Formatter('%(asctime)s - %(levelname)-8s - %(message)s'))
+
+    def flush(self):
+        if len(self.buffer) > 0:
+            smtp = smtplib.SMTP(self.mailhost, self.mailport)
+            msg = 'From: {}\r\nTo: {}\r\nSubject: {}\r\n\r\n'.format(self.fromaddr, ",".join(self.toaddrs),
+                                                                      self.subject)
+            for record in self.buffer:
+                msg = msg + self.format(record) + "\r\n"
+            smtp.sendmail(self.fromaddr, self.toaddrs, msg)
+            smtp.quit()
+            self.buffer = []
+
+
+def measure(name, handler, server, records):
+    logger = logging.Logger(name)
+    logger.addHandler(handler)
+
+    samples = []
+    start_time = time.perf_counter()
+    for index in range(records):
+        call_time = time.perf_counter()
+        logger.info('rsync progress line %d with some payload to make it look like real output', index)
+        samples.append(time.perf_counter() - call_time)
+    hot_path = time.perf_counter() - start_time
+
+    handler.close()
+    total = time.perf_counter() - start_time
+
+    samples.sort()
+    print(f'{name:8} hot path {hot_path * 1000:9.2f} ms  p50 {samples[len(samples) // 2] * 1e6:8.2f} us  '
+          f'p99.9 {samples[int(len(samples) * 0.999)] * 1e6:10.2f} us  max {samples[-1] * 1000:8.2f} ms  '
+          f'total {total * 1000:9.2f} ms  mails {server.messages}  connections {server.connections}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='mail handler hot path latency against a local smtp stand-in')
+    parser.add_argument('-n', '--records', default=20000, type=int)
+    parser.add_argument('-c', '--capacity', default=500, type=int)
+    parser.add_argument('-d', '--delay', default=0.02, type=float, help='smtp delay per message in seconds')
+    args = parser.parse_args()
+
+    server = fakeSmtp(delay=args.delay).start()
+    host, port = server.server_address
+    measure('legacy', legacySMTPHandler(host, port, 'a@localhost', ['b@localhost'], 'bench', args.capacity),
+            server, args.records)
+
+    server.stop()
+    server = fakeSmtp(delay=args.delay).start()
+    handler = BufferingSMTPHandler(host, 'a@localhost', ['b@localhost'], 'bench', args.capacity)
+    handler.mailport = server.server_address[1]
+    measure('worker', handler, server, args.records)
+    server.stop()
+
+
+if __name__ == '__main__':
+    main()